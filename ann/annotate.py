@@ -10,11 +10,35 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import re
+import itertools
+import batch_lookup as bl
+import coverage_mask as cm
+import dbsnp_index as di
 import file_utils as fu
+import interval_index as ii
+import locality_cache as lc
+import overlap_engine as ve
+import position_index as pi
+import sweep_join as sj
+import tfbs_index as ti
+import transcript_model as tm
 import utils as u
+import variant_cache as vc
+import vcf_record as vr
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
+# Lines handed to the stages at a time, and the chunk size of batch lookups
+BATCH_SIZE = 10000
+
+# cpgIslandExt columns getGenes reads
+ISLAND_COLUMNS = ['chrom', 'chromStart', 'chromEnd', 'name']
+
+# CNV tables flagged by the CNV database stage, in output order
+CNV_TABLES = ['dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv',
+    'conrad_Cnv']
+
 def collapseGeneNames(row, indices, region, cnt):
     names = ['bin', 'name', 'chrom', 'transcriptStrand', 'txStart', 'txEnd', 
         'cdsStart', 'cdsEnd', 'exonCount', 'exonStarts', 'exonEnds', 'score',
@@ -59,7 +83,7 @@ def binarySearchUniqueAndSorted(arg0, key):
     obj = 0;
 
     while (low <= high):
-        mid = (low + high) / 2
+        mid = (low + high) // 2
         obj = arg0[mid]
 
         if (obj < key):
@@ -107,89 +131,417 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
+"""Alleles as the per-variant queries compare them
+   haplotypeReference="..." and REF="..." go through MySQL's default
+   collation, which is case-insensitive, so the in-process lookups match
+   on upper-cased alleles. The complement is taken before upper-casing,
+   as the queries take it
+"""
+def alleleKeys(*alleles):
+    return tuple([str(a).upper() for a in alleles])
 
-    inds = getFormatSpecificIndices(format=format)
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+"""Splits text the way reading it back from a file would
+   A stage writes 'line + \\n' and the next stage iterates over the file,
+   so any line break a database value puts into a record starts a new
+   line for the next stage
+"""
+def splitLines(text):
+    if ('\n' not in text) and ('\r' not in text):
+        return [text]
+    return re.split('\r\n|\r|\n', text)
 
-    for line in fh:
+
+"""Lines for the next stage from what a stage returned: the record
+   itself, or the lines of its text if the next stage would read that
+   differently (see vcf_record.VariantRecord)
+"""
+def handOn(line):
+    if isinstance(line, vr.VariantRecord):
+        if not line.reparse:
+            return [line]
+        line = line.text()
+    return splitLines(line)
+
+
+"""Runs stages over a file in a single pass
+   Every record goes through all stages in memory and only the output
+   of the last stage is written. The output is the same as chaining the
+   stages through intermediate files. Lines are handed to the stages in
+   chunks so that batch stages can resolve a whole chunk at once.
+   Files named .gz are read as gzip and written as indexed BGZF
+"""
+def runStages(stages, infile, outfile, chunk=BATCH_SIZE):
+    with fu.openFile(infile) as fh, \
+        fu.openFile(outfile, "w", index=True) as fh_out:
+        lines = list(itertools.islice(fh, chunk))
+        while (len(lines) > 0):
+            for stage in stages:
+                lines = vr.asRecords(lines, stage.sep)
+                missed = stage.fetchCached(lines)
+                if (len(missed) > 0):
+                    stage.prefetch(missed)
+                annotated = []
+                for l in lines:
+                    annotated.extend(handOn(stage.annotate(l)))
+                stage.storeCached()
+                lines = annotated
+            vr.writeRecords(fh_out, lines)
+            lines = list(itertools.islice(fh, chunk))
+
+    for stage in stages:
+        stage.close()
+
+
+"""Runs a single stage from one intermediate file to the next
+"""
+def runStage(stage, infile, outfile):
+    runStages([stage], infile, outfile)
+
+
+"""Base class for the annotation stages
+   annotate() takes one line and returns the annotated line, close()
+   writes the stage's counts to the .count.log file. A stage's work on a
+   record is split in two: fragment() looks up what the stage adds for
+   the variant, and depends on nothing but its key columns; apply() adds
+   it to the record and counts it. With a variant_cache.VariantCache set
+   as cache, fragments are kept across jobs and fetchCached() leaves out
+   the records whose fragment is known before the lookups. With batch=True
+   prefetch() resolves the reference lookups for a whole chunk of lines
+   in a few statements before the lines are annotated. With an
+   async_lookup.AsyncLookup set as lookup, prefetch() instead runs the
+   per-variant statements of the chunk concurrently and query() answers
+   from their results. With an annotation_catalog.AnnotationCatalog set
+   as catalog, the fragments of known sites are taken from it first.
+   With a fragment_sidecar.FragmentSidecar set as sidecar, every fragment
+   is kept in it, and those it holds for the stage's table versions are
+   taken from it before the catalog and the cache.
+   Stages with a locality_cache.LocalityCache set as
+   near answer a position inside span() of the last lookup with its
+   fragment.
+   Lines are handed from stage to stage as vcf_record.VariantRecords, so
+   each is split once and INFO is built once, when it is written
+"""
+class Stage(object):
+    sep = '\t'
+    batch = False
+    lookup = None
+    results = None
+    cache = None
+    catalog = None
+    sidecar = None
+    cached = None
+    kept = None
+    near = None
+
+    def isHeader(self, line):
+        return line.startswith("#")
+
+    """The VariantRecord of a line or record, None for a header line
+    """
+    def record(self, line):
+        if isinstance(line, vr.VariantRecord):
+            if (line.sep == self.sep):
+                if self.isHeader(line.fields[0]):
+                    return None
+                return line
+            line = line.text()
         line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
+        if self.isHeader(line):
+            return None
+        return vr.VariantRecord(line, self.sep)
+
+    def lookupKey(self, fields):
+        raise NotImplementedError
+
+    """Reference tables the stage reads
+    """
+    def tables(self):
+        return []
+
+    def recordFields(self, lines):
+        records = []
+        for line in lines:
+            record = self.record(line)
+            if record is not None:
+                records.append(record.fields)
+        return records
+
+    def variantKeys(self, lines):
+        keys = []
+        for fields in self.recordFields(lines):
+            chr, pos = self.lookupKey(fields)
+            keys.append((chr, int(pos)))
+        return bl.uniqueKeys(keys)
+
+    """Statements looked up for one record, tried in order until one
+       returns rows
+    """
+    def lookupStatements(self, fields):
+        return []
+
+    def prefetch(self, lines):
+        pass
+
+    def prefetchConcurrent(self, lines):
+        self.results = self.lookup.run([self.lookupStatements(fields)
+            for fields in self.recordFields(lines)])
+
+    """Rows of a statement, run concurrently by prefetch() if it could be
+    """
+    def query(self, sql):
+        if (self.results is not None) and (sql in self.results):
+            return self.results[sql]
+        self.cursor.execute(sql)
+        return self.cursor.fetchall()
+
+    def queryFirst(self, sql):
+        rows = self.query(sql)
+        if (len(rows) > 0):
+            return rows[0]
+        return None
+
+    """Name of the stage's fragments in a variant cache
+    """
+    def cacheName(self):
+        return type(self).__name__
+
+    def cacheKey(self, fields):
+        return vc.variantKey(fields, self.inds)
+
+    """Take the fragments of a chunk of lines found in the sidecar, the
+       catalog or the cache
+       Returns the lines whose fragments still have to be looked up
+    """
+    def fetchCached(self, lines):
+        if (self.cache is None) and (self.catalog is None) and \
+            (self.sidecar is None):
+            return lines
+
+        keyed = []
+        for line in lines:
+            record = self.record(line)
+            if record is not None:
+                keyed.append((self.cacheKey(record.fields), line))
+        keys = [key for (key, line) in keyed]
+        self.cached = {}
+        self.kept = set()
+        if (self.sidecar is not None):
+            self.cached = self.sidecar.get(self.cacheName(), keys)
+            self.kept = set(self.cached.keys())
+        if (self.catalog is not None):
+            self.cached.update(self.catalog.get(self.cacheName(),
+                [key for key in keys if key not in self.cached]))
+        if (self.cache is not None):
+            self.cached.update(self.cache.get(self.cacheName(),
+                [key for key in keys if key not in self.cached]))
+        self.fresh = {}
+        return [line for (key, line) in keyed if key not in self.cached]
+
+    """Save the fragments looked up for the chunk in the cache, and those
+       of the chunk the sidecar did not have in the sidecar
+    """
+    def storeCached(self):
+        if (self.cache is not None) and (self.cached is not None):
+            self.cache.put(self.cacheName(), self.fresh)
+            self.fresh = {}
+        if (self.sidecar is not None):
+            self.sidecar.flush()
+
+    """Add a fragment the sidecar does not hold yet to it
+    """
+    def keepFragment(self, fields, fragment):
+        key = self.cacheKey(fields)
+        if (key not in self.kept):
+            self.sidecar.add(self.cacheName(), key, fragment)
+            self.kept.add(key)
+
+    def lookupFragment(self, fields):
+        if (self.cached is None):
+            return self.nearFragment(fields)
+
+        key = self.cacheKey(fields)
+        if key not in self.cached:
+            self.cached[key] = self.nearFragment(fields)
+            self.fresh[key] = self.cached[key]
+        return self.cached[key]
+
+    """Span (lo, hi) of positions around pos with the same fragment as
+       pos; by default only pos itself
+    """
+    def span(self, chr, pos):
+        return (pos, pos)
+
+    def nearFragment(self, fields):
+        if self.near is None:
+            return self.fragment(fields)
+
+        chr, pos = self.lookupKey(fields)
+        if not pos.isdigit():
+            return self.fragment(fields)
+        pos = int(pos)
+        if self.near.covers(chr, pos):
+            return self.near.value
+        fragment = self.fragment(fields)
+        self.near.keep(chr, self.span(chr, pos), fragment)
+        return fragment
+
+    def fragment(self, fields):
+        raise NotImplementedError
+
+    def apply(self, record, fragment):
+        raise NotImplementedError
+
+    def annotate(self, line):
+        record = self.record(line)
+        if record is None:
+            return vr.stripLine(line)
+
+        fragment = self.lookupFragment(record.fields)
+        if (self.sidecar is not None):
+            self.keepFragment(record.fields, fragment)
+        return self.apply(record, fragment)
+
+    def close(self):
+        pass
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
 
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+"""
+class DbSnpStage(Stage):
+    def __init__(self, vcf, format='vcf', varclass='SNV', sep='\t',
+        batch=False, index_dir=None):
+
+        self.logcountfile = vcf + '.count.log'
+        self.varclass = varclass
+        self.sep = sep
+        self.batch = batch
+        self.prefetched = None
+        self.inds = getFormatSpecificIndices(format=format)
+        self.var_count = 0
+        self.linenum = 1
+
+        # Lookups go to the memory-mapped index if there is one
+        self.index = None
+        self.conn = None
+        if index_dir is not None:
+            self.index = di.getIndex(index_dir)
+        else:
+            self.conn = u.db_connect()
+            self.cursor = self.conn.cursor()
+
+    def lookupKey(self, fields):
+        chr = fields[self.inds[0]].strip()
+        if chr.startswith("chr"):
+            chr = chr.replace('chr', '')
+        return (chr, fields[self.inds[1]].strip())
+
+    def prefetch(self, lines):
+        if self.batch and (self.index is None):
+            rows, names = bl.equalIn(self.cursor, self.variantKeys(lines),
+                'dbSNP', 'CHR', 'POS', where='INFO = %s AND ',
+                params=[self.varclass])
+            self.prefetched = (rows, names.index('REF'))
+        elif (self.lookup is not None) and (self.index is None):
+            self.prefetchConcurrent(lines)
+
+    def lookupSql(self, chr, pos, fields):
+        ref = clean_mysql_chars(fields[self.inds[2]]).strip()
+        compRef = getComplementary(ref)
+
+        return 'select * from dbSNP where CHR="' + str(chr) + \
+            '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
+            '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
+            self.varclass + '" ;'
+
+    def lookupStatements(self, fields):
+        chr, pos = self.lookupKey(fields)
+        return [self.lookupSql(chr, pos, fields)]
+
+    """(rsID, GMAF) of the dbSNP records matching the variant
+    """
+    def lookupSnps(self, chr, pos, fields):
+        if (self.index is not None):
+            ref = clean_mysql_chars(fields[self.inds[2]]).strip()
+            alleles = [alleleKeys(ref), alleleKeys(getComplementary(ref))]
+            i = binarySearchUniqueAndSorted(self.index.positions(chr),
+                int(pos))
+            if (i < 0):
+                return []
+            return [(rsid, gmaf) for (r, varclass, rsid, gmaf)
+                in self.index.records(chr, i)
+                if (alleleKeys(r) in alleles) and
+                    (varclass == self.varclass)]
+
+        if (self.prefetched is not None):
+            rows, ref_ind = self.prefetched
+            ref = clean_mysql_chars(fields[self.inds[2]]).strip()
+            alleles = [alleleKeys(ref), alleleKeys(getComplementary(ref))]
+            rows = [row for row in rows.get((chr, int(pos)), [])
+                if alleleKeys(row[ref_ind]) in alleles]
+        else:
+            rows = self.query(self.lookupSql(chr, pos, fields))
+
+        return [(str(row[di.RSID_IND]), str(row[di.GMAF_IND])) for row in rows]
 
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+    def tables(self):
+        return ['dbSNP']
 
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
+    def cacheName(self):
+        return type(self).__name__ + '.' + self.varclass
+
+    def fragment(self, fields):
+        chr, pos = self.lookupKey(fields)
+        return self.lookupSnps(chr, pos, fields)
 
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
+    def apply(self, record, snps):
+        varclass = self.varclass
+        self.linenum = self.linenum + 1
 
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+        ## reset rsid to "." - in case there was annotation from old release of dbSNP
+        record.setField(2, '.')
+        rsids = []
+        mafs = []
+        if (len(snps) > 0):
+            for (rsid, gmaf) in snps:
+                rsids.append(rsid)
+                if (gmaf != '.'):
+                    mafs.append('GMAF=' + gmaf)
 
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+            maf_str=''
+            if (len(mafs) > 0):
+                maf_str = ';' + ';'.join([str(x) for x in mafs])
 
+            self.var_count = self.var_count + 1
+            if (record.info() == '.'):
+                record.setInfo('DB' + maf_str)
             else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+                record.appendInfo(';DB;VC=' + varclass + maf_str)
 
-            linenum = linenum + 1
+            record.setField(2, str(';'.join(rsids)))
 
-        else:
-            fh_out.write(line + '\n')
+        return record
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
+    def close(self):
+        ratioInDbSnp = (self.var_count / float(self.linenum)) * 100
+        fh_log = open(self.logcountfile, 'w')
+        fh_log.write("## Please notice that all Isoforms were counted\n")
+        fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+        fh_log.write(f"Total: {str(self.linenum)}\n")
+        fh_log.write(f"In dbSNP: {str(self.var_count)} ({str(ratioInDbSnp)}%)\n")
+        fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        if self.conn is not None:
+            self.conn.close()
+
+
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t', batch=False, index_dir=None):
+
+    stage = DbSnpStage(vcf, format=format, varclass=varclass, sep=sep,
+        batch=batch, index_dir=index_dir)
+    runStage(stage, vcf, vcf + tmpextout)
 
 
 """NOTE: all isoforms are collapsed in one record
@@ -197,308 +549,442 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
     2. chrom_pos_equal_nobase
     3. chrom_pos_unequal
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
+class BigRefGeneStage(Stage):
+    def __init__(self, vcf, format='vcf', sep='\t', use_index=True,
+        batch=False):
+        self.sep = sep
+        self.batch = batch
+        self.prefetched = None
+        self.inds = getFormatSpecificIndices(format=format)
+        self.vcf_linenum = 1
+        self.conn = u.db_connect()
+        self.cursor = self.conn.cursor()
+
+        # The three tables are held in memory unless use_index=False
+        self.indexes = None
+        if use_index:
+            self.indexes = (
+                pi.getIndex(self.cursor, 'chrom_pos_equal_base'),
+                pi.getIndex(self.cursor, 'chrom_pos_equal_nobase'),
+                ii.getIndex(self.cursor, 'chrom_pos_unequal',
+                    chromName='CHR', startName='start', endName='end'))
+
+    def lookupKey(self, fields):
+        chr = fields[self.inds[0]].strip()
+        if chr.startswith("chr"):
+            chr = chr.replace('chr', '')
+        return (chr, fields[self.inds[1]].strip())
+
+    def tables(self):
+        return ['chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+            'chrom_pos_unequal']
+
+    def prefetch(self, lines):
+        if (self.indexes is not None):
+            return
+        if self.batch:
+            keys = self.variantKeys(lines)
+            base = bl.equalIn(self.cursor, keys, 'chrom_pos_equal_base',
+                'CHR', 'start')
+            nobase = bl.equalIn(self.cursor, keys, 'chrom_pos_equal_nobase',
+                'CHR', 'start')
+            unequal = bl.overlapJoin(self.cursor, keys, 'chrom_pos_unequal',
+                chromName='CHR', startName='start', endName='end')
+            self.prefetched = (base, nobase[0], unequal)
+        elif (self.lookup is not None):
+            self.prefetchConcurrent(lines)
+
+    def cascadeSql(self, chr, pos, fields):
+        inds = self.inds
+        ref = clean_mysql_chars(fields[inds[2]]).strip()
+        alt = clean_mysql_chars(fields[inds[3]]).strip()
+
+        compRef = getComplementary(ref)
+        compAlt = getComplementary(alt)
+
+        sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
+            str(chr) + '" AND start = ' + str(pos) + \
+            ' AND ((haplotypeReference="' + str(ref) + \
+            '" AND haplotypeAlternate ="' + str(alt) + \
+            '") OR (haplotypeReference="' + str(compRef) + \
+            '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
+
+        sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
+            str(chr) + '" AND start = ' + str(pos) + ';'
+
+        sql3 = 'select * from chrom_pos_unequal where CHR="' + \
+            str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
+            str(pos) + ' <= end ;'
+
+        return [sql1, sql2, sql3]
+
+    def lookupStatements(self, fields):
+        chr, pos = self.lookupKey(fields)
+        return self.cascadeSql(chr, pos, fields)
+
+    """Candidate rows from the three tables, in the order they are tried
+       The next table is only queried if the previous one had no match
+    """
+    def cascade(self, chr, pos, fields):
+        inds = self.inds
+        if (self.indexes is not None):
+            base, nobase, unequal = self.indexes
             ref = clean_mysql_chars(fields[inds[2]]).strip()
             alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
-
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
-
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
-
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
-
+            alleles = [alleleKeys(ref, alt),
+                alleleKeys(getComplementary(ref), getComplementary(alt))]
+            ref_ind = base.names.index('haplotypeReference')
+            alt_ind = base.names.index('haplotypeAlternate')
+            yield [row for row in base.lookup(chr, pos)
+                if alleleKeys(row[ref_ind], row[alt_ind]) in alleles]
+            yield nobase.lookup(chr, pos)
+            yield unequal.overlap(chr, pos)
+            return
+
+        if (self.prefetched is not None):
+            (base, names), nobase, unequal = self.prefetched
+            key = (chr, int(pos))
+            ref = clean_mysql_chars(fields[inds[2]]).strip()
+            alt = clean_mysql_chars(fields[inds[3]]).strip()
+            alleles = [alleleKeys(ref, alt),
+                alleleKeys(getComplementary(ref), getComplementary(alt))]
+            ref_ind = names.index('haplotypeReference')
+            alt_ind = names.index('haplotypeAlternate')
+            yield [row for row in base.get(key, [])
+                if alleleKeys(row[ref_ind], row[alt_ind]) in alleles]
+            yield nobase.get(key, [])
+            yield unequal.get(key, [])
+            return
+
+        for sql in self.cascadeSql(chr, pos, fields):
+            yield self.query(sql)
+
+    """INFO entries of the rows of the first table in the cascade with a
+       match, None if none has
+    """
+    def fragment(self, fields):
+        chr, pos = self.lookupKey(fields)
+
+        for rows in self.cascade(chr, pos, fields):
             if (len(rows) > 0):
-                keep_going = False
                 m = set([])
                 for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
-
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
+                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+                return ';'.join(m)
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+        return None
 
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
+    def apply(self, record, entries):
+        self.vcf_linenum = self.vcf_linenum + 1
+        if entries is not None:
+            record.appendInfo(';' + entries)
+            if record.info().startswith(".;"):
+                record.setInfo(record.info().replace('.;', '', 1))
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+        return record
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
+    def close(self):
+        self.conn.close()
 
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
 
-            if (keep_going):
-                fh_out.write(line + '\n')
-
-            vcf_linenum = vcf_linenum + 1
-
-        else:
-            fh_out.write(line + '\n')
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t',
+    use_index=True, batch=False):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    stage = BigRefGeneStage(vcf, format=format, sep=sep, use_index=use_index,
+        batch=batch)
+    runStage(stage, vcf + tmpextin, vcf + tmpextout)
 
 
 """Get information about location in gene structures
 """
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
+class GenesStage(Stage):
+    def __init__(self, vcf, format='vcf', table='refGene', promoter_offset=500,
+        sep='\t', use_index=True, batch=False):
+
+        self.logcountfile = vcf + '.count.log'
+        self.table = table
+        self.promoter_offset = promoter_offset
+        self.sep = sep
+        self.batch = batch
+        self.prefetched = None
+        self.inds = getFormatSpecificIndices(format=format)
+
+        self.interGenic_count = 0
+        self.cds_count = 0
+        self.utr3_count = 0
+        self.utr5_count = 0
+        self.intronic_count = 0
+        self.non_coding_intronic_count = 0
+        self.exonic_count = 0
+        self.non_coding_exonic_count = 0
+        self.promoter_count = 0
+
+        self.linenum = 1
+        self.conn = u.db_connect()
+        self.cursor = self.conn.cursor()
+
+        # Transcripts and CpG islands come from in-memory structures
+        # unless use_index=False
+        self.model = None
+        self.islands = None
+        if use_index:
+            self.model = tm.getModel(self.cursor, table)
+            self.islands = ii.getIndex(self.cursor, 'cpgIslandExt',
+                columns=ISLAND_COLUMNS)
+
+    def lookupKey(self, fields):
+        chr = fields[self.inds[0]].strip()
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+        return (chr, fields[self.inds[1]].strip())
+
+    def prefetch(self, lines):
+        if self.batch:
+            keys = self.variantKeys(lines)
+            genes = None
+            if (self.model is None):
+                genes = bl.overlapJoin(self.cursor, keys, self.table,
+                    startName='txStart', endName='txEnd',
+                    offset=self.promoter_offset)
+            islands = None
+            if (self.islands is None):
+                islands = bl.overlapJoin(self.cursor, keys, 'cpgIslandExt',
+                    columns='t.' + ', t.'.join(ISLAND_COLUMNS))
+            self.prefetched = (genes, islands)
+        elif (self.lookup is not None) and \
+            ((self.model is None) or (self.islands is None)):
+            self.prefetchConcurrent(lines)
+
+    """Transcripts first; islands only for the records that have a
+       transcript whose promoter region could contain them
+    """
+    def prefetchConcurrent(self, lines):
+        keys = [self.lookupKey(fields) for fields in self.recordFields(lines)]
+        self.results = {}
+        if (self.model is None):
+            self.results = self.lookup.run([[self.genesSql(chr, pos)]
+                for (chr, pos) in keys])
+
+        if (self.islands is not None):
+            return
+
+        chains = []
+        for (chr, pos) in keys:
+            model, transcripts = self.lookupTranscripts(chr, pos)
+            for t in transcripts:
+                if (int(pos) <= model.txStart[t]) or \
+                    (model.txEnd[t] <= int(pos)):
+                    chains.append([self.islandSql(chr, pos)])
+                    break
+        self.results.update(self.lookup.run(chains))
+
+    def genesSql(self, chr, pos):
+        promoter_offset = self.promoter_offset
+        return 'select * from ' + self.table + ' where chrom="' + \
+            str(chr) + '" AND (txStart - ' + str(promoter_offset) + \
+            ') <= ' + str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
+            str(promoter_offset) +');'
+
+    def islandSql(self, chr, pos):
+        return 'select ' + ', '.join(ISLAND_COLUMNS) + ' from ' + \
+            'cpgIslandExt where chrom="' + str(chr) + \
+            '" AND (chromStart <= ' + str(pos) + \
+            ' AND ' + str(pos) + ' <= chromEnd);'
+
+    def lookupRows(self, chr, pos):
+        if (self.prefetched is not None) and (self.prefetched[0] is not None):
+            return self.prefetched[0].get((chr, int(pos)), [])
+
+        return self.query(self.genesSql(chr, pos))
+
+    """(model, transcript numbers) of the transcripts whose gene region,
+       promoter included, contains the position
+    """
+    def lookupTranscripts(self, chr, pos):
+        if (self.model is not None):
+            return (self.model, self.model.transcripts(chr, int(pos),
+                int(self.promoter_offset)))
+
+        rows = self.lookupRows(chr, pos)
+        return (tm.compileRows(rows), range(len(rows)))
+
+    """CpG island overlapping the position, if any
+       Where islands overlap, the one taken is the first of the index, the
+       join or the query, and SQL does not define which that is, so the
+       paths, and RDS and a snapshot, may pick different ones
+    """
+    def lookupIsland(self, chr, pos):
+        if (self.islands is not None):
+            return self.islands.first(chr, pos)
+        if (self.prefetched is not None):
+            islands = self.prefetched[1].get((chr, int(pos)), [])
+            if (len(islands) > 0):
+                return islands[0]
+            return None
+
+        return self.queryFirst(self.islandSql(chr, pos))
+
+    def tables(self):
+        return [self.table, 'cpgIslandExt']
+
+    def cacheName(self):
+        return type(self).__name__ + '.' + self.table + '.' + \
+            str(self.promoter_offset)
+
+    """[transcripts, entries, exons, promoters] of a variant: how many
+       transcripts' regions contain it, the INFO entries of those it is in
+       an exon or promoter of, and how many exons and promoter regions it
+       was found in
+    """
+    def fragment(self, fields):
+        promoter_offset = self.promoter_offset
+        chr, pos = self.lookupKey(fields)
+
+        model, transcripts = self.lookupTranscripts(chr, pos)
+        info = []
+        exonic = 0
+        promoters = 0
+
+        cnt = 1
+        for t in transcripts:
+            row = model.rows[t]
+            txtStart = model.txStart[t]
+            txtEnd = model.txEnd[t]
+            cdsStart = model.cdsStart[t]
+            cdsEnd = model.cdsEnd[t]
+            exonCount = model.exonCount[t]
+            strand = model.strand[t]
+
+            promoter_plus = txtStart - int(promoter_offset)
+            promoter_minus = txtEnd + int(promoter_offset)
+            region = ""
+            pos = int(pos)
+            exons = []
+
+            if (cdsStart == cdsEnd):
+                for e in model.exonsAt(t, pos):
+                    exnum = e + 1
+                    if (strand == '-'):
+                        exnum = exonCount - e
+                    exons.append("non_coding_exon=" + "ex" + \
+                        str(exnum) + '/' + str(exonCount))
+                if (len(exons) > 0):
+                    region = ";".join(exons)
+            elif (u.isBetween(pos, cdsStart, cdsEnd)):
+                for e in model.exonsAt(t, pos):
+                    exnum = e + 1
+                    if (strand == '-'):
+                        exnum = exonCount - e
+                    exons.append("exon=" +  "ex" + \
+                        str(exnum) + '/' + str(exonCount))
+                    exonic = exonic + 1
+                if (len(exons) > 0):
+                    region = ";".join(exons)
+
+            elif (u.isBetween(pos, promoter_plus, txtStart) and
+                (strand == "+")):
+                island = self.lookupIsland(chr, pos)
+                if (island is not None):
+                    region = 'putativePromoterRegion=' + \
+                        "".join(str(island[3]).split())
+                    promoters = promoters + 1
+
+            elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
+                island = self.lookupIsland(chr, pos)
+                if (island is not None):
+                    region = 'putativePromoterRegion=' +  \
+                        "".join(str(island[3]).split())
+                    promoters = promoters + 1
 
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
+            else:
+                region = ''
 
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
+            if (region != ''):
+                info.append(collapseGeneNames(row=row,
+                    indices=indicesKnownGenes, region=region, cnt=cnt))
 
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+            cnt = cnt + 1
 
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
+        return [len(transcripts), info, exonic, promoters]
 
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
+    def apply(self, record, fragment):
+        transcripts, info, exonic, promoters = fragment
+        self.linenum = self.linenum + 1
 
-                        rows = cursor.fetchone()
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
+        if (transcripts == 0):
+            record.appendInfo(";positionType=interGenic")
+            self.interGenic_count = self.interGenic_count + 1
+            return record
 
-                    else:
-                        region = ''
+        #count location, once per transcript
+        positionType = clean_mysql_chars(record.infoValue('positionType'))
 
-                    if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
+        if (positionType == 'intron'):
+            self.intronic_count = self.intronic_count + transcripts
+        elif (positionType == 'non_coding_intron'):
+            self.non_coding_intronic_count = \
+                self.non_coding_intronic_count + transcripts
+        elif (positionType == 'CDS'):
+            self.cds_count = self.cds_count + transcripts
+        elif (positionType == 'non_coding_exon'):
+            self.non_coding_exonic_count = \
+                self.non_coding_exonic_count + transcripts
+        elif (positionType == 'utr5'):
+            self.utr5_count = self.utr5_count + transcripts
+        elif (positionType == 'utr3'):
+            self.utr3_count = self.utr3_count + transcripts
+        self.exonic_count = self.exonic_count + exonic
+        self.promoter_count = self.promoter_count + promoters
 
-                    cnt = cnt + 1
+        str_info = ";".join(info)
+        record.appendInfo(';' + str_info)
+        return record
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+    def close(self):
+        fh_log = open(self.logcountfile, 'a')
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
+        print("Variants located:")
+        fh_log.write("Variants located:\n")
 
-            linenum = linenum + 1
+        print(f"In interGenic {str(self.interGenic_count)}")
+        fh_log.write(f"In interGenic {str(self.interGenic_count)}\n")
 
-        else:
-            fh_out.write(line + '\n')
+        print(f"In CDS {str(self.cds_count)}")
+        fh_log.write(f"In CDS {str(self.cds_count)}\n")
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+        print(f"In \'3 UTR {str(self.utr3_count)}")
+        fh_log.write(f"In \'3 UTR {str(self.utr3_count)}\n")
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+        print(f"In \'5 UTR {str(self.utr5_count)}")
+        fh_log.write(f"In \'5 UTR {str(self.utr5_count)}\n")
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+        print(f"In Intronic {str(self.intronic_count)}")
+        fh_log.write(f"In Intronic {str(self.intronic_count)}\n")
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+        print(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}")
+        fh_log.write(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}\n")
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+        print(f"In Exonic {str(self.exonic_count)}")
+        fh_log.write(f"In Exonic {str(self.exonic_count)}\n")
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+        print(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}")
+        fh_log.write(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}\n")
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+        print(f"In Putative Promoter Region {str(self.promoter_count)}")
+        fh_log.write(f"In Putative Promoter Region {str(self.promoter_count)}\n")
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+        fh_log.close()
+        self.conn.close()
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
+    tmpextin='.2', tmpextout='.3', sep='\t', use_index=True, batch=False):
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+    stage = GenesStage(vcf, format=format, table=table,
+        promoter_offset=promoter_offset, sep=sep, use_index=use_index,
+        batch=batch)
+    runStage(stage, vcf + tmpextin, vcf + tmpextout)
 
 
 """Method used in INDELS, where bigRefGeneTable is not applicable
@@ -712,418 +1198,410 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
     conn.close()
 
 
-"""Overlap with tfbsConsSites
+"""Common plumbing for the stages that annotate a record with the
+   reference rows overlapping its position
+   Subclasses implement fragment() for data lines; header lines are
+   passed through unchanged. Rows come from the in-memory interval
+   index (use_index=True), from a chunked join (batch=True) or from one
+   query per variant. With numpy installed, the interval index is
+   searched for a whole chunk of records at once (overlap_engine.py).
+   With sweep=True no index is built; coordinate-sorted input is joined
+   against the table streamed in start order (sweep_join.py), falling
+   back to the other lookups if the input turns out to be unsorted.
+   The rows, and so the fragment, of a position stay the same over the
+   span between the interval bounds around it, which the in-memory
+   indexes give; a locality cache answers neighbouring positions inside
+   it, and repeated positions with any other source of rows
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+class OverlapStage(Stage):
+    chromName = 'chrom'
+    startName = 'chromStart'
+    endName = 'chromEnd'
+    vectorized = True
+
+    def __init__(self, vcf, format='vcf', table=None, sep='\t',
+        use_index=True, batch=False, sweep=False):
+
+        self.logcountfile = vcf + '.count.log'
+        self.table = table
+        self.label = table
+        self.sep = sep
+        self.batch = batch
+        self.prefetched = None
+        self.inds = getFormatSpecificIndices(format=format)
+        self.var_count = 0
+        self.line_count = 0
+        self.near = lc.LocalityCache()
+
+        self.conn = u.db_connect()
+        self.cursor = self.conn.cursor()
+        self.index = None
+        self.sweep = None
+        if sweep:
+            self.sweep = self.getSweep()
+        elif use_index:
+            self.index = self.getIndex()
+
+    def getIndex(self):
+        return ii.getIndex(self.cursor, self.table, chromName=self.chromName,
+            startName=self.startName, endName=self.endName)
+
+    def getSweep(self):
+        return sj.SweepJoin(lambda chr: self.table, self.chromName,
+            self.startName, self.endName)
+
+    def isHeader(self, line):
+        ## not comments, header line
+        return (line.startswith("##") or line.startswith('CHROM') or
+            line.startswith('#CHROM'))
+
+    def lookupKey(self, fields):
+        chr = fields[self.inds[0]].strip()
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+        return (chr, fields[self.inds[1]].strip())
+
+    def lookupSql(self, chr, pos):
+        return 'select * from ' + self.table + ' where ' + self.chromName + \
+            '="' + str(chr) + '" AND (' + self.startName + ' <= ' + \
+            str(pos) + ' AND ' + str(pos) + ' <= ' + self.endName + ');'
+
+    def batchLookup(self, keys):
+        return bl.overlapJoin(self.cursor, keys, self.table,
+            chromName=self.chromName, startName=self.startName,
+            endName=self.endName)
+
+    def lookupStatements(self, fields):
+        chr, pos = self.lookupKey(fields)
+        return [self.lookupSql(chr, pos)]
+
+    def prefetch(self, lines):
+        if (self.sweep is not None):
+            self.prefetched = self.sweep.join(self.variantKeys(lines))
+            if (self.prefetched is not None):
+                return
+        if self.vectorized and isinstance(self.index, ii.IntervalIndex) and \
+            ve.available():
+            self.prefetched = ve.getIndex(self.index).lookupBlock(
+                self.variantKeys(lines))
+        elif self.batch and (self.index is None):
+            self.prefetched = self.batchLookup(self.variantKeys(lines))
+        elif (self.lookup is not None) and (self.index is None):
+            self.prefetchConcurrent(lines)
+
+    def lookupRows(self, chr, pos):
+        if (self.prefetched is not None):
+            return self.prefetched.get((chr, int(pos)), [])
+        if (self.index is not None):
+            return self.index.overlap(chr, pos)
+
+        return self.query(self.lookupSql(chr, pos))
+
+    def lookupFirst(self, chr, pos):
+        if (self.index is None) and (self.prefetched is None):
+            return self.queryFirst(self.lookupSql(chr, pos))
+
+        rows = self.lookupRows(chr, pos)
+        if (len(rows) > 0):
+            return rows[0]
+        return None
+
+    def tables(self):
+        return [self.table]
+
+    def cacheName(self):
+        return type(self).__name__ + '.' + str(self.table)
+
+    def span(self, chr, pos):
+        if isinstance(self.index, (ii.IntervalIndex, cm.CoverageMask,
+            tm.TranscriptModel)):
+            return self.index.span(chr, pos)
+        return (pos, pos)
+
+    """(hits, INFO entry) of the rows overlapping a variant, None if no
+       row does
+    """
+    def fragment(self, fields):
+        raise NotImplementedError
+
+    def apply(self, record, fragment):
+        if fragment is not None:
+            hits, entry = fragment
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + hits
+            record.addInfo(entry)
+        return record
+
+    def close(self):
+        fh_log = open(self.logcountfile, 'a')
+        fh_log.write(f"In {str(self.label)}: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n")
+        fh_log.close()
+        if (self.near.lookups > 0):
+            print(self.near.report(self.label))
+
+        if (self.sweep is not None):
+            self.sweep.close()
+        self.conn.close()
 
+
+"""Overlap with tfbsConsSites
+   index_dir is a directory built by tfbs_index.py; when given, the
+   regions come from its memory-mapped per-chromosome files instead of
+   the database
+"""
+class TfbsConsSitesStage(OverlapStage):
     allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
         '14','15','16','17','18','19','20','21','22','X','Y']
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
-
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
-
+    def __init__(self, vcf, format='vcf', table='tfbsConsSites', sep='\t',
+        batch=False, index_dir=None, sweep=False):
+        super().__init__(vcf, format=format, table=table, sep=sep,
+            use_index=False, batch=batch, sweep=sweep)
+        if index_dir is not None:
+            self.index = ti.getIndex(index_dir)
+
+    def lookupSql(self, chr, pos):
+        # For some reason this table has no "chr" preceeding number
+        return 'select chrom, chromStart, chromEnd, name ' + \
+            'from tfbsConsSites' + chr.replace('chr', '') + \
+            ' where  chromStart <= ' + str(pos) + ' AND ' + \
+            str(pos) + ' <= chromEnd;'
+
+    def lookupStatements(self, fields):
+        chr, pos = self.lookupKey(fields)
+        if (chr.replace('chr', '') not in self.allowed_chrom):
+            return []
+        return [self.lookupSql(chr, pos)]
+
+    def sweepTable(self, chr):
+        chrIndex = chr.replace('chr', '')
+        if (chrIndex not in self.allowed_chrom):
+            return None
+        return 'tfbsConsSites' + chrIndex
+
+    def tables(self):
+        return ['tfbsConsSites' + c for c in self.allowed_chrom]
+
+    def getSweep(self):
+        # one table per chromosome, read whole
+        return sj.SweepJoin(self.sweepTable, None, 'chromStart', 'chromEnd',
+            columns=['chrom', 'chromStart', 'chromEnd', 'name'])
+
+    def batchLookup(self, keys):
+        bychrom = {}
+        for (chr, pos) in keys:
+            chrIndex = chr.replace('chr', '')
+            if (chrIndex in self.allowed_chrom):
+                bychrom.setdefault(chrIndex, []).append((chr, pos))
+
+        rows = {}
+        for chrIndex, chromkeys in bychrom.items():
+            rows.update(bl.overlapJoin(self.cursor, chromkeys,
+                'tfbsConsSites' + chrIndex, chromName=None,
+                columns='t.chrom, t.chromStart, t.chromEnd, t.name'))
+        return rows
+
+    def fragment(self, fields):
+        chr, pos = self.lookupKey(fields)
+        chrIndex=chr.replace('chr', '')
+
+        if (chrIndex not in self.allowed_chrom): # chrom is not on the list
+            return None
+
+        if (self.index is not None):
+            regions = self.index.regions(chrIndex, pos)
         else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
+            regions = [ti.region(row) for row in self.lookupRows(chr, pos)]
+        records = []
 
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
-
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
+        if (len(regions) == 0):
+            return None
 
-                    fh_out.write('\t'.join(fields) + '\n')
+        for t in regions:
+            records.append('tfbsRegion' + '=' + t)
+        return [len(regions), ';'.join(records)]
 
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
 
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
+    def close(self):
+        if (self.index is not None):
+            self.index.release()
+        super().close()
 
-        linenum = linenum + 1
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
+    tmpextin='.2', tmpextout='.3', sep='\t', batch=False, index_dir=None,
+    sweep=False):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    stage = TfbsConsSitesStage(vcf, format=format, table=table, sep=sep,
+        batch=batch, index_dir=index_dir, sweep=sweep)
+    runStage(stage, vcf + tmpextin, vcf + tmpextout)
 
 
 """Overlap with GadAll table
 """
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
-    tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class GadAllStage(OverlapStage):
+    chromName = 'chromosome'
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def __init__(self, vcf, format='vcf', table='gadAll', sep='\t',
+        use_index=True, batch=False, sweep=False):
+        super().__init__(vcf, format=format, table=table, sep=sep,
+            use_index=use_index, batch=batch, sweep=sweep)
 
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def lookupKey(self, fields):
+        chr = fields[self.inds[0]].strip()
+        # For some reason this table has no "chr" preceeding number
+        if chr.startswith("chr"):
+            chr = str(chr).replace("chr", "")
+        return (chr, fields[self.inds[1]].strip())
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def fragment(self, fields):
+        chr, pos = self.lookupKey(fields)
+        rows = self.lookupRows(chr, pos)
+        records = []
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+        if (len(rows) == 0):
+            return None
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        r_tmp = []
+        for row in rows:
+            if not fu.isOnTheList(r_tmp, str(row[3])):
+                r_tmp.append(str(row[3]) )
+                records.append(str(self.table) + '=' + str(row[3]))
+        return [len(rows), ';'.join(records)]
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    def apply(self, record, fragment):
+        super().apply(record, fragment)
+        if fragment is not None:
+            record.setSeparator('\t ')
+        return record
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
+    tmpextout='.1', sep='\t', use_index=True, batch=False, sweep=False):
+
+    stage = GadAllStage(vcf, format=format, table=table, sep=sep,
+        use_index=use_index, batch=batch, sweep=sweep)
+    runStage(stage, vcf + tmpextin, vcf + tmpextout)
 
 
 """ Overlap with gwasCatalog table """
-def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class GwasCatalogStage(OverlapStage):
+    startName = 'chromEnd'
+    endName = 'chromEnd'
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def __init__(self, vcf, format='vcf', table='gwasCatalog', sep='\t',
+        use_index=True, batch=False, sweep=False):
+        super().__init__(vcf, format=format, table=table, sep=sep,
+            use_index=use_index, batch=batch, sweep=sweep)
 
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def lookupSql(self, chr, pos):
+        return 'select * from ' + self.table + ' where chrom="' + \
+            str(chr) + '" AND chromEnd = ' + str(pos) + ';'
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def fragment(self, fields):
+        chr, pos = self.lookupKey(fields)
+        rows = self.lookupRows(chr, pos)
+        records = []
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+        if (len(rows) == 0):
+            return None
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        for row in rows:
+            records.append(str(self.table) + '=' + str('pubMedID') + \
+                '=' + str(row[5]) + ',trait=' + str(row[10]))
+        return [len(rows), ';'.join(records)]
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
+    tmpextin='', tmpextout='.1', sep='\t', use_index=True, batch=False,
+    sweep=False):
+
+    stage = GwasCatalogStage(vcf, format=format, table=table, sep=sep,
+        use_index=use_index, batch=batch, sweep=sweep)
+    runStage(stage, vcf + tmpextin, vcf + tmpextout)
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class HUGOGeneNomenclatureStage(OverlapStage):
+    def __init__(self, vcf, format='vcf', table='hugo', sep='\t',
+        use_index=True, batch=False, sweep=False):
+        super().__init__(vcf, format=format, table=table, sep=sep,
+            use_index=use_index, batch=batch, sweep=sweep)
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def fragment(self, fields):
+        chr, pos = self.lookupKey(fields)
+        rows = self.lookupRows(chr, pos)
+        records = []
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+        if (len(rows) == 0):
+            return None
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+        r_tmp = []
+        for row in rows:
+            t = str(str(row[5]) + ',' + str(row[6])).strip()
+            if not fu.isOnTheList(r_tmp, t):
+                r_tmp.append(t)
+                records.append('HGNC_GeneAnnotation' + '=' + t)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
-
-                    records_str = ','.join(records).replace(';', ',')
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+        records_str = ','.join(records).replace(';', ',')
+        return [len(rows), records_str]
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
+    tmpextin='', tmpextout='.1', sep='\t', use_index=True, batch=False,
+    sweep=False):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    stage = HUGOGeneNomenclatureStage(vcf, format=format, table=table,
+        sep=sep, use_index=use_index, batch=batch, sweep=sweep)
+    runStage(stage, vcf + tmpextin, vcf + tmpextout)
 
 
 """Overlap with segdup regions genomicSuperDups
 """
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
-    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
-
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-"""Searches Genes Databases and returns Genes/Cytobands 
+class GenomicSuperDupsStage(OverlapStage):
+    def __init__(self, vcf, format='vcf', table='genomicSuperDups', sep='\t',
+        use_index=True, batch=False, sweep=False):
+        super().__init__(vcf, format=format, table=table, sep=sep,
+            use_index=use_index, batch=batch, sweep=sweep)
+
+    def fragment(self, fields):
+        chr, pos = self.lookupKey(fields)
+        rows = self.lookupFirst(chr, pos)
+
+        if rows is not None:
+            isOverlap = True
+            otherChrom = rows[7]
+            otherStart = rows[8]
+            otherEnd = rows[9]
+            return [1, str(self.table) + '=' + \
+                str(isOverlap) + ';' + 'otherChrom=' + \
+                str(otherChrom) + ';otherStart=' + \
+                str(otherStart) + ';otherEnd=' + str(otherEnd)]
+        return None
+
+    def apply(self, record, fragment):
+        if fragment is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            record.appendInfo(';' + fragment[1])
+        return record
+
+
+def addOverlapWithGenomicSuperDups(vcf, format='vcf',
+    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t',
+    use_index=True, batch=False, sweep=False):
+
+    stage = GenomicSuperDupsStage(vcf, format=format, table=table, sep=sep,
+        use_index=use_index, batch=batch, sweep=sweep)
+    runStage(stage, vcf + tmpextin, vcf + tmpextout)
+
+
+"""Searches Genes Databases and returns Genes/Cytobands
    with which SNP or INDEL overlaps
 """
-def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+class RefGeneStage(OverlapStage):
     colindex = 1
     colindex2 = 12
     name = 'name'
@@ -1131,273 +1609,211 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     startName = 'txStart'
     endName = 'txEnd'
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def __init__(self, vcf, format='vcf', table='refGene', sep='\t',
+        use_index=True, batch=False, sweep=False):
+        super().__init__(vcf, format=format, table=table, sep=sep,
+            use_index=use_index, batch=batch, sweep=sweep)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(name2 + '=' + \
-                            str(row[colindex2]) + ';' + name + '=' + \
-                            str(row[colindex]))
-
-                    genes = ';'.join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ';' + str(genes)
-                fh_out.write('\t'.join(fields) + '\n')
+    def getIndex(self):
+        # the transcript model getGenes uses
+        return tm.getModel(self.cursor, self.table)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    def fragment(self, fields):
+        chr, pos = self.lookupKey(fields)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        overlapsWith = []
+        rows = self.lookupRows(chr, pos)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        if (len(rows) > 0):
+            for row in rows:
+                overlapsWith.append(self.name2 + '=' + \
+                    str(row[self.colindex2]) + ';' + self.name + '=' + \
+                    str(row[self.colindex]))
+
+            genes = ';'.join([str(x) for x in overlapsWith])
+            return [len(rows), str(genes)]
+        return None
+
+
+def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
+    tmpextin='', tmpextout='.1', sep='\t', use_index=True, batch=False,
+    sweep=False):
+
+    stage = RefGeneStage(vcf, format=format, table=table, sep=sep,
+        use_index=use_index, batch=batch, sweep=sweep)
+    runStage(stage, vcf + tmpextin, vcf + tmpextout)
 
 
 """Method to find overlap with Cytoband table
 """
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+class CytobandStage(OverlapStage):
+    def __init__(self, vcf, format='vcf', table='cytoBand', sep='\t',
+        use_index=True, batch=False, sweep=False):
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = 'txStart'
-    endName = 'txEnd'
+        self.colindex = 12
+        self.startName = 'txStart'
+        self.endName = 'txEnd'
 
-    if (table == 'cytoBand'):
-        colindex = 3
-        startName = 'chromStart'
-        endName = 'chromEnd'
+        if (table == 'cytoBand'):
+            self.colindex = 3
+            self.startName = 'chromStart'
+            self.endName = 'chromEnd'
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+        super().__init__(vcf, format=format, table=table, sep=sep,
+            use_index=use_index, batch=batch, sweep=sweep)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
+    def fragment(self, fields):
+        chr, pos = self.lookupKey(fields)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        overlapsWith = []
+        rows = self.lookupRows(chr, pos)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        if (len(rows) > 0):
+            for row in rows:
+                overlapsWith.append(str(row[self.colindex]))
+            overlapsWith = u.dedup(overlapsWith)
+            cytoband = ';'.join([str(x) for x in overlapsWith])
+            return [len(rows), str(self.table) + '=' + str(cytoband)]
+        return None
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
+    tmpextin='', tmpextout='.1', sep='\t', use_index=True, batch=False,
+    sweep=False):
+
+    stage = CytobandStage(vcf, format=format, table=table, sep=sep,
+        use_index=use_index, batch=batch, sweep=sweep)
+    runStage(stage, vcf + tmpextin, vcf + tmpextout)
 
 
 """Method to find overlap with CNV tables
+   Only whether a position is covered matters, so the index is the
+   table's merged coverage mask rather than an interval index
 """
-def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class CnvDatabaseStage(OverlapStage):
+    def __init__(self, vcf, format='vcf', table='dgv_Cnv', sep='\t',
+        use_index=True, batch=False, sweep=False):
+        super().__init__(vcf, format=format, table=table, sep=sep,
+            use_index=use_index, batch=batch, sweep=sweep)
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def getIndex(self):
+        return cm.getMask(self.cursor, self.table, chromName=self.chromName,
+            startName=self.startName, endName=self.endName)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def overlaps(self, chr, pos):
+        if (self.index is not None):
+            return self.index.covers(chr, pos)
+        return (self.lookupFirst(chr, pos) is not None)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def fragment(self, fields):
+        chr, pos = self.lookupKey(fields)
+        return self.coverage(chr, pos)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
+    def coverage(self, chr, pos):
+        if self.overlaps(chr, pos):
+            isOverlap = True
+            return [1, str(self.table) + '=' + str(isOverlap)]
+        return None
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
+    tmpextin='', tmpextout='.1', sep='\t', use_index=True, batch=False,
+    sweep=False):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    stage = CnvDatabaseStage(vcf, format=format, table=table, sep=sep,
+        use_index=use_index, batch=batch, sweep=sweep)
+    runStage(stage, vcf + tmpextin, vcf + tmpextout)
 
 
-"""Method to find overlap with targetScanS tables
+"""All the CNV tables in one pass
+   Each record is split once and checked against every table in turn
+   (one bisect per table with the masks); the flags and .count.log lines
+   come out exactly as from one CnvDatabaseStage per table
 """
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class CnvDatabasesStage(Stage):
+    def __init__(self, vcf, format='vcf', tables=CNV_TABLES, sep='\t',
+        use_index=True, batch=False, sweep=False):
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+        self.sep = sep
+        self.stages = [CnvDatabaseStage(vcf, format=format, table=table,
+            sep=sep, use_index=use_index, batch=batch, sweep=sweep)
+            for table in tables]
+        self.inds = self.stages[0].inds
+        self.near = lc.LocalityCache()
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def isHeader(self, line):
+        return self.stages[0].isHeader(line)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def prefetch(self, lines):
+        for stage in self.stages:
+            stage.lookup = self.lookup
+            stage.prefetch(lines)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
+    def tables(self):
+        return [stage.table for stage in self.stages]
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    def cacheName(self):
+        return type(self).__name__ + '.' + '.'.join([stage.table
+            for stage in self.stages])
 
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    def lookupKey(self, fields):
+        return self.stages[0].lookupKey(fields)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    def span(self, chr, pos):
+        return lc.intersect([stage.span(chr, pos) for stage in self.stages])
+
+    def fragment(self, fields):
+        chr, pos = self.lookupKey(fields)
+        return [stage.coverage(chr, pos) for stage in self.stages]
+
+    def apply(self, record, fragment):
+        for (stage, coverage) in zip(self.stages, fragment):
+            stage.apply(record, coverage)
+        return record
 
-### EOF
\ No newline at end of file
+    def close(self):
+        for stage in self.stages:
+            stage.close()
+        if (self.near.lookups > 0):
+            print(self.near.report('CNV databases'))
+
+
+def addOverlapWithCnvDatabases(vcf, format='vcf', tables=CNV_TABLES,
+    tmpextin='', tmpextout='.1', sep='\t', use_index=True, batch=False,
+    sweep=False):
+
+    stage = CnvDatabasesStage(vcf, format=format, tables=tables, sep=sep,
+        use_index=use_index, batch=batch, sweep=sweep)
+    runStage(stage, vcf + tmpextin, vcf + tmpextout)
+
+
+"""Method to find overlap with targetScanS tables
+"""
+class MiRNAStage(OverlapStage):
+    def __init__(self, vcf, format='vcf', table='targetScanS', sep='\t',
+        use_index=True, batch=False, sweep=False):
+        super().__init__(vcf, format=format, table=table, sep=sep,
+            use_index=use_index, batch=batch, sweep=sweep)
+        self.label = 'miRNAsites'
+
+    def fragment(self, fields):
+        chr, pos = self.lookupKey(fields)
+        rows = self.lookupFirst(chr, pos)
+
+        if rows is not None:
+            t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
+                str(rows[2]) + '_' + str(rows[3])
+            t = 'miRNAsites=' + t.strip()
+            return [1, t]
+        return None
+
+
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
+    tmpextin='', tmpextout='.1', sep='\t', use_index=True, batch=False,
+    sweep=False):
+
+    stage = MiRNAStage(vcf, format=format, table=table, sep=sep,
+        use_index=use_index, batch=batch, sweep=sweep)
+    runStage(stage, vcf + tmpextin, vcf + tmpextout)
+
+### EOF
@@ -0,0 +1,342 @@
+# annotation_catalog.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Precomputed annotation catalog of the known dbSNP sites
+#
+# Build once per reference release with:
+#   python annotation_catalog.py <catalog_directory> [<reference_version>]
+#
+# Every (CHR, POS, REF, ALT allele) of the dbSNP table is written to a
+# sorted sites file and run through the driver's stages, and what each
+# stage adds for a site is kept. The reference version defaults to that
+# of the snapshot in use.
+#
+# Layout of <catalog_directory>:
+#   meta.json               reference version, stage names, record counts
+#   <chrom>/key.bin         sorted packed keys, position in the high 32
+#                           bits and crc32 of "REF\tALT" in the low 32
+#                           (uint64, native byte order)
+#   <chrom>/alleles.idx     record offsets into alleles.dat (uint64, n + 1)
+#   <chrom>/alleles.dat     utf-8 "REF\tALT" of each record
+#   <chrom>/fragments.idx   record offsets into fragments.dat
+#   <chrom>/fragments.dat   JSON list of the stages' fragments, in the
+#                           order of the stage names
+#
+# At job time the stages take the fragments of catalog sites from the
+# memory-mapped files, so only novel variants are looked up.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import shutil
+import time
+import zlib
+from array import array
+from bisect import bisect_left
+
+import pymysql
+
+import annotate as ann
+import dbsnp_index as di
+import utils as u
+
+STRING_COLUMNS = ['alleles', 'fragments']
+
+SITES_HEADER = '##fileformat=VCFv4.1\n' + \
+    '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+
+"""Packed key of a site on its chromosome
+"""
+def packKey(pos, alleles):
+    return (int(pos) << 32) | zlib.crc32(alleles.encode('utf-8'))
+
+
+"""Write every distinct (CHR, POS, REF, ALT allele) of the dbSNP table to
+   a sites-only VCF, in (CHR, POS) order
+   Returns the number of sites
+"""
+def exportSites(conn, sitesfile, table='dbSNP', chunk=100000):
+    cursor = conn.cursor()
+    cursor.execute('select distinct CHR from ' + table + ';')
+    chroms = sorted([str(row[0]) for row in cursor.fetchall()])
+    cursor.close()
+
+    count = 0
+    with open(sitesfile, 'w') as fh:
+        fh.write(SITES_HEADER)
+        for chrom in chroms:
+            cursor = conn.cursor(pymysql.cursors.SSCursor)
+            cursor.execute('select POS, REF, ALT from ' + table + \
+                ' where CHR = %s order by POS;', (chrom,))
+            last = None
+            seen = set()
+            rows = cursor.fetchmany(chunk)
+            while (len(rows) > 0):
+                for (pos, ref, alts) in rows:
+                    if (pos != last):
+                        last = pos
+                        seen = set()
+                    for alt in str(alts).split(','):
+                        site = (str(ref).strip(), alt.strip())
+                        if (len(site[1]) == 0) or (site in seen):
+                            continue
+                        seen.add(site)
+                        fh.write(chrom + '\t' + str(pos) + '\t.\t' + \
+                            site[0] + '\t' + site[1] + '\t.\t.\t.\n')
+                        count = count + 1
+                rows = cursor.fetchmany(chunk)
+            cursor.close()
+    return count
+
+
+"""Collects the fragments the stages store for the sites of a sorted
+   sites file and writes them to a catalog directory
+   It stands in for a variant_cache.VariantCache: it has nothing cached,
+   and a site is written once every stage has stored its fragment
+"""
+class CatalogWriter(object):
+    def __init__(self, directory, version, names):
+        self.directory = directory
+        self.tmpdir = directory.rstrip('/') + '.tmp'
+        self.version = str(version)
+        self.names = names
+        self.pending = {}
+        self.counts = {}
+        self.chrom = None
+        self.pos = None
+        self.group = []
+        self.keys = None
+        self.columns = None
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+        os.makedirs(self.tmpdir)
+
+    def get(self, name, keys):
+        return {}
+
+    def put(self, name, fragments):
+        for (key, fragment) in fragments.items():
+            entry = self.pending.setdefault(key, {})
+            entry[name] = fragment
+            if (len(entry) == len(self.names)):
+                del self.pending[key]
+                self.add(key, [entry[n] for n in self.names])
+
+    def add(self, key, fragments):
+        chrom, pos, ref, alt = key.split('\t')
+        pos = int(pos)
+        if (chrom != self.chrom):
+            self.closeChromosome()
+            self.openChromosome(chrom)
+        elif (pos < self.pos):
+            raise ValueError(f"Sites are not sorted at {chrom}:{str(pos)}")
+        if (pos != self.pos):
+            self.flush()
+            self.pos = pos
+        alleles = ref + '\t' + alt
+        self.group.append((packKey(pos, alleles), alleles,
+            json.dumps(fragments)))
+
+    def openChromosome(self, chrom):
+        if chrom in self.counts:
+            raise ValueError(f"Sites of {chrom} are not together")
+        chromdir = os.path.join(self.tmpdir, chrom)
+        os.makedirs(chromdir)
+        self.chrom = chrom
+        self.pos = None
+        self.counts[chrom] = 0
+        self.keys = open(os.path.join(chromdir, 'key.bin'), 'wb')
+        self.columns = dict([(col,
+            di.StringColumnWriter(os.path.join(chromdir, col)))
+            for col in STRING_COLUMNS])
+
+    """Write the sites of one position, in key order
+    """
+    def flush(self):
+        self.group.sort()
+        keys = array('Q')
+        for (key, alleles, fragments) in self.group:
+            keys.append(key)
+            self.columns['alleles'].append(alleles)
+            self.columns['fragments'].append(fragments)
+        keys.tofile(self.keys)
+        for col in self.columns.values():
+            col.flush()
+        self.counts[self.chrom] = self.counts[self.chrom] + len(self.group)
+        self.group = []
+
+    def closeChromosome(self):
+        if (self.chrom is None):
+            return
+        self.flush()
+        self.keys.close()
+        for col in self.columns.values():
+            col.close()
+        print(f"{self.chrom}: {str(self.counts[self.chrom])} sites")
+
+    def report(self):
+        return []
+
+    def close(self):
+        self.closeChromosome()
+        if (len(self.pending) > 0):
+            print(f"{str(len(self.pending))} sites missed a stage, left out")
+        meta = {'version': self.version, 'built': int(time.time()),
+            'names': self.names, 'chroms': self.counts}
+        with open(os.path.join(self.tmpdir, 'meta.json'), 'w') as fh:
+            json.dump(meta, fh, indent=2)
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.rename(self.tmpdir, self.directory)
+
+
+"""Export the dbSNP sites and run them through the stages makeStages
+   returns for the sites file into a catalog directory
+"""
+def buildCatalog(conn, directory, version, makeStages):
+    sitesfile = directory.rstrip('/') + '.sites.vcf'
+    count = exportSites(conn, sitesfile)
+    print(f"Exported {str(count)} sites")
+
+    stages = makeStages(sitesfile)
+    writer = CatalogWriter(directory, version,
+        [stage.cacheName() for stage in stages])
+    for stage in stages:
+        stage.cache = writer
+    ann.runStages(stages, sitesfile, sitesfile + '.annot')
+    writer.close()
+
+    for name in [sitesfile, sitesfile + '.annot', sitesfile + '.count.log']:
+        if os.path.exists(name):
+            os.remove(name)
+
+
+"""The mapped files of one chromosome
+"""
+class ChromosomeCatalog(object):
+    def __init__(self, chromdir):
+        self.keys = di.mapArray(os.path.join(chromdir, 'key.bin'), 'Q')
+        self.columns = {}
+        for col in STRING_COLUMNS:
+            path = os.path.join(chromdir, col)
+            self.columns[col] = (di.mapArray(path + '.idx', 'Q'),
+                di.mapArray(path + '.dat', 'B'))
+
+    def value(self, col, i):
+        idx, dat = self.columns[col]
+        return bytes(dat[idx[i]:idx[i + 1]]).decode('utf-8')
+
+
+"""Read-only view of a catalog directory
+   get() answers a stage like variant_cache.VariantCache.get(); the
+   fragments of the sites asked for last are kept decoded, as every stage
+   asks for the same chunk of sites in turn
+"""
+class AnnotationCatalog(object):
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as fh:
+            meta = json.load(fh)
+        self.version = meta['version']
+        self.names = meta['names']
+        self.counts = meta['chroms']
+        self.chroms = {}
+        self.recent = {}
+        self.hits = 0
+        self.lookups = 0
+
+    def chromosome(self, chrom):
+        if chrom not in self.counts:
+            return None
+        if chrom not in self.chroms:
+            self.chroms[chrom] = ChromosomeCatalog(
+                os.path.join(self.directory, chrom))
+        return self.chroms[chrom]
+
+    """Fragments of every stage for a variant key, None if the variant is
+       not in the catalog
+    """
+    def find(self, key):
+        chrom, pos, ref, alt = key.split('\t')
+        index = self.chromosome(chrom)
+        if (index is None) or not pos.isdigit():
+            return None
+        alleles = ref + '\t' + alt
+        packed = packKey(pos, alleles)
+        i = bisect_left(index.keys, packed)
+        while (i < len(index.keys)) and (index.keys[i] == packed):
+            if (index.value('alleles', i) == alleles):
+                return json.loads(index.value('fragments', i))
+            i = i + 1
+        return None
+
+    """Fragments of a stage found for keys, {key: fragment}
+    """
+    def get(self, name, keys):
+        if name not in self.names:
+            return {}
+        j = self.names.index(name)
+        entries = {}
+        found = {}
+        for key in keys:
+            if key in entries:
+                entry = entries[key]
+            elif key in self.recent:
+                entry = self.recent[key]
+            else:
+                entry = self.find(key)
+                self.lookups = self.lookups + 1
+                if entry is not None:
+                    self.hits = self.hits + 1
+            entries[key] = entry
+            if entry is not None:
+                found[key] = entry[j]
+        self.recent = entries
+        return found
+
+    def report(self):
+        rate = 0.0
+        if (self.lookups > 0):
+            rate = (self.hits / float(self.lookups)) * 100
+        return f"Catalog hits: {str(self.hits)} of {str(self.lookups)} " + \
+            f"({str(rate)}%)"
+
+
+_catalogs = {}
+
+"""Get the catalog in a directory, opening it on first use
+"""
+def getCatalog(directory):
+    if directory not in _catalogs:
+        _catalogs[directory] = AnnotationCatalog(directory)
+    return _catalogs[directory]
+
+
+if __name__ == '__main__':
+    import driver
+    import snapshot
+
+    if len(sys.argv) > 1:
+        version = None
+        if len(sys.argv) > 2:
+            version = sys.argv[2]
+        version = version or snapshot.snapshotVersion()
+        if not version:
+            print("A reference version must be provided.")
+            sys.exit(1)
+
+        def makeStages(sitesfile):
+            return [driver.makeStage(sitesfile, 'vcf', cls, kwargs,
+                sweep=True) for (label, cls, kwargs) in driver.STAGES]
+
+        conn = u.db_connect()
+        buildCatalog(conn, sys.argv[1], version, makeStages)
+        conn.close()
+    else:
+        print("An output directory for the catalog must be provided.")
+
+### EOF
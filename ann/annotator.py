@@ -3,9 +3,12 @@ import json
 import subprocess
 import sys
 import os
+import time
 from botocore.exceptions import ClientError
 from pathlib import Path
 from configparser import ConfigParser
+import result_reuse as rr
+import snapshot
 
 config = ConfigParser(os.environ)
 config.read('ann_config.ini')
@@ -17,8 +20,81 @@ REGION = config['aws']['AwsRegionName']
 ANNOTATOR_BASE_DIR = config['ann']['AnnotatorBaseDir']
 ANNOTATOR_JOBS_DIR = config['ann']['AnnotatorJobsDir']
 DYNAMO_DB_TABLE = config['dynamodb']['DynamoDBTable']
+RESULT_BUCKET_NAME = config['s3']['ResultBucketName']
+SNS_JOB_RESULT_TOPIC = config['sns']['SnsJobResultTopic']
+SNS_MESSAGE_STRUCTURE = config['sns']['SnsMessageStructure']
+REFERENCE_VERSION = config.get('ann', 'ReferenceVersion', fallback='') or None
+REFERENCE_SNAPSHOT_DIR = config.get('ann', 'ReferenceSnapshotDir',
+    fallback='')
+if REFERENCE_SNAPSHOT_DIR:
+    os.environ['ANNOTATOR_SNAPSHOT_DIR'] = REFERENCE_SNAPSHOT_DIR
 
 s3 = boto3.resource('s3', region_name=REGION)
+s3_client = boto3.client('s3', region_name=REGION)
+
+# Results are only reused if the reference version is known, see
+# result_reuse.py
+PIPELINE = rr.pipelineDescription(config,
+    REFERENCE_VERSION or snapshot.snapshotVersion())
+
+
+"""Copy the result of a completed job with the same input, reference and
+pipeline and mark the job COMPLETED
+Returns False, leaving the job to be annotated, if there is none
+"""
+def reuse_result(content_hash, job_obj, prefix, directory):
+    pointer = rr.findResult(s3_client, RESULT_BUCKET_NAME, content_hash)
+    if pointer is None:
+        return False
+    keys = rr.copyResult(s3_client, RESULT_BUCKET_NAME, pointer, prefix,
+        job_obj['input_file_name'])
+    if keys is None:
+        return False
+
+    # record the hit on the job item
+    dynamodb = boto3.resource('dynamodb', region_name=REGION)
+    ann_table = dynamodb.Table(DYNAMO_DB_TABLE)
+    ann_table.update_item(
+        Key = {'job_id' : job_obj['job_id']},
+        ExpressionAttributeValues = {
+            ':s' : 'COMPLETED',
+            ':js' : 'PENDING',
+            ':t' : int(time.time()),
+            ':krf' : keys['s3_key_result_file'],
+            ':klf' : keys['s3_key_log_file'],
+            ':h' : content_hash,
+            ':r' : pointer['job_id']
+        },
+        ConditionExpression = "begins_with(job_status, :js)",
+        UpdateExpression = """SET job_status = :s,
+                              complete_time = :t,
+                              s3_key_result_file = :krf,
+                              s3_key_log_file = :klf,
+                              content_hash = :h,
+                              reused_result_of = :r
+                           """,
+        ReturnValues = "UPDATED_OLD"
+    )
+
+    # notify the user as run.py does
+    data = {
+        "job_id" : job_obj['job_id'],
+        "user_id" : job_obj['user_id'],
+        "input_file_name" : job_obj['input_file_name'],
+        "s3_inputs_butket" : INPUT_BUCKET_NAME,
+        "complete_time" : int(time.time())
+    }
+    sns_client = boto3.client('sns', region_name=REGION)
+    sns_client.publish(TopicArn=SNS_JOB_RESULT_TOPIC,
+                       MessageStructure=SNS_MESSAGE_STRUCTURE,
+                       Message=json.dumps({'default' : json.dumps(data)}))
+
+    for file_2_delete in os.listdir(directory):
+        file = directory + file_2_delete
+        if os.path.isfile(file):
+            os.remove(file)
+    return True
+
 # Connect to SQS and get the message queue
 # How to get queue url
 # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.get_queue_url
@@ -92,9 +168,28 @@ while True:
             print('File not found')
         continue
 
+    # Reuse the result of an identical job instead of annotating
+    content_hash = None
+    if PIPELINE is not None:
+        content_hash = rr.fileHash(filepath, PIPELINE)
+        try:
+            if reuse_result(content_hash, job_obj,
+                f"{admin_id}/{user_id}/{job_id}/", directory):
+                print(f"Reused the result of an identical job for {job_id}")
+                sqs_client.delete_message(QueueUrl=queue_url,
+                                          ReceiptHandle=receipt_handle)
+                continue
+        except ClientError as e:
+            print("Failed to reuse a result, annotating")
+            print(e)
+
     # Launch annotation job as a background process
+    # (run.py records its result under content_hash once it completes)
+    args = ["python", f"{ANNOTATOR_BASE_DIR}run.py", filepath]
+    if content_hash is not None:
+        args.append(content_hash)
     try:
-        job = subprocess.Popen(["python", f"{ANNOTATOR_BASE_DIR}run.py", filepath])
+        job = subprocess.Popen(args)
     except subprocess.CalledProcessError as e:
         print("Failed to start annotation subprocess")
         print(e)
@@ -0,0 +1,82 @@
+# async_lookup.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Concurrent per-variant database lookups for the annotation stages
+#
+# pymysql is blocking, so each statement runs in a worker thread on a
+# connection of its own. An asyncio event loop hands out `inflight`
+# dedicated connections, so up to that many statements run at a time.
+# A statement shared by several records of a chunk runs once.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import utils as u
+
+"""Run one statement on a connection, in a worker thread
+"""
+def fetchAll(conn, sql):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+"""Resolves the lookups of a chunk of records concurrently
+   run() takes one chain of statements per record; the statements of a
+   chain run one after the other until one returns rows, like the
+   chrom_pos_* cascade of getBigRefGene. Returns {statement: rows}, which
+   the stages consult before querying on their own connection.
+   Each of the inflight connections runs one statement at a time. The
+   chains that reach a statement another chain already started wait for
+   its rows instead of sending it again
+"""
+class AsyncLookup(object):
+    def __init__(self, inflight=16):
+        self.conns = [u.db_connect() for i in range(max(1, inflight))]
+        self.executor = ThreadPoolExecutor(max_workers=len(self.conns))
+        self.loop = asyncio.new_event_loop()
+
+    async def execute(self, sql, free):
+        conn = await free.get()
+        try:
+            return await self.loop.run_in_executor(self.executor,
+                fetchAll, conn, sql)
+        finally:
+            free.put_nowait(conn)
+
+    async def chain(self, statements, pending, free):
+        for sql in statements:
+            if sql not in pending:
+                pending[sql] = self.loop.create_task(self.execute(sql, free))
+            rows = await pending[sql]
+            if (len(rows) > 0):
+                return
+
+    async def gather(self, chains):
+        free = asyncio.Queue()
+        for conn in self.conns:
+            free.put_nowait(conn)
+        pending = {}
+        await asyncio.gather(*[self.chain(statements, pending, free)
+            for statements in chains])
+        return dict([(sql, task.result()) for (sql, task)
+            in pending.items()])
+
+    def run(self, chains):
+        return self.loop.run_until_complete(self.gather(chains))
+
+    def close(self):
+        self.executor.shutdown()
+        self.loop.close()
+        for conn in self.conns:
+            conn.close()
+
+### EOF
@@ -0,0 +1,104 @@
+# batch_lookup.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Chunked reference database lookups for the annotation stages
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+KEY_TABLE = 'batch_variant_keys'
+
+"""Drops repeated (chrom, pos) keys, keeping the first occurrence
+"""
+def uniqueKeys(keys):
+    seen = set([])
+    unique = []
+    for key in keys:
+        if key not in seen:
+            seen.add(key)
+            unique.append(key)
+    return unique
+
+
+"""Groups (chrom, pos, column, ...) rows by their leading key columns
+"""
+def groupRows(rows):
+    groups = {}
+    for row in rows:
+        key = (str(row[0]), int(row[1]))
+        groups.setdefault(key, []).append(tuple(row[2:]))
+    return groups
+
+
+"""Loads a chunk of variant positions into a per-connection temporary table
+"""
+def loadKeys(cursor, keys):
+    cursor.execute('CREATE TEMPORARY TABLE IF NOT EXISTS ' + KEY_TABLE + \
+        ' (chrom VARCHAR(64) NOT NULL, pos BIGINT NOT NULL, ' + \
+        'PRIMARY KEY (chrom, pos));')
+    cursor.execute('DELETE FROM ' + KEY_TABLE + ';')
+    cursor.executemany('INSERT INTO ' + KEY_TABLE + ' (chrom, pos) ' + \
+        'VALUES (%s, %s);', keys)
+
+
+"""Resolves 'start - offset <= pos AND pos <= end + offset' for a whole
+   chunk of positions with one join against the temporary key table
+   The key table drives the join (STRAIGHT_JOIN), so the reference table
+   is probed once per position as with one query per position. SQL does
+   not define the order of the rows of a position on either path, so a
+   position with several hits may list them in another order.
+   Returns {(chrom, pos): [row, ...]}; chromName=None leaves the
+   chromosome out of the join for the per-chromosome tables
+"""
+def overlapJoin(cursor, keys, table, chromName='chrom',
+    startName='chromStart', endName='chromEnd', columns='t.*', offset=0):
+
+    if (len(keys) == 0):
+        return {}
+    loadKeys(cursor, keys)
+
+    start = 't.' + startName
+    end = 't.' + endName
+    if (offset != 0):
+        start = '(' + start + ' - ' + str(int(offset)) + ')'
+        end = '(' + end + ' + ' + str(int(offset)) + ')'
+
+    sql = 'select k.chrom, k.pos, ' + columns + ' from ' + KEY_TABLE + \
+        ' k STRAIGHT_JOIN ' + table + ' t on '
+    if chromName is not None:
+        sql = sql + 't.' + chromName + ' = k.chrom AND '
+    sql = sql + start + ' <= k.pos AND k.pos <= ' + end + ';'
+
+    cursor.execute(sql)
+    return groupRows(cursor.fetchall())
+
+
+"""Resolves exact (chrom, pos) lookups for a chunk of positions with one
+   parameterized multi-key statement
+   Returns ({(chrom, pos): [row, ...]}, column names)
+"""
+def equalIn(cursor, keys, table, chromName, posName, where='', params=()):
+    if (len(keys) == 0):
+        return ({}, [])
+
+    sql = 'select * from ' + table + ' where ' + where + '(' + \
+        chromName + ', ' + posName + ') in (' + \
+        ', '.join(['(%s, %s)'] * len(keys)) + ');'
+    args = list(params)
+    for (chrom, pos) in keys:
+        args.append(chrom)
+        args.append(pos)
+    cursor.execute(sql, args)
+
+    names = [str(d[0]) for d in cursor.description]
+    chr_ind = names.index(chromName)
+    pos_ind = names.index(posName)
+    groups = {}
+    for row in cursor.fetchall():
+        key = (str(row[chr_ind]), int(row[pos_ind]))
+        groups.setdefault(key, []).append(row)
+    return (groups, names)
+
+### EOF
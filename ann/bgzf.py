@@ -0,0 +1,223 @@
+# bgzf.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# BGZF (bgzip) compressed VCF files and their tabix (.tbi) index
+#
+# BGZF is a series of gzip members of at most 64 KB of data each, so any
+# gzip reader can read it; an index maps each chromosome and position to
+# the virtual offset (compressed block offset << 16 | offset in block)
+# of the records there, the same index tabix and htslib read.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import gzip
+import struct
+import zlib
+
+# Data compressed per block, leaving room for incompressible data
+BLOCK_SIZE = 0xff00
+
+# Empty block that ends every BGZF file
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b00' + \
+    '03000000000000000000')
+
+# Tabix binning: 16 kb linear windows and the UCSC bin levels
+LINEAR_SHIFT = 14
+
+"""Open a BGZF (or any gzip) file for reading as text
+"""
+def openText(filename):
+    return gzip.open(filename, 'rt')
+
+
+"""Compress one block of data
+"""
+def compressBlock(data, level=6):
+    deflate = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = deflate.compress(data) + deflate.flush()
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+        ord('B'), ord('C'), 2, len(cdata) + 25)
+    return header + cdata + struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+        len(data))
+
+
+"""Writes text to a BGZF file
+   tell() is the virtual offset of the next byte written. With an index,
+   the virtual offsets of every line are passed to index.add()
+"""
+class BgzfWriter(object):
+    def __init__(self, filename, index=None, level=6):
+        self.fh = open(filename, 'wb')
+        self.index = index
+        self.level = level
+        self.address = 0
+        self.buffer = bytearray()
+        self.line = None
+        self.lineStart = 0
+
+    def tell(self):
+        return (self.address << 16) | len(self.buffer)
+
+    def writeBytes(self, data):
+        self.buffer.extend(data)
+        while (len(self.buffer) >= BLOCK_SIZE):
+            self.flushBlock(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+
+    def flushBlock(self, data):
+        block = compressBlock(data, self.level)
+        self.fh.write(block)
+        self.address = self.address + len(block)
+
+    def write(self, text):
+        if self.index is None:
+            self.writeBytes(text.encode('utf-8'))
+            return
+
+        start = 0
+        while (start < len(text)):
+            end = text.find('\n', start)
+            if (end < 0):
+                end = len(text)
+            else:
+                end = end + 1
+            if self.line is None:
+                self.line = []
+                self.lineStart = self.tell()
+            piece = text[start:end]
+            self.line.append(piece)
+            self.writeBytes(piece.encode('utf-8'))
+            if piece.endswith('\n'):
+                self.index.add(''.join(self.line), self.lineStart,
+                    self.tell())
+                self.line = None
+            start = end
+
+    def close(self):
+        if (len(self.buffer) > 0):
+            self.flushBlock(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.fh.write(EOF_BLOCK)
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+"""Bin of a zero-based, half-open interval in the tabix/UCSC scheme
+"""
+def reg2bin(beg, end):
+    end = end - 1
+    if (beg >> 14) == (end >> 14):
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if (beg >> 17) == (end >> 17):
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if (beg >> 20) == (end >> 20):
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if (beg >> 23) == (end >> 23):
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if (beg >> 26) == (end >> 26):
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+
+"""Tabix index of a VCF written in (chrom, pos) order
+   A record covers [POS - 1, POS - 1 + len(REF)). If the records turn out
+   not to be sorted, sorted is False and no index can be written
+"""
+class TabixIndex(object):
+    def __init__(self, meta='#'):
+        self.meta = meta
+        self.names = []
+        self.refs = {}
+        self.sorted = True
+        self.last = None
+
+    def add(self, line, vbeg, vend):
+        if line.startswith(self.meta) or not self.sorted:
+            return
+        fields = line.rstrip('\r\n').split('\t', 4)
+        try:
+            beg = int(fields[1]) - 1
+            end = beg + max(1, len(fields[3]))
+        except (IndexError, ValueError):
+            return
+        chrom = fields[0]
+
+        if chrom not in self.refs:
+            self.names.append(chrom)
+            self.refs[chrom] = ({}, [])
+        elif (self.last[0] != chrom) or (beg < self.last[1]):
+            self.sorted = False
+            return
+        self.last = (chrom, beg)
+
+        bins, linear = self.refs[chrom]
+        chunks = bins.setdefault(reg2bin(beg, end), [])
+        if (len(chunks) > 0) and (chunks[-1][1] == vbeg):
+            chunks[-1][1] = vend
+        else:
+            chunks.append([vbeg, vend])
+        for w in range(beg >> LINEAR_SHIFT, ((end - 1) >> LINEAR_SHIFT) + 1):
+            while (len(linear) <= w):
+                linear.append(0)
+            if (linear[w] == 0):
+                linear[w] = vbeg
+
+    def data(self):
+        names = b''.join([name.encode('utf-8') + b'\0'
+            for name in self.names])
+        # VCF: sequence, begin and end columns 1, 2 and 0, meta '#'
+        parts = [b'TBI\1', struct.pack('<8i', len(self.names), 2, 1, 2, 0,
+            ord(self.meta), 0, len(names)), names]
+        for name in self.names:
+            bins, linear = self.refs[name]
+            parts.append(struct.pack('<i', len(bins)))
+            for b in sorted(bins.keys()):
+                chunks = bins[b]
+                parts.append(struct.pack('<Ii', b, len(chunks)))
+                for (vbeg, vend) in chunks:
+                    parts.append(struct.pack('<QQ', vbeg, vend))
+            for w in range(1, len(linear)):
+                if (linear[w] == 0):
+                    linear[w] = linear[w - 1]
+            parts.append(struct.pack('<i', len(linear)))
+            parts.append(struct.pack('<' + str(len(linear)) + 'Q', *linear))
+        parts.append(struct.pack('<Q', 0))
+        return b''.join(parts)
+
+    """Write the index, BGZF compressed, to filename
+    """
+    def write(self, filename):
+        data = self.data()
+        with open(filename, 'wb') as fh:
+            for i in range(0, len(data), BLOCK_SIZE):
+                fh.write(compressBlock(data[i:i + BLOCK_SIZE]))
+            fh.write(EOF_BLOCK)
+
+
+"""Open a BGZF file for writing
+   With index=True the records are indexed as they are written and the
+   index is saved as <filename>.tbi on close, if they were sorted
+"""
+class IndexedWriter(BgzfWriter):
+    def __init__(self, filename, index=True, level=6):
+        self.filename = filename
+        super().__init__(filename, index=TabixIndex() if index else None,
+            level=level)
+
+    def close(self):
+        super().close()
+        if (self.index is not None) and self.index.sorted:
+            self.index.write(self.filename + '.tbi')
+        elif os.path.exists(self.filename + '.tbi'):
+            os.remove(self.filename + '.tbi')
+
+### EOF
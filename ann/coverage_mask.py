@@ -0,0 +1,103 @@
+# coverage_mask.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Per-chromosome coverage masks for the CNV database stages
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+from array import array
+from bisect import bisect_right
+
+"""Positions covered by any interval of a table, per chromosome
+   The CNV stages only report whether a position overlaps the table, so
+   the intervals are merged into sorted, disjoint [start, end] runs and
+   a lookup is a single bisect
+"""
+class CoverageMask(object):
+    def __init__(self):
+        self.pending = {}
+        self.chroms = {}
+
+    def add(self, chrom, start, end):
+        if (start is None) or (end is None) or (int(end) < int(start)):
+            return
+        self.pending.setdefault(chrom, []).append((int(start), int(end)))
+
+    def build(self):
+        for chrom, intervals in self.pending.items():
+            intervals.sort()
+            starts = array('q')
+            ends = array('q')
+            for (start, end) in intervals:
+                # integer positions, so touching runs merge too
+                if (len(ends) > 0) and (start <= ends[-1] + 1):
+                    if (end > ends[-1]):
+                        ends[-1] = end
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self.chroms[chrom] = (starts, ends)
+        self.pending = {}
+        return self
+
+    def covers(self, chrom, pos):
+        if chrom not in self.chroms:
+            return False
+        starts, ends = self.chroms[chrom]
+        pos = int(pos)
+        i = bisect_right(starts, pos) - 1
+        return (i >= 0) and (ends[i] >= pos)
+
+    """Span (lo, hi) of positions around pos that are covered, or not,
+       like pos; a bound of None is open
+    """
+    def span(self, chrom, pos):
+        if chrom not in self.chroms:
+            return (None, None)
+        starts, ends = self.chroms[chrom]
+        pos = int(pos)
+        i = bisect_right(starts, pos) - 1
+        if (i >= 0) and (ends[i] >= pos):
+            return (starts[i], ends[i])
+        lo = None
+        hi = None
+        if (i >= 0):
+            lo = ends[i] + 1
+        if (i + 1 < len(starts)):
+            hi = starts[i + 1] - 1
+        return (lo, hi)
+
+
+"""Load the intervals of a whole table into a CoverageMask
+"""
+def buildMask(cursor, table, chromName='chrom', startName='chromStart',
+    endName='chromEnd', chunk=10000):
+
+    cursor.execute('select ' + chromName + ', ' + startName + ', ' + \
+        endName + ' from ' + table + ';')
+    mask = CoverageMask()
+    rows = cursor.fetchmany(chunk)
+    while (len(rows) > 0):
+        for row in rows:
+            mask.add(str(row[0]), row[1], row[2])
+        rows = cursor.fetchmany(chunk)
+    return mask.build()
+
+
+_masks = {}
+
+"""Get the mask for a table, building it on first use
+"""
+def getMask(cursor, table, chromName='chrom', startName='chromStart',
+    endName='chromEnd'):
+
+    key = (table, chromName, startName, endName)
+    if key not in _masks:
+        _masks[key] = buildMask(cursor, table, chromName=chromName,
+            startName=startName, endName=endName)
+    return _masks[key]
+
+### EOF
@@ -0,0 +1,214 @@
+# db_pool.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Process-wide pool of reference database connections
+#
+# utils.db_connect() hands out pooled connections; closing one returns it
+# to the pool, so the stages of a job reuse warm connections instead of
+# opening new ones. annotator.py starts a run.py process per job, so a
+# pool lasts for one job (its shards have pools of their own).
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import time
+import atexit
+import threading
+
+# Connections kept open while idle
+POOL_MAX_IDLE = int(os.environ.get('DB_POOL_MAX_IDLE', 16))
+# Connections open at once, 0 for no limit; acquire() waits at the limit
+POOL_MAX_OPEN = int(os.environ.get('DB_POOL_MAX_OPEN', 0))
+# Idle connections are pinged before reuse after this many seconds
+POOL_CHECK_AFTER = int(os.environ.get('DB_POOL_CHECK_AFTER', 30))
+# Connections are replaced after this many seconds
+POOL_MAX_AGE = int(os.environ.get('DB_POOL_MAX_AGE', 3600))
+
+STAT_NAMES = ['acquired', 'opened', 'reused', 'discarded', 'wait_secs']
+
+
+"""A connection checked out of the pool
+   Behaves like the underlying connection; close() gives it back
+"""
+class PooledConnection(object):
+    def __init__(self, pool, conn, created):
+        self._pool = pool
+        self._conn = conn
+        self._created = created
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise AttributeError(f"'{name}' of a released connection")
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.release(self._conn, self._created)
+            self._conn = None
+
+
+class ConnectionPool(object):
+    def __init__(self, connect, max_idle=POOL_MAX_IDLE,
+        max_open=POOL_MAX_OPEN, check_after=POOL_CHECK_AFTER,
+        max_age=POOL_MAX_AGE):
+
+        self.connect = connect
+        self.max_idle = max_idle
+        self.max_open = max_open
+        self.check_after = check_after
+        self.max_age = max_age
+        self.cond = threading.Condition()
+        self.stats = dict([(name, 0) for name in STAT_NAMES])
+        self.reset()
+
+    """Forget the connections of another process
+       Connections inherited through fork() share their sockets with the
+       parent, so a child process starts with an empty pool
+    """
+    def reset(self):
+        self.pid = os.getpid()
+        self.idle = []
+        self.open = 0
+
+    def acquire(self):
+        start = time.time()
+        entry = None
+        with self.cond:
+            if (self.pid != os.getpid()):
+                self.reset()
+            while True:
+                if (len(self.idle) > 0):
+                    entry = self.idle.pop()
+                    break
+                if (self.max_open == 0) or (self.open < self.max_open):
+                    self.open = self.open + 1
+                    break
+                self.cond.wait()
+
+        conn = None
+        created = None
+        if entry is not None:
+            conn, created, last_used = entry
+            now = time.time()
+            if (now - created > self.max_age) or \
+                ((now - last_used > self.check_after) and
+                not self.healthy(conn)):
+                self.discard(conn, reopen=True)
+                conn = None
+            else:
+                self.count('reused')
+
+        if conn is None:
+            try:
+                conn = self.connect()
+            except Exception:
+                with self.cond:
+                    self.open = self.open - 1
+                    self.cond.notify()
+                raise
+            created = time.time()
+            self.count('opened')
+
+        self.count('acquired')
+        self.count('wait_secs', time.time() - start)
+        return PooledConnection(self, conn, created)
+
+    """Take a connection back, rolled back first: pymysql does not
+       autocommit, so a connection would otherwise keep its open
+       transaction, with its REPEATABLE READ view of the tables and any
+       uncommitted rows (e.g. batch_lookup's keys), for its next user.
+       Connections that cannot be rolled back are discarded
+    """
+    def release(self, conn, created):
+        try:
+            conn.rollback()
+        except Exception:
+            self.discard(conn)
+            return
+        with self.cond:
+            if (self.pid == os.getpid()) and (len(self.idle) < self.max_idle):
+                self.idle.append((conn, created, time.time()))
+                self.cond.notify()
+                return
+        self.discard(conn)
+
+    """Close a connection; with reopen=True its slot stays taken because
+       the caller opens a replacement
+    """
+    def discard(self, conn, reopen=False):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self.cond:
+            if not reopen:
+                self.open = self.open - 1
+                self.cond.notify()
+        self.count('discarded')
+
+    def healthy(self, conn):
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def count(self, name, value=1):
+        with self.cond:
+            self.stats[name] = self.stats[name] + value
+
+    def snapshot(self):
+        with self.cond:
+            return dict(self.stats)
+
+    def closeAll(self):
+        with self.cond:
+            idle = self.idle
+            self.idle = []
+            self.open = self.open - len(idle)
+        for (conn, created, last_used) in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+"""The process-wide pool, created on first use with the given connect
+   function
+"""
+def getPool(connect):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(connect)
+            atexit.register(_pool.closeAll)
+    return _pool
+
+
+"""Counters of the process-wide pool (zeros if it was never used)
+"""
+def stats():
+    if _pool is None:
+        return dict([(name, 0) for name in STAT_NAMES])
+    return _pool.snapshot()
+
+
+"""One line summary of the pool activity since the counters in before
+"""
+def report(before=None):
+    after = stats()
+    if before is None:
+        before = dict([(name, 0) for name in STAT_NAMES])
+    delta = dict([(name, after[name] - before[name]) for name in STAT_NAMES])
+    return f"Database connections: {delta['acquired']} acquired, " + \
+        f"{delta['opened']} opened, {delta['reused']} reused, " + \
+        f"{delta['discarded']} discarded, " + \
+        f"{delta['wait_secs']:.2f}s waiting"
+
+### EOF
@@ -0,0 +1,234 @@
+# dbsnp_index.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Memory-mapped dbSNP lookup index
+#
+# Build once per dbSNP release with:
+#   python dbsnp_index.py <index_directory>
+#
+# Layout of <index_directory>:
+#   meta.json            chromosomes, record counts, variant class names
+#   <chrom>/pos.bin      sorted positions (uint32, native byte order)
+#   <chrom>/vc.bin       variant class code per record (uint8)
+#   <chrom>/<col>.idx    record offsets into <col>.dat (uint64, n + 1)
+#   <chrom>/<col>.dat    utf-8 values of REF, rsID and GMAF
+#
+# The files are opened read-only with mmap, so every annotator process
+# on a box shares one copy in the page cache.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import mmap
+import shutil
+import time
+from array import array
+
+import pymysql
+
+import utils as u
+
+STRING_COLUMNS = ['ref', 'rsid', 'gmaf']
+
+# Positions of rsID and GMAF in a dbSNP row, as used by getSnpsFromDbSnp
+RSID_IND = 3
+GMAF_IND = 7
+
+"""Appends utf-8 strings to <col>.dat and their offsets to <col>.idx
+"""
+class StringColumnWriter(object):
+    def __init__(self, path):
+        self.fh_dat = open(path + '.dat', 'wb')
+        self.fh_idx = open(path + '.idx', 'wb')
+        self.offset = 0
+        self.offsets = array('Q', [0])
+
+    def append(self, value):
+        data = str(value).encode('utf-8')
+        self.fh_dat.write(data)
+        self.offset = self.offset + len(data)
+        self.offsets.append(self.offset)
+
+    def flush(self):
+        self.offsets.tofile(self.fh_idx)
+        self.offsets = array('Q')
+
+    def close(self):
+        self.flush()
+        self.fh_dat.close()
+        self.fh_idx.close()
+
+
+"""Export the dbSNP table into an index directory
+   Each chromosome is read in POS order. SQL does not define the order of
+   the records at one position, here or in the per-variant queries of
+   getSnpsFromDbSnp, so a position with several rsIDs may list them in
+   another order than with RDS
+"""
+def buildIndex(conn, directory, table='dbSNP', chunk=100000):
+    tmpdir = directory.rstrip('/') + '.tmp'
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+
+    cursor = conn.cursor()
+    cursor.execute('select distinct CHR from ' + table + ';')
+    chroms = sorted([str(row[0]) for row in cursor.fetchall()])
+    cursor.close()
+
+    classes = []
+    counts = {}
+    for chrom in chroms:
+        chromdir = os.path.join(tmpdir, chrom)
+        os.makedirs(chromdir)
+        fh_pos = open(os.path.join(chromdir, 'pos.bin'), 'wb')
+        fh_vc = open(os.path.join(chromdir, 'vc.bin'), 'wb')
+        columns = dict([(col, StringColumnWriter(os.path.join(chromdir, col)))
+            for col in STRING_COLUMNS])
+
+        cursor = conn.cursor(pymysql.cursors.SSCursor)
+        cursor.execute('select * from ' + table + ' where CHR = %s ' + \
+            'order by POS;', (chrom,))
+        names = [str(d[0]) for d in cursor.description]
+        pos_ind = names.index('POS')
+        ref_ind = names.index('REF')
+        info_ind = names.index('INFO')
+
+        count = 0
+        rows = cursor.fetchmany(chunk)
+        while (len(rows) > 0):
+            positions = array('I')
+            codes = array('B')
+            for row in rows:
+                varclass = str(row[info_ind])
+                if varclass not in classes:
+                    classes.append(varclass)
+                positions.append(int(row[pos_ind]))
+                codes.append(classes.index(varclass))
+                columns['ref'].append(row[ref_ind])
+                columns['rsid'].append(row[RSID_IND])
+                columns['gmaf'].append(row[GMAF_IND])
+            positions.tofile(fh_pos)
+            codes.tofile(fh_vc)
+            for col in columns.values():
+                col.flush()
+            count = count + len(rows)
+            rows = cursor.fetchmany(chunk)
+        cursor.close()
+
+        fh_pos.close()
+        fh_vc.close()
+        for col in columns.values():
+            col.close()
+        counts[chrom] = count
+        print(f"{chrom}: {str(count)} records")
+
+    meta = {'table': table, 'built': int(time.time()), 'classes': classes,
+        'chroms': counts}
+    with open(os.path.join(tmpdir, 'meta.json'), 'w') as fh:
+        json.dump(meta, fh, indent=2)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.rename(tmpdir, directory)
+
+
+"""Map a binary file read-only as an array of the given type code
+"""
+def mapArray(path, typecode):
+    fh = open(path, 'rb')
+    try:
+        if (os.fstat(fh.fileno()).st_size == 0):
+            return array(typecode)
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        fh.close()
+    if (typecode == 'B'):
+        return memoryview(mm)
+    return memoryview(mm).cast(typecode)
+
+
+"""The mapped arrays of one chromosome
+"""
+class ChromosomeIndex(object):
+    def __init__(self, chromdir):
+        self.pos = mapArray(os.path.join(chromdir, 'pos.bin'), 'I')
+        self.vc = mapArray(os.path.join(chromdir, 'vc.bin'), 'B')
+        self.columns = {}
+        for col in STRING_COLUMNS:
+            path = os.path.join(chromdir, col)
+            self.columns[col] = (mapArray(path + '.idx', 'Q'),
+                mapArray(path + '.dat', 'B'))
+
+    def value(self, col, i):
+        idx, dat = self.columns[col]
+        return bytes(dat[idx[i]:idx[i + 1]]).decode('utf-8')
+
+
+"""Read-only view of an index directory
+   positions() is what the caller searches; records() returns every
+   record at the position found, in build order
+"""
+class DbSnpIndex(object):
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as fh:
+            meta = json.load(fh)
+        self.classes = meta['classes']
+        self.counts = meta['chroms']
+        self.chroms = {}
+
+    def chromosome(self, chrom):
+        if chrom not in self.counts:
+            return None
+        if chrom not in self.chroms:
+            self.chroms[chrom] = ChromosomeIndex(
+                os.path.join(self.directory, chrom))
+        return self.chroms[chrom]
+
+    def positions(self, chrom):
+        index = self.chromosome(chrom)
+        if index is None:
+            return []
+        return index.pos
+
+    def records(self, chrom, i):
+        index = self.chromosome(chrom)
+        pos = index.pos
+        first = i
+        while (first > 0) and (pos[first - 1] == pos[i]):
+            first = first - 1
+        last = i
+        while (last + 1 < len(pos)) and (pos[last + 1] == pos[i]):
+            last = last + 1
+
+        records = []
+        for j in range(first, last + 1):
+            records.append((index.value('ref', j),
+                self.classes[index.vc[j]], index.value('rsid', j),
+                index.value('gmaf', j)))
+        return records
+
+
+_indexes = {}
+
+"""Get the index in a directory, opening it on first use
+"""
+def getIndex(directory):
+    if directory not in _indexes:
+        _indexes[directory] = DbSnpIndex(directory)
+    return _indexes[directory]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        conn = u.db_connect()
+        buildIndex(conn, sys.argv[1])
+        conn.close()
+    else:
+        print("An output directory for the dbSNP index must be provided.")
+
+### EOF
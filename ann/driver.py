@@ -12,110 +12,369 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
+import shutil
+import multiprocessing
 import file_utils as fu
 import annotate as ann
+import annotation_catalog as ac
+import async_lookup as al
+import external_sort as es
+import db_pool
+import fragment_sidecar as fs
+import sharding
+import sites_only as so
+import snapshot
+import utils as u
+import variant_cache as vc
 
-def run(infile, format):
+"""Annotation stages in the order they are applied
+   Each entry is (label, stage class, stage arguments)
+"""
+STAGES = [
+    ("dbSNP", ann.DbSnpStage, {}),
+    ("BigRefGene", ann.BigRefGeneStage, {}),
+    ("BigRefGene", ann.GenesStage, {'table': 'refGene',
+        'promoter_offset': 500}),
+    ("Cytoband", ann.CytobandStage, {'table': 'cytoBand'}),
+    ("gadAll", ann.GadAllStage, {'table': 'gadAll'}),
+    ("GwasCatalog", ann.GwasCatalogStage, {'table': 'gwasCatalog'}),
+    ("miRNA", ann.MiRNAStage, {'table': 'targetScanS'}),
+    ("HUGO Gene Nomenclature Committee", ann.HUGOGeneNomenclatureStage,
+        {'table': 'hugo'}),
+    ("CNV databases", ann.CnvDatabasesStage, {'tables': ann.CNV_TABLES}),
+    ("genomicSuperDups", ann.GenomicSuperDupsStage,
+        {'table': 'genomicSuperDups'}),
+    ("addOverlapWithTfbsConsSites", ann.TfbsConsSitesStage,
+        {'table': 'tfbsConsSites'}),
+]
+
+
+# Stages that hold their tables in memory unless use_index=False
+INDEXED_STAGES = (ann.BigRefGeneStage, ann.GenesStage, ann.OverlapStage,
+    ann.CnvDatabasesStage)
+
+"""Create the stage for one STAGES entry
+"""
+def makeStage(infile, format, cls, kwargs, batch=False, dbsnp_index=None,
+    lookup=None, tfbs_index=None, sweep=False, cache=None, catalog=None,
+    sidecar=None, use_index=True):
+    options = dict(kwargs)
+    options['batch'] = batch
+    if (not use_index) and issubclass(cls, INDEXED_STAGES) and \
+        (cls is not ann.TfbsConsSitesStage):
+        options['use_index'] = False
+    if sweep and issubclass(cls, (ann.OverlapStage, ann.CnvDatabasesStage)):
+        options['sweep'] = True
+    if (cls is ann.DbSnpStage):
+        if dbsnp_index is None:
+            dbsnp_index = snapshot.dbsnpIndexDir()
+        options['index_dir'] = dbsnp_index
+    if (cls is ann.TfbsConsSitesStage):
+        if tfbs_index is None:
+            tfbs_index = snapshot.tfbsIndexDir()
+        options['index_dir'] = tfbs_index
+    stage = cls(infile, format=format, **options)
+    stage.lookup = lookup
+    stage.cache = cache
+    stage.catalog = catalog
+    if sidecar is not None:
+        sidecar.track(stage.cacheName(), stage.tables())
+        stage.sidecar = sidecar
+    return stage
+
+
+"""Open the variant cache at cache_file for the reference in use
+   The version is reference_version, or that of the snapshot in use;
+   without either the cache is not used, as entries could not be told
+   apart from those of other reference data
+"""
+def openCache(cache_file, cache_bytes=vc.CACHE_BYTES, reference_version=None):
+    if not cache_file:
+        return None
+    version = reference_version or snapshot.snapshotVersion()
+    if not version:
+        print("No reference version, variant cache not used.")
+        return None
+    return vc.VariantCache(cache_file, version, max_bytes=cache_bytes)
+
+
+"""Open the annotation catalog in catalog_dir if it was built for the
+   reference in use (reference_version, or that of the snapshot)
+"""
+def openCatalog(catalog_dir, reference_version=None):
+    if not catalog_dir:
+        return None
+    catalog = ac.getCatalog(catalog_dir)
+    version = reference_version or snapshot.snapshotVersion()
+    if (str(version) != catalog.version):
+        print(f"Annotation catalog is for reference {catalog.version}, " + \
+            "not used.")
+        return None
+    return catalog
+
+
+"""Open the fragment sidecar at sidecar_file for the reference in use
+   (reference_version, or that of the snapshot)
+"""
+def openSidecar(sidecar_file, reference_version=None):
+    if not sidecar_file:
+        return None
+    version = reference_version or snapshot.snapshotVersion()
+    if not version:
+        print("No reference version, fragment sidecar not written.")
+        return None
+    return fs.FragmentSidecar(sidecar_file, version)
+
+
+"""Name of infile without a .gz extension, from which the names of the
+   intermediate files and the .count.log are derived
+"""
+def baseName(infile):
+    if infile.endswith('.gz'):
+        return infile[:-3]
+    return infile
+
+
+"""Output file written by run() for infile
+"""
+def annotatedName(infile, compress=False):
+    outfile = (baseName(infile) + '.annot').replace('.vcf.annot', '.annot.vcf')
+    if compress:
+        outfile = outfile + '.gz'
+    return outfile
+
+
+"""Annotate one shard in a worker process
+"""
+def runShard(args):
+    shardfile, format, fused, batch, dbsnp_index, inflight, tfbs_index, \
+        sweep, presort, sort_memory, sites_only, cache_file, cache_bytes, \
+        reference_version, catalog_dir, sidecar_file, use_index = args
+    # a presorted shard goes back to its own order for mergeShards
+    run(shardfile, format, fused=fused, batch=batch, dbsnp_index=dbsnp_index,
+        inflight=inflight, tfbs_index=tfbs_index, sweep=sweep,
+        presort=presort, restore_order=True, sort_memory=sort_memory,
+        sites_only=sites_only, cache_file=cache_file,
+        cache_bytes=cache_bytes, reference_version=reference_version,
+        catalog_dir=catalog_dir, sidecar_file=sidecar_file,
+        use_index=use_index)
+    return annotatedName(shardfile)
+
+
+"""Annotate infile as shards of whole chromosomes (or position ranges of
+   large ones) in a pool of parallel worker processes, then interleave
+   the results in the original order and sum their counts
+   Returns False, leaving nothing behind, if the input does not split or
+   the shards cannot be merged line for line
+"""
+def runSharded(infile, format, finalout, parallel, fused=False, batch=False,
+    dbsnp_index=None, inflight=0, tfbs_index=None, sweep=False,
+    presort=False, sort_memory=es.SORT_MEMORY, sites_only=False,
+    cache_file=None, cache_bytes=vc.CACHE_BYTES, reference_version=None,
+    catalog_dir=None, sidecar_file=None, use_index=True):
+
+    inds = u.getFormatSpecificIndices(format=format)
+    header, keys = sharding.scanInput(infile, chr_ind=inds[0],
+        pos_ind=inds[1])
+    assignment, nshards = sharding.planShards(keys, parallel)
+    if (nshards < 2):
+        return False
+
+    directory = baseName(infile) + '.shards'
+    shutil.rmtree(directory, ignore_errors=True)
+    shardfiles = sharding.writeShards(infile, directory, header, assignment,
+        nshards)
+    with multiprocessing.Pool(min(parallel, nshards)) as pool:
+        outfiles = pool.map(runShard, [(f, format, fused, batch, dbsnp_index,
+            inflight, tfbs_index, sweep, presort, sort_memory, sites_only,
+            cache_file, cache_bytes, reference_version, catalog_dir,
+            sidecar_file, use_index) for f in shardfiles], chunksize=1)
+
+    merged = sharding.mergeShards(outfiles, finalout, len(header), assignment)
+    if merged:
+        sharding.mergeCountLogs([f + '.count.log' for f in shardfiles],
+            baseName(infile) + '.count.log')
+    else:
+        fu.delete(finalout)
+    shutil.rmtree(directory)
+    return merged
+
+
+"""Annotate infile and write <name>.annot.vcf and <name>.vcf.count.log
+   By default each stage reads the previous stage's intermediate file
+   (.1 through .14). With fused=True the input is read once, every record
+   goes through all stages in memory and only the final file is written;
+   the results are the same either way.
+   The reference tables the stages read most are held in memory (interval
+   indexes, coverage masks and the transcript model). With
+   use_index=False they are queried instead, like dbSNP without a dbSNP
+   index and tfbsConsSites without a tfbs index; then with batch=True the
+   stages resolve a chunk of records per statement, and with inflight > 0
+   the per-variant queries of each chunk run concurrently, on inflight
+   connections of their own (see async_lookup.py). Both only apply to stages that query
+   the database.
+   dbsnp_index is a directory built by dbsnp_index.py; when given, dbSNP
+   is looked up there instead of in the database. When the stages read a
+   reference snapshot (ANNOTATOR_SNAPSHOT_DIR), its dbSNP index is the
+   default. Database connection reuse is printed at the end.
+   With parallel > 1 the input is annotated as chromosome shards by that
+   many worker processes (see runSharded); the output is the same.
+   tfbs_index is a directory built by tfbs_index.py for the tfbsConsSites
+   stage, defaulting to the snapshot's like dbsnp_index.
+   With sweep=True the overlap stages join coordinate-sorted input
+   against their tables streamed in start order instead of holding the
+   tables in memory; unsorted input falls back to the usual lookups.
+   With presort=True the records are first sorted by (chrom, pos) with
+   at most about sort_memory bytes in memory (see external_sort.py), and
+   with restore_order=True the output is put back in the input order;
+   sharded runs always keep the input order.
+   A .vcf.gz input (gzip or BGZF) is read directly and annotated into a
+   BGZF <name>.annot.vcf.gz, as is any input with compress=True; sorted
+   output also gets a tabix index, <name>.annot.vcf.gz.tbi.
+   With sites_only=True the FORMAT and sample columns are set aside
+   before the first stage and put back after the last (see
+   sites_only.py), so the stages read and write only CHROM through INFO.
+   With a cache_file the stages keep what they add for each variant in
+   that variant cache (see variant_cache.py), at most cache_bytes of it,
+   and take it from there in later jobs on the same reference_version
+   (by default the snapshot's); the hit rate goes to the .count.log.
+   With a catalog_dir built by annotation_catalog.py for that reference
+   version, the stages take the fragments of known dbSNP sites from the
+   catalog and only look up novel variants.
+   With a sidecar_file the fragments every stage added are kept there,
+   tagged with the versions of the tables the stage read (see
+   fragment_sidecar.py). Annotating the input again with the same
+   sidecar_file, e.g. with reannotate() after a table was updated, looks
+   up only the stages whose tables changed; the others take their
+   fragments from the sidecar. Fragments kept and recomputed per stage
+   are printed at the end.
+   Returns the name of the output file
+"""
+def run(infile, format, fused=False, batch=False, dbsnp_index=None,
+    parallel=0, inflight=0, tfbs_index=None, sweep=False, presort=False,
+    restore_order=False, sort_memory=es.SORT_MEMORY, compress=False,
+    sites_only=False, cache_file=None, cache_bytes=vc.CACHE_BYTES,
+    reference_version=None, catalog_dir=None, sidecar_file=None,
+    use_index=True):
 
     print("Running . . .")
+    base = baseName(infile)
+    compress = compress or infile.endswith('.gz')
+    finalout = annotatedName(infile, compress)
+    pool_stats = db_pool.stats()
+
+    if (parallel > 1):
+        if runSharded(infile, format, finalout, parallel, fused=fused,
+            batch=batch, dbsnp_index=dbsnp_index, inflight=inflight,
+            tfbs_index=tfbs_index, sweep=sweep, presort=presort,
+            sort_memory=sort_memory, sites_only=sites_only,
+            cache_file=cache_file, cache_bytes=cache_bytes,
+            reference_version=reference_version, catalog_dir=catalog_dir,
+            sidecar_file=sidecar_file, use_index=use_index):
+            print("All shards - done.")
+            return finalout
+        print("Input cannot be sharded, running in one process . . .")
+
+    source = infile
+    if presort:
+        source = base + '.sorted'
+        inds = u.getFormatSpecificIndices(format=format)
+        es.sortVcf(infile, source, base + '.order', chr_ind=inds[0],
+            pos_ind=inds[1], memory=sort_memory)
+        print("Sort - done.")
+
+    sites = source
+    annotated = finalout
+    if sites_only:
+        sites = base + '.sites'
+        annotated = base + '.sites.annot'
+        count = so.splitSamples(source, sites, base + '.samples')
+
+    cache = openCache(cache_file, cache_bytes, reference_version)
+    catalog = openCatalog(catalog_dir, reference_version)
+    sidecar = openSidecar(sidecar_file, reference_version)
+    lookup = None
+    if (inflight > 0):
+        lookup = al.AsyncLookup(inflight=inflight)
+
+    if fused:
+        stages = [makeStage(base, format, cls, kwargs, batch=batch,
+            dbsnp_index=dbsnp_index, lookup=lookup, tfbs_index=tfbs_index,
+            sweep=sweep, cache=cache, catalog=catalog, sidecar=sidecar,
+            use_index=use_index) for (label, cls, kwargs) in STAGES]
+        ann.runStages(stages, sites, annotated)
+        print("All stages - done.")
+    else:
+        tmpin = sites
+        for (n, (label, cls, kwargs)) in enumerate(STAGES, 1):
+            stage = makeStage(base, format, cls, kwargs, batch=batch,
+                dbsnp_index=dbsnp_index, lookup=lookup,
+                tfbs_index=tfbs_index, sweep=sweep, cache=cache,
+                catalog=catalog, sidecar=sidecar, use_index=use_index)
+            tmpout = base + '.' + str(n)
+            if (n == len(STAGES)):
+                tmpout = annotated
+            ann.runStage(stage, tmpin, tmpout)
+            print(f"{label} - done.")
+            tmpin = tmpout
+
+        ## Cleanup
+        for n in range(1, len(STAGES)):
+            fu.delete(base + '.' + str(n))
+
+    if lookup is not None:
+        lookup.close()
+    if cache is not None:
+        with open(base + '.count.log', 'a') as fh_log:
+            fh_log.write(''.join([l + '\n' for l in cache.report()]))
+        cache.close()
+    if catalog is not None:
+        print(catalog.report())
+    if sidecar is not None:
+        print('\n'.join(sidecar.report()))
+        sidecar.close()
+
+    if sites_only:
+        so.mergeSamples(annotated, base + '.samples', finalout, count)
+        fu.delete(base + '.samples')
+        fu.delete(sites)
+        fu.delete(annotated)
+
+    if presort:
+        if restore_order:
+            restored = base + '.restored' + ('.gz' if compress else '')
+            if es.restoreOrder(finalout, base + '.order', restored,
+                memory=sort_memory):
+                os.replace(restored, finalout)
+                fu.delete(finalout + '.tbi')
+                if os.path.exists(restored + '.tbi'):
+                    os.replace(restored + '.tbi', finalout + '.tbi')
+            else:
+                print("Records were split, output left sorted.")
+        fu.delete(source)
+        fu.delete(base + '.order')
+
+    print(db_pool.report(pool_stats))
+    return finalout
+
+
+"""Fragment sidecar kept for infile by default
+"""
+def sidecarName(infile):
+    return baseName(infile) + '.fragments'
+
+
+"""Annotate infile again after reference tables were updated, splicing
+   the fragments of the updated stages into those kept in sidecar_file
+   (by default the sidecarName of infile) for the others
+   options are those of run(); the output is the same as that of a full
+   run on the current tables
+"""
+def reannotate(infile, format, sidecar_file=None, **options):
+    if sidecar_file is None:
+        sidecar_file = sidecarName(infile)
+    if not os.path.exists(sidecar_file):
+        print(f"No fragment sidecar {sidecar_file}, annotating in full.")
+    return run(infile, format, sidecar_file=sidecar_file, **options)
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ## Cleanup
-    for i in range(1, tmpextin):
-        fu.delete(infile + '.' + str(i))
-
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
-    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
-
-### EOF
\ No newline at end of file
+### EOF
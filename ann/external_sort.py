@@ -0,0 +1,234 @@
+# external_sort.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Bounded-memory external merge sort of VCF records by (chrom, pos)
+#
+# Records are collected until about `memory` bytes are buffered, sorted
+# and spilled to a run file next to the input; the runs are then merged
+# k ways. The record numbers of the sorted records are kept in an order
+# file, so the annotated output can be put back in the input order.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import heapq
+import shutil
+import tempfile
+from array import array
+
+import file_utils as fu
+
+# Bytes of records buffered before a run is spilled
+SORT_MEMORY = 256 * 1024 * 1024
+
+# Approximate bytes of Python objects held per buffered record, on top
+# of the text of the line
+RECORD_OVERHEAD = 200
+
+# Run files merged at once
+MERGE_FANIN = 64
+
+"""Sort key of a chromosome name: 1..22 numerically, then X, Y, M and
+   any others by name. 'chr1' and '1' sort together, as the stages look
+   them up as the same chromosome
+"""
+def chromKey(chrom):
+    if chrom.startswith('chr'):
+        chrom = chrom[3:]
+    if chrom.isdigit():
+        return (0, int(chrom), '')
+    return (1, 0, chrom)
+
+
+"""Sort key function of VCF records on (chrom, pos, record number)
+"""
+def recordKey(chr_ind=0, pos_ind=1):
+    def key(recno, line):
+        fields = line.split('\t', max(chr_ind, pos_ind) + 1)
+        try:
+            pos = int(fields[pos_ind])
+        except (IndexError, ValueError):
+            pos = 0
+        chrom = ''
+        if (len(fields) > chr_ind):
+            chrom = fields[chr_ind].strip()
+        return (chromKey(chrom), pos, recno)
+    return key
+
+
+"""Key function ordering records by record number
+"""
+def recnoKey(recno, line):
+    return recno
+
+
+def writeRun(records, directory, n):
+    path = os.path.join(directory, 'run' + str(n))
+    with open(path, 'w') as fh:
+        for (recno, line) in records:
+            fh.write(str(recno) + '\t' + line + '\n')
+    return path
+
+
+def readRun(path):
+    with open(path) as fh:
+        for text in fh:
+            recno, line = text.rstrip('\n').split('\t', 1)
+            yield (int(recno), line)
+
+
+def mergeRuns(paths, key):
+    return heapq.merge(*[readRun(path) for path in paths],
+        key=lambda r: key(r[0], r[1]))
+
+
+"""Sort (record number, line) pairs with bounded memory
+   Yields the pairs in key order. Runs are written to directory and
+   removed once merged
+"""
+def sortRecords(records, key, directory, memory=SORT_MEMORY,
+    fanin=MERGE_FANIN):
+
+    runs = []
+    buffer = []
+    size = 0
+    for (recno, line) in records:
+        buffer.append((key(recno, line), recno, line))
+        size = size + len(line) + RECORD_OVERHEAD
+        if (size >= memory):
+            buffer.sort()
+            runs.append(writeRun([(r, l) for (k, r, l) in buffer], directory,
+                len(runs)))
+            buffer = []
+            size = 0
+
+    buffer.sort()
+    if (len(runs) == 0):
+        for (k, recno, line) in buffer:
+            yield (recno, line)
+        return
+    if (len(buffer) > 0):
+        runs.append(writeRun([(r, l) for (k, r, l) in buffer], directory,
+            len(runs)))
+    buffer = []
+
+    n = len(runs)
+    while (len(runs) > fanin):
+        merged = []
+        for i in range(0, len(runs), fanin):
+            group = runs[i:i + fanin]
+            merged.append(writeRun(mergeRuns(group, key), directory, n))
+            n = n + 1
+            for path in group:
+                os.remove(path)
+        runs = merged
+
+    for record in mergeRuns(runs, key):
+        yield record
+    for path in runs:
+        os.remove(path)
+
+
+"""Split the leading header lines of a file from its records
+   Returns (header lines, iterator of (record number, line))
+"""
+def readRecords(fh):
+    header = []
+    first = None
+    for text in fh:
+        line = text.rstrip('\n')
+        if not line.startswith('#'):
+            first = line
+            break
+        header.append(line)
+
+    def records():
+        if first is None:
+            return
+        yield (0, first)
+        recno = 1
+        for text in fh:
+            yield (recno, text.rstrip('\n'))
+            recno = recno + 1
+    return (header, records())
+
+
+"""Sort the records of infile by (chrom, pos) into outfile
+   The header lines stay at the top. Records at the same position keep
+   their input order. The input record number of every sorted record is
+   written to orderfile (uint64), for restoreOrder()
+"""
+def sortVcf(infile, outfile, orderfile, chr_ind=0, pos_ind=1,
+    memory=SORT_MEMORY):
+
+    directory = tempfile.mkdtemp(prefix='sort.',
+        dir=os.path.dirname(os.path.abspath(outfile)))
+    try:
+        with fu.openFile(infile) as fh, open(outfile, 'w') as fh_out, \
+            open(orderfile, 'wb') as fh_order:
+            header, records = readRecords(fh)
+            for line in header:
+                fh_out.write(line + '\n')
+            order = array('Q')
+            for (recno, line) in sortRecords(records,
+                recordKey(chr_ind, pos_ind), directory, memory=memory):
+                fh_out.write(line + '\n')
+                order.append(recno)
+                if (len(order) >= 100000):
+                    order.tofile(fh_order)
+                    order = array('Q')
+            order.tofile(fh_order)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+"""Read the record numbers of an order file a block at a time
+"""
+def readOrder(orderfile, block=100000):
+    with open(orderfile, 'rb') as fh:
+        while True:
+            order = array('Q')
+            try:
+                order.fromfile(fh, block)
+            except EOFError:
+                pass
+            for recno in order:
+                yield recno
+            if (len(order) < block):
+                return
+
+
+"""Put the records of a file sorted by sortVcf() (or annotated from
+   one) back in input order, from sortedfile into outfile
+   Returns False, writing nothing, if the file no longer has one line per
+   sorted record
+"""
+def restoreOrder(sortedfile, orderfile, outfile, memory=SORT_MEMORY):
+    count = os.path.getsize(orderfile) // array('Q').itemsize
+    with fu.openFile(sortedfile) as fh:
+        header, records = readRecords(fh)
+        lines = sum(1 for r in records)
+    if (lines != count):
+        return False
+
+    directory = tempfile.mkdtemp(prefix='sort.',
+        dir=os.path.dirname(os.path.abspath(outfile)))
+    try:
+        with fu.openFile(sortedfile) as fh, \
+            fu.openFile(outfile, 'w', index=True) as fh_out:
+            header, records = readRecords(fh)
+            for line in header:
+                fh_out.write(line + '\n')
+            numbered = zip(readOrder(orderfile),
+                (line for (i, line) in records))
+            for (recno, line) in sortRecords(numbered, recnoKey, directory,
+                memory=memory):
+                fh_out.write(line + '\n')
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return True
+
+### EOF
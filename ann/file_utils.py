@@ -19,6 +19,8 @@ import sys
 
 import itertools, operator
 
+import bgzf
+
 """Execute command
 """
 def execute(com, debug=False):
@@ -91,6 +93,17 @@ def delete(filename):
         os.unlink(filename)
 
 
+"""Opens a text file; .gz files are read as gzip and written as BGZF,
+   with a tabix index when index=True
+"""
+def openFile(filename, mode='r', index=False):
+    if not filename.endswith('.gz'):
+        return open(filename, mode)
+    if mode.startswith('r'):
+        return bgzf.openText(filename)
+    return bgzf.IndexedWriter(filename, index=index)
+
+
 """Makes directory if it does not exist
 """
 def mkdirp(directory):
@@ -0,0 +1,124 @@
+# fragment_sidecar.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Per-result sidecar of the fragments each stage contributed
+#
+# While a file is annotated, what every stage adds for each variant is
+# kept in a SQLite sidecar next to the result, tagged with the version of
+# the reference tables the stage read: the content digests of a snapshot
+# (see snapshot.py), or the reference version. Without a snapshot, a
+# reference version "<version>; <table>=<version>; ..." gives the listed
+# tables versions of their own, so that bumping one of them only changes
+# the stages that read it. When the file is annotated
+# again with the sidecar, e.g. after one table was refreshed, the stages
+# whose tables are unchanged take their fragments from it and only the
+# others look their variants up; the sidecar is then brought up to date.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import hashlib
+import sqlite3
+
+import snapshot
+
+# Keys per statement
+KEY_CHUNK = 500
+
+"""Reference version and per-table versions of a reference version
+   "<version>; <table>=<version>; ...", (version, {table: version})
+"""
+def splitVersion(version):
+    parts = [part.strip() for part in str(version).split(';')]
+    tables = {}
+    for part in parts[1:]:
+        if ('=' in part):
+            table, value = part.split('=', 1)
+            tables[table.strip()] = value.strip()
+    return (parts[0], tables)
+
+
+"""Version of a stage: the versions of its tables, from the snapshot in
+   use if it has them, from version's per-table versions, and version's
+   reference version otherwise
+"""
+def stageVersion(tables, version):
+    base, table_versions = splitVersion(version)
+    versions = [snapshot.tableVersion(table) or
+        table_versions.get(table, base) for table in tables]
+    return hashlib.sha256('\n'.join(versions).encode('utf-8')).hexdigest()[:16]
+
+
+"""A sidecar file, for the stages tracked in it
+"""
+class FragmentSidecar(object):
+    def __init__(self, path, version):
+        self.version = str(version)
+        self.versions = {}
+        self.reused = {}
+        self.computed = {}
+        self.pending = []
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('create table if not exists fragments ' + \
+            '(name text, version text, key text, value text, ' + \
+            'primary key (name, key))')
+        self.conn.commit()
+
+    """Track a stage by its cache name and the tables it reads
+    """
+    def track(self, name, tables):
+        self.versions[name] = stageVersion(tables, self.version)
+        self.reused.setdefault(name, 0)
+        self.computed.setdefault(name, 0)
+
+    """Fragments of a stage kept for keys by the same version of the
+       stage, {key: fragment}
+    """
+    def get(self, name, keys):
+        found = {}
+        unique = list(set(keys))
+        for i in range(0, len(unique), KEY_CHUNK):
+            chunk = unique[i:i + KEY_CHUNK]
+            marks = ', '.join(['?'] * len(chunk))
+            for (key, value) in self.conn.execute('select key, value ' + \
+                'from fragments where name = ? and version = ? ' + \
+                'and key in (' + marks + ')',
+                [name, self.versions[name]] + chunk):
+                found[key] = json.loads(value)
+        self.reused[name] = self.reused[name] + len(found)
+        return found
+
+    def add(self, name, key, fragment):
+        self.pending.append((name, self.versions[name], key,
+            json.dumps(fragment)))
+        self.computed[name] = self.computed[name] + 1
+
+    def flush(self):
+        if (len(self.pending) > 0):
+            self.conn.executemany('insert or replace into fragments ' + \
+                'values (?, ?, ?, ?)', self.pending)
+            self.conn.commit()
+            self.pending = []
+
+    """Reused and recomputed fragments per stage
+    """
+    def report(self):
+        return [f"{name}: {str(self.reused[name])} fragments kept, " + \
+            f"{str(self.computed[name])} recomputed"
+            for name in self.versions]
+
+    """Write what is pending and drop the fragments of other versions of
+       the tracked stages
+    """
+    def close(self):
+        self.flush()
+        for (name, version) in self.versions.items():
+            self.conn.execute('delete from fragments where name = ? ' + \
+                'and version != ?', (name, version))
+        self.conn.commit()
+        self.conn.close()
+
+### EOF
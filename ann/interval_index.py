@@ -0,0 +1,154 @@
+# interval_index.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# In-memory interval index for the reference database overlap stages
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+from bisect import bisect_right
+
+"""Per-chromosome index of closed [start, end] intervals
+   Answers 'start <= pos AND pos <= end' without a database round trip.
+   Intervals are kept sorted by start together with a running maximum
+   of the end coordinate, so a lookup is one bisect followed by a short
+   backwards scan. Matching rows are returned in the order the table was
+   read. SQL leaves that order undefined, as it does for the rows of the
+   equivalent per-variant query, so from MySQL a variant with several
+   hits may list them in another order than the query would.
+"""
+class IntervalIndex(object):
+    def __init__(self):
+        self.pending = {}
+        self.chroms = {}
+        self.count = 0
+
+    def add(self, chrom, start, end, row):
+        if (start is None) or (end is None):
+            return
+        self.pending.setdefault(chrom, []).append(
+            (int(start), int(end), self.count, row))
+        self.count = self.count + 1
+
+    def build(self):
+        for chrom, intervals in self.pending.items():
+            intervals.sort(key=lambda x: (x[0], x[2]))
+            starts = []
+            ends = []
+            maxends = []
+            seqs = []
+            rows = []
+            maxend = None
+            for (start, end, seq, row) in intervals:
+                if (maxend is None) or (end > maxend):
+                    maxend = end
+                starts.append(start)
+                ends.append(end)
+                maxends.append(maxend)
+                seqs.append(seq)
+                rows.append(row)
+            self.chroms[chrom] = (starts, ends, maxends, seqs, rows)
+        self.pending = {}
+        return self
+
+    def overlap(self, chrom, pos):
+        return self.overlapRange(chrom, int(pos), int(pos))
+
+    """Rows of the intervals with start <= high and low <= end
+    """
+    def overlapRange(self, chrom, low, high):
+        if chrom not in self.chroms:
+            return []
+        starts, ends, maxends, seqs, rows = self.chroms[chrom]
+        hits = []
+        i = bisect_right(starts, high) - 1
+        while (i >= 0) and (maxends[i] >= low):
+            if (ends[i] >= low):
+                hits.append((seqs[i], rows[i]))
+            i = i - 1
+        hits.sort(key=lambda x: x[0])
+        return [row for (seq, row) in hits]
+
+    """Span (lo, hi) of positions around pos overlapped by the same
+       intervals as pos; a bound of None is open
+       Within it no interval starts after pos and none ends before it
+    """
+    def span(self, chrom, pos):
+        if chrom not in self.chroms:
+            return (None, None)
+        starts, ends, maxends, seqs, rows = self.chroms[chrom]
+        pos = int(pos)
+        i = bisect_right(starts, pos) - 1
+        lo = None
+        hi = None
+        if (i >= 0):
+            lo = starts[i]
+        if (i + 1 < len(starts)):
+            hi = starts[i + 1] - 1
+        while (i >= 0) and (maxends[i] >= pos):
+            if (ends[i] >= pos):
+                if (hi is None) or (ends[i] < hi):
+                    hi = ends[i]
+            elif (ends[i] + 1 > lo):
+                lo = ends[i] + 1
+            i = i - 1
+        if (i >= 0) and (maxends[i] + 1 > lo):
+            lo = maxends[i] + 1
+        return (lo, hi)
+
+    def first(self, chrom, pos):
+        rows = self.overlap(chrom, pos)
+        if (len(rows) > 0):
+            return rows[0]
+        return None
+
+
+"""Load a whole reference table into an IntervalIndex
+   Columns are located by name so that full rows (select *) are kept
+   and the stages can keep using their positional column indices;
+   columns=[...] keeps just those columns, like the stage's own select
+"""
+def buildIndex(cursor, table, chromName='chrom', startName='chromStart',
+    endName='chromEnd', columns=None, chunk=10000):
+
+    cursor.execute('select * from ' + table + ';')
+    names = [str(d[0]) for d in cursor.description]
+    chr_ind = names.index(chromName)
+    start_ind = names.index(startName)
+    end_ind = names.index(endName)
+    keep = None
+    if columns is not None:
+        keep = [names.index(name) for name in columns]
+
+    index = IntervalIndex()
+    rows = cursor.fetchmany(chunk)
+    while (len(rows) > 0):
+        for row in rows:
+            kept = row
+            if keep is not None:
+                kept = tuple([row[i] for i in keep])
+            index.add(str(row[chr_ind]), row[start_ind], row[end_ind], kept)
+        rows = cursor.fetchmany(chunk)
+
+    return index.build()
+
+
+_indexes = {}
+
+"""Get the index for a table, building it on first use
+   Indices are kept for the life of the process, so each reference
+   table is read only once per annotation job
+"""
+def getIndex(cursor, table, chromName='chrom', startName='chromStart',
+    endName='chromEnd', columns=None):
+
+    key = (table, chromName, startName, endName,
+        None if columns is None else tuple(columns))
+    if key not in _indexes:
+        _indexes[key] = buildIndex(cursor, table, chromName=chromName,
+            startName=startName, endName=endName, columns=columns)
+    return _indexes[key]
+
+### EOF
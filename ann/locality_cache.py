@@ -0,0 +1,66 @@
+# locality_cache.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Locality cache for the overlap stages
+#
+# In sorted input neighbouring variants mostly fall in the same cytoband,
+# gene, segdup or CNV region, and the records of a split multi-allelic
+# site share one position. A stage's last result is kept together with
+# the span of positions around it where the overlapping rows, and so the
+# result, stay the same, and the next position inside that span is
+# answered without a lookup.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+"""The last result of a stage and the span [lo, hi] of its chromosome
+   where it holds; a bound of None is open
+"""
+class LocalityCache(object):
+    def __init__(self):
+        self.chrom = None
+        self.lo = None
+        self.hi = None
+        self.value = None
+        self.hits = 0
+        self.lookups = 0
+
+    """Whether the kept result holds at pos; value is then the result
+    """
+    def covers(self, chrom, pos):
+        self.lookups = self.lookups + 1
+        if (chrom != self.chrom):
+            return False
+        if (self.lo is not None) and (pos < self.lo):
+            return False
+        if (self.hi is not None) and (pos > self.hi):
+            return False
+        self.hits = self.hits + 1
+        return True
+
+    def keep(self, chrom, span, value):
+        self.chrom = chrom
+        self.lo, self.hi = span
+        self.value = value
+
+    def hitRate(self):
+        if (self.lookups == 0):
+            return 0.0
+        return (self.hits / float(self.lookups)) * 100
+
+    def report(self, label):
+        return f"{str(label)} locality cache: {str(self.hits)} of " + \
+            f"{str(self.lookups)} lookups ({str(self.hitRate())}%)"
+
+
+"""Intersection of spans, each (lo, hi) with None for an open bound
+"""
+def intersect(spans):
+    lows = [lo for (lo, hi) in spans if lo is not None]
+    highs = [hi for (lo, hi) in spans if hi is not None]
+    return (max(lows) if (len(lows) > 0) else None,
+        min(highs) if (len(highs) > 0) else None)
+
+### EOF
@@ -0,0 +1,115 @@
+# overlap_engine.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Vectorized point-in-interval lookups for a block of VCF records
+#
+# numpy is optional: without it available() is False and the overlap
+# stages look up one record at a time in the interval index.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""True if numpy can be imported
+"""
+def available():
+    return (np is not None)
+
+
+"""numpy arrays over the per-chromosome lists of an IntervalIndex
+   Converted on first use of each chromosome and kept with the index
+"""
+class VectorIndex(object):
+    def __init__(self, index):
+        self.index = index
+        self.chroms = {}
+
+    def arrays(self, chrom):
+        if chrom not in self.chroms:
+            starts, ends, maxends, seqs, rows = self.index.chroms[chrom]
+            self.chroms[chrom] = (np.array(starts, dtype=np.int64),
+                np.array(ends, dtype=np.int64),
+                np.array(maxends, dtype=np.int64),
+                np.array(seqs, dtype=np.int64), rows)
+        return self.chroms[chrom]
+
+    """Hits of an array of positions on one chromosome
+       Returns (records, intervals): position and interval numbers of
+       every hit, ordered by position number and then table order.
+       searchsorted finds the last interval starting at or before each
+       position; the backwards scan that follows is done for all the
+       positions at once, one step per iteration, and a position drops
+       out as soon as the running maximum end falls below it
+    """
+    def overlapBlock(self, chrom, positions):
+        starts, ends, maxends, seqs, rows = self.arrays(chrom)
+        cur = np.searchsorted(starts, positions, side='right') - 1
+        recs = np.arange(len(positions))
+        live = (cur >= 0)
+        recs = recs[live]
+        cur = cur[live]
+
+        hit_recs = []
+        hit_ints = []
+        while (len(cur) > 0):
+            pos = positions[recs]
+            live = (maxends[cur] >= pos)
+            recs = recs[live]
+            cur = cur[live]
+            pos = pos[live]
+            hit = (ends[cur] >= pos)
+            hit_recs.append(recs[hit])
+            hit_ints.append(cur[hit])
+            cur = cur - 1
+            live = (cur >= 0)
+            recs = recs[live]
+            cur = cur[live]
+
+        if (len(hit_recs) == 0):
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        recs = np.concatenate(hit_recs)
+        ints = np.concatenate(hit_ints)
+        order = np.lexsort((seqs[ints], recs))
+        return (recs[order], ints[order])
+
+    """Rows overlapping each of a block of (chrom, pos) keys
+       Returns {(chrom, pos): [row, ...]} for the keys with hits only, so
+       rows are gathered (and INFO text formatted) just for those
+    """
+    def lookupBlock(self, keys):
+        bychrom = {}
+        for (chrom, pos) in keys:
+            if chrom in self.index.chroms:
+                bychrom.setdefault(chrom, []).append(pos)
+
+        found = {}
+        for chrom, positions in bychrom.items():
+            positions = np.unique(np.array(positions, dtype=np.int64))
+            recs, ints = self.overlapBlock(chrom, positions)
+            if (len(recs) == 0):
+                continue
+            rows = self.arrays(chrom)[4]
+            bounds = np.searchsorted(recs, np.arange(len(positions) + 1))
+            for j in np.flatnonzero(bounds[1:] > bounds[:-1]).tolist():
+                found[(chrom, int(positions[j]))] = [rows[i] for i in
+                    ints[bounds[j]:bounds[j + 1]].tolist()]
+        return found
+
+
+_indexes = {}
+
+"""Get the VectorIndex of an IntervalIndex
+"""
+def getIndex(index):
+    key = id(index)
+    if key not in _indexes:
+        _indexes[key] = VectorIndex(index)
+    return _indexes[key]
+
+### EOF
@@ -0,0 +1,76 @@
+# position_index.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# In-memory hash index on (chromosome, position) for the
+# chrom_pos_equal_* tables read by getBigRefGene
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+"""Rows of a table keyed on exact (chrom, position)
+   The key is packed into one integer, chromosome code in the high bits
+   and position in the low 32, so the table is a single dict of ints.
+   Rows at a key keep their table order
+"""
+class PositionIndex(object):
+    def __init__(self, names):
+        self.names = names
+        self.codes = {}
+        self.rows = {}
+
+    def pack(self, chrom, pos):
+        code = self.codes.get(chrom)
+        if code is None:
+            return None
+        return (code << 32) | int(pos)
+
+    def add(self, chrom, pos, row):
+        if (pos is None):
+            return
+        if chrom not in self.codes:
+            self.codes[chrom] = len(self.codes)
+        key = self.pack(chrom, pos)
+        rows = self.rows.get(key)
+        if rows is None:
+            self.rows[key] = [row]
+        else:
+            rows.append(row)
+
+    def lookup(self, chrom, pos):
+        key = self.pack(chrom, pos)
+        if key is None:
+            return []
+        return self.rows.get(key, [])
+
+
+"""Load a whole table into a PositionIndex
+"""
+def buildIndex(cursor, table, chromName='CHR', posName='start', chunk=10000):
+    cursor.execute('select * from ' + table + ';')
+    names = [str(d[0]) for d in cursor.description]
+    chr_ind = names.index(chromName)
+    pos_ind = names.index(posName)
+
+    index = PositionIndex(names)
+    rows = cursor.fetchmany(chunk)
+    while (len(rows) > 0):
+        for row in rows:
+            index.add(str(row[chr_ind]), row[pos_ind], row)
+        rows = cursor.fetchmany(chunk)
+    return index
+
+
+_indexes = {}
+
+"""Get the index for a table, building it on first use
+"""
+def getIndex(cursor, table, chromName='CHR', posName='start'):
+    key = (table, chromName, posName)
+    if key not in _indexes:
+        _indexes[key] = buildIndex(cursor, table, chromName=chromName,
+            posName=posName)
+    return _indexes[key]
+
+### EOF
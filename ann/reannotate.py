@@ -0,0 +1,134 @@
+# reannotate.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Re-annotate completed jobs after reference tables were updated
+#
+# python reannotate.py <job_id> [<job_id> ...]
+#
+# For each job, the input is downloaded from the inputs bucket and the
+# fragment sidecar uploaded with its result (FragmentSidecar) from the
+# results bucket. driver.reannotate() then looks up only the stages whose
+# tables changed, and the new result, log and sidecar replace those of
+# the job. A job without a sidecar is annotated in full.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import time
+import shutil
+import boto3
+from botocore.exceptions import ClientError
+from pathlib import Path
+
+import driver
+import result_reuse as rr
+import snapshot
+# the [ann] settings and upload_file() of run.py
+import run
+
+s3_client = boto3.client('s3', region_name=run.REGION)
+dynamodb = boto3.resource('dynamodb', region_name=run.REGION)
+ann_table = dynamodb.Table(run.DYNAMO_DB_TABLE)
+
+
+"""Download an object, False if it does not exist
+"""
+def download_file(bucket, key, filepath):
+    try:
+        s3_client.download_file(bucket, key, filepath)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return False
+        raise
+    return True
+
+
+"""Re-annotate one completed job and replace its result files
+Returns False if the job cannot be re-annotated
+"""
+def reannotate_job(job_id):
+    item = ann_table.get_item(Key={'job_id': job_id}).get('Item')
+    if (item is None) or (item.get('job_status') != 'COMPLETED'):
+        print(f"{job_id} is not a completed job, skipped")
+        return False
+
+    admin_id = item['s3_key_input_file'].split('/')[0]
+    prefix = f"{admin_id}/{item['user_id']}/{job_id}/"
+    directory = f"{run.ANNOTATOR_JOBS_DIR}{prefix}"
+    shutil.rmtree(directory, ignore_errors=True)
+    Path(directory).mkdir(parents=True, exist_ok=True)
+
+    filepath = directory + item['input_file_name']
+    if not download_file(item['s3_inputs_bucket'],
+        item['s3_key_input_file'], filepath):
+        print(f"Input of {job_id} not found, skipped")
+        shutil.rmtree(directory)
+        return False
+
+    sidecar_file = driver.sidecarName(filepath)
+    sidecar_key = item.get('s3_key_fragments_file',
+        prefix + os.path.basename(sidecar_file))
+    download_file(run.RESULT_BUCKET_NAME, sidecar_key, sidecar_file)
+
+    with run.Timer():
+        finalout = driver.reannotate(filepath, 'vcf',
+            **run.pipeline_options(sidecar_file))
+
+    # the files replace those of the job, under the names run.py uses
+    uploads = [(finalout, 's3_key_result_file',
+            prefix + os.path.basename(finalout)),
+        (finalout + '.tbi', 's3_key_index_file',
+            prefix + os.path.basename(finalout) + '.tbi'),
+        (driver.baseName(filepath) + '.count.log', 's3_key_log_file',
+            prefix + rr.logName(item['input_file_name'])),
+        (sidecar_file, 's3_key_fragments_file', sidecar_key)]
+    keys = {}
+    for (local, field, key) in uploads:
+        if os.path.exists(local):
+            if not run.upload_file(local, run.RESULT_BUCKET_NAME, key):
+                print(f"Upload of {key} failed, {job_id} left as it was")
+                return False
+            keys[field] = key
+
+    values = {':t': int(time.time()),
+        ':krf': keys['s3_key_result_file'],
+        ':klf': keys['s3_key_log_file']}
+    update = """SET reannotate_time = :t,
+                    s3_key_result_file = :krf,
+                    s3_key_log_file = :klf"""
+    if 's3_key_fragments_file' in keys:
+        values[':kff'] = keys['s3_key_fragments_file']
+        update = update + ", s3_key_fragments_file = :kff"
+
+    # the result is now that of the current pipeline, and reusable as such
+    pipeline = rr.pipelineDescription(run.config,
+        run.REFERENCE_VERSION or snapshot.snapshotVersion())
+    if pipeline is not None:
+        values[':h'] = rr.fileHash(filepath, pipeline)
+        update = update + ", content_hash = :h"
+    ann_table.update_item(Key={'job_id': job_id},
+        ExpressionAttributeValues=values, UpdateExpression=update)
+    if pipeline is not None:
+        rr.recordResult(s3_client, run.RESULT_BUCKET_NAME, values[':h'],
+            job_id, keys)
+
+    shutil.rmtree(directory)
+    print(f"{job_id} - re-annotated.")
+    return True
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python reannotate.py <job_id> [<job_id> ...]")
+        sys.exit(1)
+    failed = [job_id for job_id in sys.argv[1:]
+        if not reannotate_job(job_id)]
+    if (len(failed) > 0):
+        print(f"Not re-annotated: {' '.join(failed)}")
+        sys.exit(1)
+
+### EOF
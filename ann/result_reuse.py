@@ -0,0 +1,152 @@
+# result_reuse.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Content-addressed reuse of annotation job results
+#
+# A job's result depends only on its input file, the reference data, the
+# annotator code and the pipeline settings, so it is addressed by the
+# SHA-256 of the input followed by a JSON description of the others. When a job completes,
+# a pointer to its result and log is kept in the results bucket under
+# reuse/<hash>.json. A later job with the same hash has the files copied
+# under its own keys instead of being annotated. The check is made by
+# annotator.py once it has downloaded the input, so submitting a job is
+# not slowed down by hashing it.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import json
+import hashlib
+from botocore.exceptions import ClientError
+
+import driver
+
+REUSE_PREFIX = 'reuse/'
+
+# [ann] settings that can change what a job writes; the others, e.g.
+# FusedPipeline, ParallelShards or SitesOnly, only change how it is
+# computed
+PIPELINE_SETTINGS = ['PresortInput', 'RestoreOrder', 'CompressOutput']
+
+# Bytes of the input hashed at a time
+HASH_CHUNK = 1024 * 1024
+
+"""Version of the annotator code: the SHA-256 of the Python files next
+   to this one, so results of other code are not reused
+"""
+def codeVersion():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.py'):
+            digest.update(name.encode('utf-8') + b'\0')
+            with open(os.path.join(directory, name), 'rb') as fh:
+                digest.update(fh.read())
+    return digest.hexdigest()
+
+
+"""Description of the reference version, the code version and the
+   pipeline settings of config, None without a reference version: results
+   on live reference tables cannot be told apart from those of other
+   versions
+"""
+def pipelineDescription(config, version):
+    if not version:
+        return None
+    return {'reference_version': str(version),
+        'code_version': codeVersion(),
+        'settings': dict([(name, config.get('ann', name, fallback=''))
+            for name in PIPELINE_SETTINGS])}
+
+
+"""Content hash of chunks of input bytes and a pipeline description
+"""
+def contentHash(chunks, pipeline):
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        digest.update(chunk)
+    digest.update(b'\0')
+    digest.update(json.dumps(pipeline, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def fileChunks(path):
+    with open(path, 'rb') as fh:
+        chunk = fh.read(HASH_CHUNK)
+        while (len(chunk) > 0):
+            yield chunk
+            chunk = fh.read(HASH_CHUNK)
+
+
+def fileHash(path, pipeline):
+    return contentHash(fileChunks(path), pipeline)
+
+
+def pointerKey(content_hash):
+    return REUSE_PREFIX + content_hash + '.json'
+
+
+"""Name run.py gives the .count.log of a job with input input_file_name
+"""
+def logName(input_file_name):
+    return input_file_name.split('.')[0] + '.vcf.count.log'
+
+
+"""Names run.py gives the files of a job with input input_file_name, by
+   pointer field; compress as the result was written
+"""
+def resultNames(input_file_name, compress=False):
+    result = os.path.basename(driver.annotatedName(input_file_name,
+        compress))
+    return {'s3_key_result_file': result,
+        's3_key_index_file': result + '.tbi',
+        's3_key_log_file': logName(input_file_name),
+        's3_key_fragments_file': os.path.basename(
+            driver.sidecarName(input_file_name))}
+
+
+"""The pointer of a completed result with the hash, None if there is none
+"""
+def findResult(s3, bucket, content_hash):
+    try:
+        response = s3.get_object(Bucket=bucket, Key=pointerKey(content_hash))
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+
+"""Copy the files of a pointer under prefix, named as run.py names the
+   files of a job with input input_file_name
+   Returns {pointer field: new key}, or None if a file is gone (e.g.
+   archived), in which case the job has to be annotated
+"""
+def copyResult(s3, bucket, pointer, prefix, input_file_name):
+    names = resultNames(input_file_name,
+        pointer['keys']['s3_key_result_file'].endswith('.gz'))
+    keys = {}
+    try:
+        for (field, key) in pointer['keys'].items():
+            target = prefix + names.get(field, os.path.basename(key))
+            s3.copy_object(Bucket=bucket, Key=target,
+                CopySource={'Bucket': bucket, 'Key': key})
+            keys[field] = target
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    return keys
+
+
+"""Point the hash at the files of a completed job
+"""
+def recordResult(s3, bucket, content_hash, job_id, keys):
+    pointer = {'job_id': job_id, 'keys': keys}
+    s3.put_object(Bucket=bucket, Key=pointerKey(content_hash),
+        Body=json.dumps(pointer).encode('utf-8'))
+
+### EOF
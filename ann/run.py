@@ -17,6 +17,7 @@ from botocore.exceptions import ClientError
 import os
 import json
 from configparser import ConfigParser
+import result_reuse as rr
 
 config = ConfigParser(os.environ)
 config.read('ann_config.ini')
@@ -26,6 +27,32 @@ RESULT_BUCKET_NAME = config['s3']['ResultBucketName']
 REGION = config['aws']['AwsRegionName']
 ANNOTATOR_BASE_DIR = config['ann']['AnnotatorBaseDir']
 ANNOTATOR_JOBS_DIR = config['ann']['AnnotatorJobsDir']
+FUSED_PIPELINE = config.getboolean('ann', 'FusedPipeline', fallback=False)
+BATCH_LOOKUPS = config.getboolean('ann', 'BatchLookups', fallback=False)
+IN_MEMORY_INDEXES = config.getboolean('ann', 'InMemoryIndexes',
+    fallback=True)
+DBSNP_INDEX_DIR = config.get('ann', 'DbSnpIndexDir', fallback='') or None
+TFBS_INDEX_DIR = config.get('ann', 'TfbsIndexDir', fallback='') or None
+PARALLEL_SHARDS = config.getint('ann', 'ParallelShards', fallback=0)
+CONCURRENT_LOOKUPS = config.getint('ann', 'ConcurrentLookups', fallback=0)
+SWEEP_JOIN = config.getboolean('ann', 'SweepJoin', fallback=False)
+PRESORT_INPUT = config.getboolean('ann', 'PresortInput', fallback=False)
+RESTORE_ORDER = config.getboolean('ann', 'RestoreOrder', fallback=False)
+SORT_MEMORY_MB = config.getint('ann', 'SortMemoryMB', fallback=256)
+COMPRESS_OUTPUT = config.getboolean('ann', 'CompressOutput', fallback=False)
+SITES_ONLY = config.getboolean('ann', 'SitesOnly', fallback=False)
+VARIANT_CACHE_FILE = config.get('ann', 'VariantCacheFile', fallback='') or \
+    None
+VARIANT_CACHE_MB = config.getint('ann', 'VariantCacheMB', fallback=1024)
+REFERENCE_VERSION = config.get('ann', 'ReferenceVersion', fallback='') or None
+ANNOTATION_CATALOG_DIR = config.get('ann', 'AnnotationCatalogDir',
+    fallback='') or None
+FRAGMENT_SIDECAR = config.getboolean('ann', 'FragmentSidecar',
+    fallback=False)
+REFERENCE_SNAPSHOT_DIR = config.get('ann', 'ReferenceSnapshotDir',
+    fallback='')
+if REFERENCE_SNAPSHOT_DIR:
+    os.environ['ANNOTATOR_SNAPSHOT_DIR'] = REFERENCE_SNAPSHOT_DIR
 DYNAMO_DB_TABLE = config['dynamodb']['DynamoDBTable']
 SNS_JOB_RESULT_TOPIC = config['sns']['SnsJobResultTopic']
 SNS_MESSAGE_STRUCTURE = config['sns']['SnsMessageStructure']
@@ -61,11 +88,30 @@ def upload_file(file_name, bucket, object_name=None):
   return True
 
 
+"""Keyword arguments of driver.run() for the [ann] settings
+"""
+def pipeline_options(sidecar_file=None):
+  return dict(fused=FUSED_PIPELINE, batch=BATCH_LOOKUPS,
+    use_index=IN_MEMORY_INDEXES, dbsnp_index=DBSNP_INDEX_DIR,
+    parallel=PARALLEL_SHARDS, inflight=CONCURRENT_LOOKUPS,
+    tfbs_index=TFBS_INDEX_DIR, sweep=SWEEP_JOIN, presort=PRESORT_INPUT,
+    restore_order=RESTORE_ORDER, sort_memory=SORT_MEMORY_MB * 1024 * 1024,
+    compress=COMPRESS_OUTPUT, sites_only=SITES_ONLY,
+    cache_file=VARIANT_CACHE_FILE,
+    cache_bytes=VARIANT_CACHE_MB * 1024 * 1024,
+    reference_version=REFERENCE_VERSION,
+    catalog_dir=ANNOTATION_CATALOG_DIR, sidecar_file=sidecar_file)
+
+
 if __name__ == '__main__':
   # Call the AnnTools pipeline
     if len(sys.argv) > 1:
+        sidecar_file = None
+        if FRAGMENT_SIDECAR:
+          sidecar_file = driver.sidecarName(sys.argv[1])
         with Timer():
-            driver.run(sys.argv[1], 'vcf')
+            finalout = driver.run(sys.argv[1], 'vcf',
+                **pipeline_options(sidecar_file))
         # Add code here:
         # 1. Upload the results file to S3 results bucket
         # # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
@@ -75,24 +121,36 @@ if __name__ == '__main__':
         filepath = sys.argv[1]
         filepath_parts = filepath.split("/")
         input_filename = filepath[9]
-        input_file_parts = filepath_parts[9].split(".")
-        result_filename = f"{input_file_parts[0]}.annot.vcf"
+        result_filename = os.path.basename(finalout)
         result_object_key = f"{filepath_parts[6]}/{filepath_parts[7]}/{filepath_parts[8]}/{result_filename}"
         result_filepath = f"{ANNOTATOR_JOBS_DIR}{result_object_key}"
         print(f"Writing from {result_filepath}")
 
         # upload result file to s3 results bucket
+        result_keys = {}
         if upload_file(result_filepath, RESULT_BUCKET_NAME, result_object_key):
           print("Result uploaded to bucket")
+          result_keys['s3_key_result_file'] = result_object_key
         else:
           print("Result upload failed")
+        if os.path.exists(result_filepath + '.tbi'):
+          if upload_file(result_filepath + '.tbi', RESULT_BUCKET_NAME,
+            result_object_key + '.tbi'):
+            result_keys['s3_key_index_file'] = result_object_key + '.tbi'
+        # the fragment sidecar goes next to the result, for re-annotation
+        if (sidecar_file is not None) and os.path.exists(sidecar_file):
+          sidecar_key = os.path.dirname(result_object_key) + '/' + \
+            os.path.basename(sidecar_file)
+          if upload_file(sidecar_file, RESULT_BUCKET_NAME, sidecar_key):
+            result_keys['s3_key_fragments_file'] = sidecar_key
 
         # 2. Upload the log file to S3 results bucket
-        log_filename = f"{input_file_parts[0]}.vcf.count.log"
+        log_filename = rr.logName(filepath_parts[9])
         log_object_key = f"{filepath_parts[6]}/{filepath_parts[7]}/{filepath_parts[8]}/{log_filename}"
         log_filepath = f"{ANNOTATOR_JOBS_DIR}{log_object_key}"
         if upload_file(log_filepath, RESULT_BUCKET_NAME, log_object_key):
           print("Log file uploaded to bucket")
+          result_keys['s3_key_log_file'] = log_object_key
         else:
           print("Log file upload fialed")
 
@@ -110,27 +168,48 @@ if __name__ == '__main__':
 
         # update db job status to COMPLETE and insert additional fields
         # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Expressions.UpdateExpressions.html
+        # the content hash passed by annotator.py, if any, goes on the item
+        content_hash = None
+        if len(sys.argv) > 2:
+          content_hash = sys.argv[2]
+        values = {
+                   ":s" : "COMPLETED",
+                   ":t" : int(time.time()),
+                   ":krf" : result_object_key,
+                   ":klf" : log_object_key
+                 }
+        update = """SET job_status = :s,
+                        complete_time = :t,
+                        s3_key_result_file = :krf,
+                        s3_key_log_file = :klf"""
+        if content_hash is not None:
+          values[":h"] = content_hash
+          update = update + ", content_hash = :h"
+        # reannotate.py fetches the sidecar back from this key
+        if 's3_key_fragments_file' in result_keys:
+          values[":kff"] = result_keys['s3_key_fragments_file']
+          update = update + ", s3_key_fragments_file = :kff"
         try:
           dynamodb = boto3.resource('dynamodb', region_name=REGION)
           ann_table = dynamodb.Table(DYNAMO_DB_TABLE)
           response = ann_table.update_item(
                         Key = {"job_id" : job_id},
-                        ExpressionAttributeValues = {
-                                                      ":s" : "COMPLETED",
-                                                      ":t" : int(time.time()),
-                                                      ":krf" : result_object_key,
-                                                      ":klf" : log_object_key
-                                                    },
-                        UpdateExpression = """SET job_status = :s,
-                                              complete_time = :t,
-                                              s3_key_result_file = :krf,
-                                              s3_key_log_file = :klf
-                                            """,
+                        ExpressionAttributeValues = values,
+                        UpdateExpression = update,
                         ReturnValues="UPDATED_OLD"
                       )
         except ClientError as e:
           print("Update job status failed")
           raise e
+
+        # later jobs with the same content hash reuse this result
+        if (content_hash is not None) and ('s3_key_result_file' in
+          result_keys) and ('s3_key_log_file' in result_keys):
+          try:
+            rr.recordResult(boto3.client('s3'), RESULT_BUCKET_NAME,
+              content_hash, job_id, result_keys)
+          except ClientError as e:
+            logging.error(f"Failed to record the result for reuse: {e}")
         
         # job in a settled state, prepare notification message to user
         data = {
@@ -0,0 +1,204 @@
+# sharding.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Splitting an input file into chromosome shards and merging the
+# annotated shards back together
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import re
+from array import array
+
+import file_utils as fu
+
+"""Split the leading header block from the records of an input file
+   Returns (header lines, [(chrom, pos), ...] of the records)
+"""
+def scanInput(infile, chr_ind=0, pos_ind=1):
+    header = []
+    keys = []
+    with fu.openFile(infile) as fh:
+        for line in fh:
+            line = line.rstrip('\n')
+            if (len(keys) == 0) and line.startswith('#'):
+                header.append(line)
+                continue
+            fields = line.split('\t', max(chr_ind, pos_ind) + 1)
+            try:
+                pos = int(fields[pos_ind])
+            except (IndexError, ValueError):
+                pos = 0
+            keys.append((fields[chr_ind], pos))
+    return (header, keys)
+
+
+"""Assign every record to one of about nshards shards
+   Each chromosome goes to one shard, packed with neighbouring small
+   chromosomes; a chromosome with more than its share of records is cut
+   into position ranges of balanced size. Returns (shard of each record,
+   number of shards)
+"""
+def planShards(keys, nshards):
+    target = max(1, -(-len(keys) // max(1, nshards)))
+
+    chroms = []
+    records = {}
+    for i, (chrom, pos) in enumerate(keys):
+        if chrom not in records:
+            chroms.append(chrom)
+            records[chrom] = []
+        records[chrom].append(i)
+
+    assignment = array('I', [0] * len(keys))
+    shard = 0
+    filled = 0
+    for chrom in chroms:
+        indices = records[chrom]
+        if (len(indices) > target):
+            if (filled > 0):
+                shard = shard + 1
+                filled = 0
+            indices = sorted(indices, key=lambda i: (keys[i][1], i))
+            for start in range(0, len(indices), target):
+                for i in indices[start:start + target]:
+                    assignment[i] = shard
+                filled = len(indices[start:start + target])
+                if (filled == target):
+                    shard = shard + 1
+                    filled = 0
+            continue
+        if (filled > 0) and (filled + len(indices) > target):
+            shard = shard + 1
+            filled = 0
+        for i in indices:
+            assignment[i] = shard
+        filled = filled + len(indices)
+
+    return (assignment, shard + (1 if filled > 0 else 0))
+
+
+"""Write the records of each shard, behind the header, to
+   <directory>/<shard>.vcf; returns the shard file names
+"""
+def writeShards(infile, directory, header, assignment, nshards):
+    os.makedirs(directory)
+    names = [os.path.join(directory, str(s) + '.vcf') for s in range(nshards)]
+    fhs = [open(name, 'w') for name in names]
+    for fh in fhs:
+        fh.write(''.join([l + '\n' for l in header]))
+
+    with fu.openFile(infile) as fh:
+        for n in range(len(header)):
+            fh.readline()
+        i = 0
+        for line in fh:
+            fhs[assignment[i]].write(line.rstrip('\n') + '\n')
+            i = i + 1
+
+    for fh in fhs:
+        fh.close()
+    return names
+
+
+"""Interleave the annotated shards back into the original record order
+   Returns False if a shard does not have one line per record, e.g. when
+   a stage split a line, so that the caller can fall back
+"""
+def mergeShards(outfiles, outfile, nheader, assignment):
+    counts = [0] * len(outfiles)
+    for s in assignment:
+        counts[s] = counts[s] + 1
+    for s in range(len(outfiles)):
+        with open(outfiles[s]) as fh:
+            if (sum(1 for line in fh) != nheader + counts[s]):
+                return False
+
+    fhs = [open(name) for name in outfiles]
+    with fu.openFile(outfile, 'w', index=True) as fh_out:
+        for s in range(len(fhs)):
+            for n in range(nheader):
+                line = fhs[s].readline()
+                if (s == 0):
+                    fh_out.write(line)
+        for s in assignment:
+            fh_out.write(fhs[s].readline())
+    for fh in fhs:
+        fh.close()
+    return True
+
+
+TOTAL_LINE = re.compile(r'^Total: (\d+)$')
+DBSNP_LINE = re.compile(r'^In dbSNP: (\d+) \((.*)%\)$')
+OVERLAP_LINE = re.compile(r'^(In .*): (\d+) in (\d+) variants$')
+COUNT_LINE = re.compile(r'^(In .*) (\d+)$')
+CACHE_HITS_LINE = re.compile(r'^Cache hits: (\d+) of (\d+) \((.*)%\)$')
+CACHE_SIZE_LINE = re.compile(r'^Cache size: (\d+) bytes$')
+
+"""Combine the .count.log files of the shards into one
+   Counts are summed. Each stage starts its total at 1, so the shards'
+   totals carry one extra each, and the dbSNP ratio and the cache hit
+   rate are recomputed from the summed counts. The shards share one
+   cache, so its size is the largest they saw
+"""
+def mergeCountLogs(logfiles, logfile):
+    logs = [open(name).read().splitlines() for name in logfiles]
+    for log in logs[1:]:
+        if (len(log) != len(logs[0])):
+            raise ValueError("Shard count logs have different lines")
+
+    total = None
+    merged = []
+    for n in range(len(logs[0])):
+        lines = [log[n] for log in logs]
+        m = TOTAL_LINE.match(lines[0])
+        if m is not None:
+            total = sum([int(TOTAL_LINE.match(l).group(1)) for l in lines]) \
+                - (len(lines) - 1)
+            merged.append(f"Total: {str(total)}")
+            continue
+        m = DBSNP_LINE.match(lines[0])
+        if m is not None:
+            count = sum([int(DBSNP_LINE.match(l).group(1)) for l in lines])
+            ratio = (count / float(total)) * 100
+            merged.append(f"In dbSNP: {str(count)} ({str(ratio)}%)")
+            continue
+        m = OVERLAP_LINE.match(lines[0])
+        if m is not None:
+            matches = [OVERLAP_LINE.match(l) for l in lines]
+            merged.append(f"{m.group(1)}: " + \
+                f"{str(sum([int(x.group(2)) for x in matches]))} in " + \
+                f"{str(sum([int(x.group(3)) for x in matches]))} variants")
+            continue
+        m = CACHE_HITS_LINE.match(lines[0])
+        if m is not None:
+            hits = sum([int(CACHE_HITS_LINE.match(l).group(1))
+                for l in lines])
+            lookups = sum([int(CACHE_HITS_LINE.match(l).group(2))
+                for l in lines])
+            rate = 0.0
+            if (lookups > 0):
+                rate = (hits / float(lookups)) * 100
+            merged.append(f"Cache hits: {str(hits)} of {str(lookups)} " + \
+                f"({str(rate)}%)")
+            continue
+        m = CACHE_SIZE_LINE.match(lines[0])
+        if m is not None:
+            size = max([int(CACHE_SIZE_LINE.match(l).group(1))
+                for l in lines])
+            merged.append(f"Cache size: {str(size)} bytes")
+            continue
+        m = COUNT_LINE.match(lines[0])
+        if m is not None:
+            merged.append(f"{m.group(1)} " + \
+                f"{str(sum([int(COUNT_LINE.match(l).group(2)) for l in lines]))}")
+            continue
+        merged.append(lines[0])
+
+    with open(logfile, 'w') as fh:
+        fh.write(''.join([l + '\n' for l in merged]))
+
+### EOF
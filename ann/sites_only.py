@@ -0,0 +1,111 @@
+# sites_only.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Sites-only annotation of multi-sample VCF files
+#
+# The stages only read CHROM through INFO, so for cohort files the FORMAT
+# and sample columns are moved to a side file before the first stage and
+# put back in one streaming merge after the last one. The side file has
+# one line per record with sample columns, "<record number>\t<columns>",
+# and "#\t<sample names>" for the #CHROM header line.
+#
+# Such a record keeps a placeholder column after INFO in the sites file,
+# so its line still has the tab that ends INFO, an empty INFO included,
+# and the placeholder is written with the separator the stages put
+# between the columns (gadAll's '\t '). The merge puts the sample columns
+# in its place with that separator, as the stages would have.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import file_utils as fu
+import vcf_record as vr
+
+# Key of the sample names of the #CHROM line in the side file
+HEADER_KEY = '#'
+
+# Column standing in for FORMAT and the samples in the sites file
+PLACEHOLDER = '.'
+
+"""Write the first eight columns of every line of infile to sitesfile
+   and the rest of the line, if any, to samplesfile; records with a rest
+   get a PLACEHOLDER column for it
+   Returns the number of records
+"""
+def splitSamples(infile, sitesfile, samplesfile):
+    recno = 0
+    with fu.openFile(infile) as fh, open(sitesfile, 'w') as fh_sites, \
+        open(samplesfile, 'w') as fh_samples:
+        for text in fh:
+            line = text.strip()
+            key = HEADER_KEY
+            if not line.startswith('#'):
+                key = str(recno)
+                recno = recno + 1
+            elif not line.startswith('#CHROM'):
+                fh_sites.write(line + '\n')
+                continue
+
+            fields = vr.splitRecord(line)
+            if (len(fields) > vr.REST_IND):
+                fh_samples.write(key + '\t' + fields.pop() + '\n')
+                if (key != HEADER_KEY):
+                    fields.append(PLACEHOLDER)
+            fh_sites.write('\t'.join(fields) + '\n')
+    return recno
+
+
+"""(key, sample columns) of the lines of a side file
+"""
+def readSamples(samplesfile):
+    with open(samplesfile) as fh:
+        for text in fh:
+            key, rest = text.rstrip('\n').split('\t', 1)
+            yield (key, rest)
+
+
+"""Put the sample columns of samplesfile back on the records of the
+   annotated sites file annotfile, into outfile
+   Raises ValueError, writing nothing, if the annotated file no longer
+   has count records, e.g. when a stage split a line
+"""
+def mergeSamples(annotfile, samplesfile, outfile, count):
+    with fu.openFile(annotfile) as fh:
+        records = sum(1 for text in fh if not text.startswith('#'))
+    if (records != count):
+        raise ValueError(f"{annotfile} has {str(records)} records " + \
+            f"instead of {str(count)}, samples left in {samplesfile}")
+
+    with fu.openFile(annotfile) as fh, \
+        fu.openFile(outfile, 'w', index=True) as fh_out:
+        samples = readSamples(samplesfile)
+        pending = next(samples, None)
+        recno = 0
+        for text in fh:
+            line = text.rstrip('\n')
+            key = HEADER_KEY
+            if not line.startswith('#'):
+                key = str(recno)
+                recno = recno + 1
+            elif not line.startswith('#CHROM'):
+                key = None
+            if (pending is not None) and (pending[0] == key):
+                line = joinSamples(line, key, pending[1])
+                pending = next(samples, None)
+            fh_out.write(line + '\n')
+
+
+"""Line of an annotated sites file with its sample columns put back
+   A record's placeholder is replaced, and the separator before it is put
+   between the sample columns too
+"""
+def joinSamples(line, key, rest):
+    if (key == HEADER_KEY):
+        return line + '\t' + rest
+    at = line.rfind('\t')
+    sep = '\t' + line[at + 1:len(line) - len(PLACEHOLDER)]
+    return line[:at] + sep + rest.replace('\t', sep)
+
+### EOF
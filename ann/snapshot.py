@@ -0,0 +1,997 @@
+# snapshot.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Local, read-only snapshots of the annotator reference database
+#
+# Build a snapshot from the reference database (RDS):
+#   python snapshot.py <snapshot_root> [--version <version>]
+# or from UCSC-style dumps (<table>.sql and <table>.txt[.gz] files):
+#   python snapshot.py <snapshot_root> --dump <dump_directory>
+#
+# Layout of <snapshot_root>:
+#   current -> <version>      the snapshot annotators use by default
+#   <version>/manifest.json   tables, columns, chromosomes, row counts,
+#                             content digests
+#   <version>/<table>/p<n>/   one directory per chromosome, holding
+#       c<i>.bin              int64 or float64 values of column i
+#       c<i>.idx, c<i>.dat    offsets (uint64, n + 1) and bytes of the
+#                             values of other columns
+#       c<i>.nul              null flags (uint8), if column i has NULLs
+#       order.bin             row numbers sorted by the position column
+#       order.pos             the positions in that order (int64)
+#   <version>/dbsnp_index/    dbsnp_index.py index built from the snapshot
+#   <version>/tfbs_index/     tfbs_index.py index built from the snapshot
+#
+# Rows keep the order of the source table within each chromosome.
+# Point utils.db_connect() at a snapshot by setting ANNOTATOR_SNAPSHOT_DIR
+# to the snapshot root or to one version directory; connect() returns a
+# connection that answers the queries the annotation stages send.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import re
+import gzip
+import bisect
+import hashlib
+import json
+import time
+import shutil
+import argparse
+from array import array
+from decimal import Decimal
+
+import dbsnp_index as di
+import tfbs_index as ti
+
+SNAPSHOT_ENV = 'ANNOTATOR_SNAPSHOT_DIR'
+
+"""Tables the annotator reads: table -> (chromosome column, position column)
+"""
+TABLES = {
+    'dbSNP': ('CHR', 'POS'),
+    'chrom_pos_equal_base': ('CHR', 'start'),
+    'chrom_pos_equal_nobase': ('CHR', 'start'),
+    'chrom_pos_unequal': ('CHR', 'start'),
+    'refGene': ('chrom', 'txStart'),
+    'cpgIslandExt': ('chrom', 'chromStart'),
+    'cytoBand': ('chrom', 'chromStart'),
+    'gadAll': ('chromosome', 'chromStart'),
+    'gwasCatalog': ('chrom', 'chromEnd'),
+    'targetScanS': ('chrom', 'chromStart'),
+    'hugo': ('chrom', 'chromStart'),
+    'dgv_Cnv': ('chrom', 'chromStart'),
+    'abParts_IG_T_CelReceptors': ('chrom', 'chromStart'),
+    'mcCarroll_Cnv': ('chrom', 'chromStart'),
+    'conrad_Cnv': ('chrom', 'chromStart'),
+    'genomicSuperDups': ('chrom', 'chromStart'),
+}
+for c in ['1','2','3','4','5','6','7','8','9','10','11','12','13','14','15',
+    '16','17','18','19','20','21','22','X','Y']:
+    TABLES['tfbsConsSites' + c] = ('chrom', 'chromStart')
+
+# Column kinds stored as fixed-width arrays
+FIXED_KINDS = {'int': 'q', 'float': 'd'}
+
+# pymysql FIELD_TYPE codes of integer and floating point columns
+MYSQL_INT_TYPES = [1, 2, 3, 8, 9, 13]
+MYSQL_FLOAT_TYPES = [4, 5]
+
+
+class SnapshotError(Exception):
+    pass
+
+
+"""Kind of a value stored in a variable-length column
+"""
+def valueKind(value):
+    if isinstance(value, (bytes, bytearray)):
+        return 'bytes'
+    if isinstance(value, Decimal):
+        return 'decimal'
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    return 'str'
+
+
+def encodeValue(value):
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+    return str(value).encode('utf-8')
+
+
+def decodeValue(data, kind):
+    if (kind == 'bytes'):
+        return data
+    if (kind == 'decimal'):
+        return Decimal(data.decode('utf-8'))
+    if (kind == 'int'):
+        return int(data)
+    if (kind == 'float'):
+        return float(data)
+    return data.decode('utf-8')
+
+
+"""Buffers the columns of one chromosome of a table
+   Values are kept in memory and appended to the column files on
+   flush(), so only a handful of files are open at any time
+"""
+class PartitionWriter(object):
+    def __init__(self, directory, storage, pos_ind):
+        self.directory = directory
+        self.storage = storage
+        self.pos_ind = pos_ind
+        self.count = 0
+        self.offsets = [0] * len(storage)
+        self.positions = array('q')
+        self.nulls = [False] * len(storage)
+        os.makedirs(directory)
+        for i in range(len(storage)):
+            if storage[i] is None:
+                with open(self.path(i, '.idx'), 'wb') as fh:
+                    array('Q', [0]).tofile(fh)
+        self.reset()
+
+    def path(self, i, ext):
+        return os.path.join(self.directory, 'c' + str(i) + ext)
+
+    def reset(self):
+        self.values = [[] for k in self.storage]
+        self.flags = [array('B') for k in self.storage]
+
+    def append(self, row):
+        for i in range(len(self.storage)):
+            value = row[i]
+            self.flags[i].append(value is None)
+            self.values[i].append(value)
+        pos = row[self.pos_ind]
+        self.positions.append(int(pos) if pos is not None else 0)
+        self.count = self.count + 1
+
+    def flush(self):
+        for i in range(len(self.storage)):
+            typecode = self.storage[i]
+            values = self.values[i]
+            if (len(values) == 0):
+                continue
+            if typecode is not None:
+                data = array(typecode, [(0 if v is None else v)
+                    for v in values])
+                with open(self.path(i, '.bin'), 'ab') as fh:
+                    data.tofile(fh)
+            else:
+                offsets = array('Q')
+                with open(self.path(i, '.dat'), 'ab') as fh:
+                    for v in values:
+                        if v is not None:
+                            data = encodeValue(v)
+                            fh.write(data)
+                            self.offsets[i] = self.offsets[i] + len(data)
+                        offsets.append(self.offsets[i])
+                with open(self.path(i, '.idx'), 'ab') as fh:
+                    offsets.tofile(fh)
+            with open(self.path(i, '.nul'), 'ab') as fh:
+                self.flags[i].tofile(fh)
+            if (1 in self.flags[i]):
+                self.nulls[i] = True
+        self.reset()
+
+    def close(self):
+        self.flush()
+        for i in range(len(self.storage)):
+            if not self.nulls[i]:
+                os.unlink(self.path(i, '.nul'))
+        order = sorted(range(self.count), key=lambda j: self.positions[j])
+        with open(os.path.join(self.directory, 'order.bin'), 'wb') as fh:
+            array('Q', order).tofile(fh)
+        with open(os.path.join(self.directory, 'order.pos'), 'wb') as fh:
+            array('q', [self.positions[j] for j in order]).tofile(fh)
+        self.positions = None
+
+
+"""Writes one table of a snapshot, split by chromosome
+   Columns of kind 'int' or 'float' are stored as fixed-width arrays and
+   all others as variable-length values; a kind of None is taken from
+   the first value seen ('str', 'bytes', 'decimal', 'int' or 'float')
+"""
+class TableWriter(object):
+    def __init__(self, directory, table, names, kinds, chromName, posName,
+        flush_rows=200000):
+
+        self.directory = directory
+        self.table = table
+        self.names = names
+        self.kinds = list(kinds)
+        self.storage = [FIXED_KINDS.get(k) for k in kinds]
+        self.chrom_ind = names.index(chromName)
+        self.pos_ind = names.index(posName)
+        self.chromName = chromName
+        self.posName = posName
+        self.flush_rows = flush_rows
+        self.pending = 0
+        self.partitions = {}
+        self.chroms = []
+        os.makedirs(directory)
+
+    def append(self, row):
+        for i in range(len(self.kinds)):
+            if (self.kinds[i] is None) and (row[i] is not None):
+                self.kinds[i] = valueKind(row[i])
+
+        chrom = str(row[self.chrom_ind])
+        if chrom not in self.partitions:
+            self.partitions[chrom] = PartitionWriter(
+                os.path.join(self.directory, 'p' + str(len(self.chroms))),
+                self.storage, self.pos_ind)
+            self.chroms.append(chrom)
+        self.partitions[chrom].append(row)
+
+        self.pending = self.pending + 1
+        if (self.pending >= self.flush_rows):
+            for partition in self.partitions.values():
+                partition.flush()
+            self.pending = 0
+
+    def close(self):
+        for partition in self.partitions.values():
+            partition.close()
+        kinds = [k if k is not None else 'str' for k in self.kinds]
+        return {
+            'columns': [[self.names[i], kinds[i], self.storage[i]]
+                for i in range(len(self.names))],
+            'chrom': self.chromName,
+            'position': self.posName,
+            'partitions': [[chrom, 'p' + str(i), self.partitions[chrom].count]
+                for i, chrom in enumerate(self.chroms)],
+            'nullable': [self.names[i] for i in range(len(self.names))
+                if (True in [p.nulls[i] for p in self.partitions.values()])]
+        }
+
+
+"""Column kinds from a MySQL cursor description
+"""
+def mysqlKinds(description):
+    kinds = []
+    for d in description:
+        if d[1] in MYSQL_INT_TYPES:
+            kinds.append('int')
+        elif d[1] in MYSQL_FLOAT_TYPES:
+            kinds.append('float')
+        else:
+            kinds.append(None)
+    return kinds
+
+
+"""Copy a table from the reference database
+"""
+def exportMySQLTable(conn, table, directory, chunk=100000):
+    import pymysql
+    chromName, posName = TABLES[table]
+    cursor = conn.cursor(pymysql.cursors.SSCursor)
+    cursor.execute('select * from ' + table + ';')
+    names = [str(d[0]) for d in cursor.description]
+    writer = TableWriter(directory, table, names,
+        mysqlKinds(cursor.description), chromName, posName)
+    rows = cursor.fetchmany(chunk)
+    while (len(rows) > 0):
+        for row in rows:
+            writer.append(row)
+        rows = cursor.fetchmany(chunk)
+    cursor.close()
+    return writer.close()
+
+
+"""Column names and kinds from a mysqldump CREATE TABLE statement
+"""
+def parseCreateTable(sqlfile):
+    names = []
+    kinds = []
+    for line in open(sqlfile):
+        m = re.match(r'\s+`([^`]+)`\s+([a-zA-Z]+)', line)
+        if m is None:
+            continue
+        names.append(m.group(1))
+        t = m.group(2).lower()
+        if t in ['tinyint', 'smallint', 'mediumint', 'int', 'integer',
+            'bigint']:
+            kinds.append('int')
+        elif t in ['float', 'double', 'real']:
+            kinds.append('float')
+        elif t in ['decimal', 'numeric']:
+            kinds.append('decimal')
+        elif t.endswith('blob') or t.endswith('binary'):
+            kinds.append('bytes')
+        else:
+            kinds.append('str')
+    return (names, kinds)
+
+
+DUMP_ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', '0': '\0', '\\': '\\',
+    'b': '\b', 'Z': '\x1a'}
+
+"""Decode one field of a mysqldump --tab (SELECT INTO OUTFILE) file
+"""
+def parseDumpField(text, kind):
+    if (text == '\\N'):
+        return None
+    if '\\' in text:
+        text = re.sub(r'\\(.)', lambda m: DUMP_ESCAPES.get(m.group(1),
+            m.group(1)), text)
+    if (kind == 'int'):
+        return int(text)
+    if (kind == 'float'):
+        return float(text)
+    if (kind == 'decimal'):
+        return Decimal(text)
+    if (kind == 'bytes'):
+        return text.encode('utf-8', 'surrogateescape')
+    return text
+
+
+"""Copy a table from UCSC-style dump files
+"""
+def exportDumpTable(dumpdir, table, directory):
+    chromName, posName = TABLES[table]
+    names, kinds = parseCreateTable(os.path.join(dumpdir, table + '.sql'))
+    txtfile = os.path.join(dumpdir, table + '.txt')
+    if os.path.exists(txtfile + '.gz'):
+        fh = gzip.open(txtfile + '.gz', 'rt', encoding='utf-8',
+            errors='surrogateescape', newline='\n')
+    else:
+        fh = open(txtfile, encoding='utf-8', errors='surrogateescape',
+            newline='\n')
+
+    writer = TableWriter(directory, table, names, kinds, chromName, posName)
+    for line in fh:
+        fields = line.rstrip('\n').split('\t')
+        writer.append([parseDumpField(fields[i], kinds[i])
+            for i in range(len(names))])
+    fh.close()
+    return writer.close()
+
+
+"""SHA-256 of the files of an exported table, which stays the same
+   from one snapshot version to the next unless the table changed
+"""
+def tableDigest(directory):
+    digest = hashlib.sha256()
+    for (dirpath, dirnames, filenames) in sorted(os.walk(directory)):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            digest.update(os.path.relpath(path, directory).encode('utf-8'))
+            with open(path, 'rb') as fh:
+                digest.update(fh.read())
+    return digest.hexdigest()
+
+
+"""Build a new snapshot version and make it current
+"""
+def buildSnapshot(root, version=None, dumpdir=None, tables=None):
+    if version is None:
+        version = time.strftime('%Y%m%d%H%M%S')
+    if tables is None:
+        tables = list(TABLES.keys())
+
+    versiondir = os.path.join(root, version)
+    tmpdir = versiondir + '.tmp'
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+
+    conn = None
+    if dumpdir is None:
+        import utils as u
+        conn = u.db_connect(snapshot_dir='')
+
+    manifest = {'version': version, 'created': int(time.time()),
+        'source': 'dump' if dumpdir else 'mysql', 'tables': {}}
+    for table in tables:
+        directory = os.path.join(tmpdir, table)
+        if dumpdir is None:
+            manifest['tables'][table] = exportMySQLTable(conn, table,
+                directory)
+        else:
+            manifest['tables'][table] = exportDumpTable(dumpdir, table,
+                directory)
+        manifest['tables'][table]['digest'] = tableDigest(directory)
+        print(f"{table} - done.")
+
+    if conn is not None:
+        conn.close()
+
+    with open(os.path.join(tmpdir, 'manifest.json'), 'w') as fh:
+        json.dump(manifest, fh, indent=2)
+
+    if 'dbSNP' in tables:
+        snapshot_conn = SnapshotConnection(Snapshot(tmpdir))
+        di.buildIndex(snapshot_conn, os.path.join(tmpdir, 'dbsnp_index'))
+    tfbs_chroms = [c for c in ti.CHROMS if ('tfbsConsSites' + c) in tables]
+    if (len(tfbs_chroms) > 0):
+        snapshot_conn = SnapshotConnection(Snapshot(tmpdir))
+        ti.buildIndex(snapshot_conn, os.path.join(tmpdir, 'tfbs_index'),
+            chroms=tfbs_chroms)
+
+    shutil.rmtree(versiondir, ignore_errors=True)
+    os.rename(tmpdir, versiondir)
+
+    link = os.path.join(root, 'current')
+    os.symlink(version, link + '.tmp')
+    os.replace(link + '.tmp', link)
+    return versiondir
+
+
+"""Map a binary file read-only as an array of the given type code
+"""
+def mapArray(path, typecode):
+    return di.mapArray(path, typecode)
+
+
+"""Read access to one chromosome of a table
+"""
+class Partition(object):
+    def __init__(self, directory, kinds, storage, count):
+        self.count = count
+        self.columns = []
+        for i in range(len(kinds)):
+            path = os.path.join(directory, 'c' + str(i))
+            nulls = None
+            if os.path.exists(path + '.nul'):
+                nulls = mapArray(path + '.nul', 'B')
+            if storage[i] is not None:
+                self.columns.append((kinds[i],
+                    mapArray(path + '.bin', storage[i]), None, nulls))
+            else:
+                self.columns.append((kinds[i], mapArray(path + '.idx', 'Q'),
+                    mapArray(path + '.dat', 'B'), nulls))
+        self.order = mapArray(os.path.join(directory, 'order.bin'), 'Q')
+        self.positions = mapArray(os.path.join(directory, 'order.pos'), 'q')
+
+    def value(self, i, j):
+        kind, values, data, nulls = self.columns[i]
+        if (nulls is not None) and nulls[j]:
+            return None
+        if data is None:
+            return values[j]
+        return decodeValue(bytes(data[values[j]:values[j + 1]]), kind)
+
+    def row(self, j):
+        return tuple([self.value(i, j) for i in range(len(self.columns))])
+
+
+"""Read access to one table of a snapshot
+"""
+class SnapshotTable(object):
+    def __init__(self, directory, name, meta):
+        self.directory = directory
+        self.name = name
+        self.names = [c[0] for c in meta['columns']]
+        self.kinds = [c[1] for c in meta['columns']]
+        self.storage = [c[2] for c in meta['columns']]
+        self.chromName = meta['chrom']
+        self.posName = meta['position']
+        self.chroms = [p[0] for p in meta['partitions']]
+        self.dirs = dict([(p[0], p[1]) for p in meta['partitions']])
+        self.counts = dict([(p[0], p[2]) for p in meta['partitions']])
+        self.partitions = {}
+
+    def partition(self, chrom):
+        if chrom not in self.dirs:
+            return None
+        if chrom not in self.partitions:
+            self.partitions[chrom] = Partition(
+                os.path.join(self.directory, self.dirs[chrom]), self.kinds,
+                self.storage,
+                self.counts[chrom])
+        return self.partitions[chrom]
+
+    def column(self, name):
+        if name not in self.names:
+            raise SnapshotError(f"Unknown column '{name}' in {self.name}")
+        return self.names.index(name)
+
+
+"""A snapshot version directory
+"""
+class Snapshot(object):
+    def __init__(self, directory):
+        if not os.path.exists(os.path.join(directory, 'manifest.json')):
+            directory = os.path.join(directory, 'current')
+        self.directory = os.path.realpath(directory)
+        with open(os.path.join(self.directory, 'manifest.json')) as fh:
+            self.manifest = json.load(fh)
+        self.version = self.manifest['version']
+        self.tables = {}
+
+    def table(self, name):
+        if name not in self.manifest['tables']:
+            raise SnapshotError(f"Table '{name}' is not in snapshot " + \
+                f"{self.version}")
+        if name not in self.tables:
+            self.tables[name] = SnapshotTable(
+                os.path.join(self.directory, name), name,
+                self.manifest['tables'][name])
+        return self.tables[name]
+
+
+TOKEN = re.compile(r'\s*(?:(\d+(?:\.\d+)?)|"((?:[^"\\]|\\.)*)"|' + \
+    r"'((?:[^'\\]|\\.)*)'|([A-Za-z_][A-Za-z0-9_]*)|(<=|>=|<>|!=|[=<>(),*+;-]))")
+
+KEYWORDS = ['select', 'distinct', 'from', 'where', 'and', 'or', 'order',
+    'by', 'limit']
+
+"""Tokens of a statement as (type, value); type is one of
+   'num', 'str', 'name', 'kw' or 'op'
+"""
+def tokenize(sql):
+    tokens = []
+    pos = 0
+    sql = sql.rstrip()
+    while (pos < len(sql)):
+        m = TOKEN.match(sql, pos)
+        if m is None:
+            raise SnapshotError(f"Cannot parse '{sql[pos:pos + 20]}'")
+        num, dq, sq, name, op = m.groups()
+        if num is not None:
+            tokens.append(('num', float(num) if '.' in num else int(num)))
+        elif dq is not None:
+            tokens.append(('str', re.sub(r'\\(.)', r'\1', dq)))
+        elif sq is not None:
+            tokens.append(('str', re.sub(r'\\(.)', r'\1', sq)))
+        elif name is not None:
+            if name.lower() in KEYWORDS:
+                tokens.append(('kw', name.lower()))
+            else:
+                tokens.append(('name', name))
+        else:
+            tokens.append(('op', op))
+        pos = m.end()
+    return tokens
+
+
+"""Quote a parameter the way pymysql interpolates it
+"""
+def literal(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (int, float, Decimal)):
+        return str(value)
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+"""Parser for the statements the annotator sends:
+   select [distinct] <* | columns> from <table> [where <condition>]
+       [order by <column>] [limit <n>]
+   Conditions combine comparisons of columns, numbers, strings and
+   column +/- number with and, or and parentheses
+"""
+class Parser(object):
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        if (self.pos < len(self.tokens)):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.pos = self.pos + 1
+        return token
+
+    def expect(self, type, value=None):
+        token = self.next()
+        if (token[0] != type) or ((value is not None) and (token[1] != value)):
+            raise SnapshotError(f"Expected {value or type}, got {token[1]}")
+        return token[1]
+
+    def accept(self, type, value):
+        if (self.peek() == (type, value)):
+            self.pos = self.pos + 1
+            return True
+        return False
+
+    def parseSelect(self):
+        self.expect('kw', 'select')
+        query = {'distinct': self.accept('kw', 'distinct'), 'where': None,
+            'order': None, 'limit': None}
+        if self.accept('op', '*'):
+            query['columns'] = None
+        else:
+            query['columns'] = [self.expect('name')]
+            while self.accept('op', ','):
+                query['columns'].append(self.expect('name'))
+        self.expect('kw', 'from')
+        query['table'] = self.expect('name')
+        if self.accept('kw', 'where'):
+            query['where'] = self.parseOr()
+        if self.accept('kw', 'order'):
+            self.expect('kw', 'by')
+            query['order'] = self.expect('name')
+        if self.accept('kw', 'limit'):
+            query['limit'] = self.expect('num')
+        self.accept('op', ';')
+        if (self.peek()[0] is not None):
+            raise SnapshotError(f"Unexpected '{self.peek()[1]}'")
+        return query
+
+    def parseOr(self):
+        terms = [self.parseAnd()]
+        while self.accept('kw', 'or'):
+            terms.append(self.parseAnd())
+        if (len(terms) == 1):
+            return terms[0]
+        return ('or', terms)
+
+    def parseAnd(self):
+        factors = [self.parseFactor()]
+        while self.accept('kw', 'and'):
+            factors.append(self.parseFactor())
+        if (len(factors) == 1):
+            return factors[0]
+        return ('and', factors)
+
+    def parseFactor(self):
+        start = self.pos
+        try:
+            return self.parseComparison()
+        except SnapshotError:
+            self.pos = start
+        self.expect('op', '(')
+        condition = self.parseOr()
+        self.expect('op', ')')
+        return condition
+
+    def parseComparison(self):
+        left = self.parseOperand()
+        op = self.expect('op')
+        if op not in ['=', '<', '>', '<=', '>=', '<>', '!=']:
+            raise SnapshotError(f"Unsupported operator '{op}'")
+        right = self.parseOperand()
+        return ('cmp', op, left, right)
+
+    def parseOperand(self):
+        if self.accept('op', '('):
+            operand = self.parseOperand()
+            self.expect('op', ')')
+        else:
+            operand = self.parseAtom()
+        while (self.peek() in [('op', '+'), ('op', '-')]):
+            op = self.next()[1]
+            operand = ('arith', op, operand, self.parseAtom())
+        return operand
+
+    def parseAtom(self):
+        type, value = self.next()
+        if (type == 'op') and (value == '-'):
+            type, value = self.next()
+            if (type != 'num'):
+                raise SnapshotError("Expected a number after '-'")
+            return ('lit', -value)
+        if type in ['num', 'str']:
+            return ('lit', value)
+        if (type == 'name'):
+            return ('col', value)
+        raise SnapshotError(f"Unexpected '{value}'")
+
+
+"""Numeric value of a column value, converted like MySQL does for
+   strings used in arithmetic
+"""
+def number(value):
+    if isinstance(value, (int, float, Decimal)):
+        return value
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    m = re.match(r'\s*-?\d+(\.\d*)?', value)
+    if m is None:
+        return 0
+    if m.group(1):
+        return float(m.group(0))
+    return int(m.group(0))
+
+
+def compareValues(op, a, b):
+    if (a is None) or (b is None):
+        return False
+    if isinstance(a, str) != isinstance(b, str):
+        a = number(a)
+        b = number(b)
+    if (op == '='):
+        return a == b
+    if (op == '<'):
+        return a < b
+    if (op == '>'):
+        return a > b
+    if (op == '<='):
+        return a <= b
+    if (op == '>='):
+        return a >= b
+    return a != b
+
+
+"""Turn a parsed condition into a function of (partition, row number)
+"""
+def compileCondition(table, node):
+    if (node[0] == 'and'):
+        parts = [compileCondition(table, n) for n in node[1]]
+        return lambda p, j: all([f(p, j) for f in parts])
+    if (node[0] == 'or'):
+        parts = [compileCondition(table, n) for n in node[1]]
+        return lambda p, j: any([f(p, j) for f in parts])
+    op, left, right = node[1], compileOperand(table, node[2]), \
+        compileOperand(table, node[3])
+    return lambda p, j: compareValues(op, left(p, j), right(p, j))
+
+
+def compileOperand(table, node):
+    if (node[0] == 'lit'):
+        value = node[1]
+        return lambda p, j: value
+    if (node[0] == 'col'):
+        i = table.column(node[1])
+        return lambda p, j: p.value(i, j)
+    sign = 1 if (node[1] == '+') else -1
+    left = compileOperand(table, node[2])
+    right = compileOperand(table, node[3])
+    def arith(p, j):
+        a = left(p, j)
+        b = right(p, j)
+        if (a is None) or (b is None):
+            return None
+        return number(a) + sign * number(b)
+    return arith
+
+
+"""Top-level 'column = literal' and 'column <= literal' bounds of a
+   condition, used to pick partitions and rows without a full scan
+"""
+def conjuncts(node):
+    if node is None:
+        return []
+    if (node[0] == 'and'):
+        result = []
+        for n in node[1]:
+            result.extend(conjuncts(n))
+        return result
+    return [node]
+
+
+def bounds(node, column):
+    equal = None
+    upper = None
+    for n in conjuncts(node):
+        if (n[0] != 'cmp'):
+            continue
+        op, left, right = n[1], n[2], n[3]
+        if (right == ('col', column)) and (left[0] == 'lit'):
+            op = {'=': '=', '<=': '>=', '>=': '<=', '<': '>', '>': '<'}.get(op)
+            left, right = right, left
+        if (left != ('col', column)) or (right[0] != 'lit'):
+            continue
+        if (op == '='):
+            equal = right[1]
+        elif (op == '<='):
+            upper = right[1]
+    return (equal, upper)
+
+
+"""DB-API style cursor over a snapshot
+"""
+class SnapshotCursor(object):
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.description = None
+        self.rows = iter([])
+
+    def execute(self, sql, args=None):
+        if args is not None:
+            parts = sql.split('%s')
+            if (len(parts) != len(args) + 1):
+                raise SnapshotError("Wrong number of query parameters")
+            sql = parts[0] + ''.join([literal(args[i]) + parts[i + 1]
+                for i in range(len(args))])
+        tokens = tokenize(sql)
+        if (len(tokens) == 0) or (tokens[0] != ('kw', 'select')):
+            raise SnapshotError(f"Snapshots are read-only: {sql[:40]}")
+        query = Parser(tokens).parseSelect()
+        table = self.snapshot.table(query['table'])
+
+        columns = query['columns']
+        if columns is None:
+            columns = table.names
+        selected = [table.column(name) for name in columns]
+        self.description = tuple([(name, None, None, None, None, None, None)
+            for name in columns])
+
+        if (query['order'] is not None) and \
+            (query['order'] != table.posName):
+            raise SnapshotError("Only order by " + table.posName + \
+                " is supported for " + table.name)
+
+        if (query['distinct'] and query['where'] is None and
+            selected == [table.column(table.chromName)]):
+            # the distinct chromosomes are the partitions themselves
+            rows = iter([(table.partition(c).value(selected[0], 0),)
+                for c in table.chroms])
+        else:
+            rows = self.select(table, query, selected)
+            if query['distinct']:
+                rows = self.distinct(rows)
+        if query['limit'] is not None:
+            rows = self.limit(rows, query['limit'])
+        self.rows = rows
+        return 0
+
+    def select(self, table, query, selected):
+        where = query['where']
+        condition = None
+        if where is not None:
+            condition = compileCondition(table, where)
+
+        chroms = table.chroms
+        equal, upper = bounds(where, table.chromName)
+        if equal is not None:
+            chroms = [c for c in chroms if (c == str(equal))]
+
+        equal, upper = bounds(where, table.posName)
+        if not isinstance(equal, (int, float)):
+            equal = None
+        if not isinstance(upper, (int, float)):
+            upper = None
+        for chrom in chroms:
+            p = table.partition(chrom)
+            for j in self.candidates(p, equal, upper,
+                query['order'] is not None):
+                if (condition is None) or condition(p, j):
+                    yield tuple([p.value(i, j) for i in selected])
+
+    """Row numbers that can match, in table order (or position order)
+    """
+    def candidates(self, p, equal, upper, ordered):
+        if (equal is None) and (upper is None):
+            if ordered:
+                return p.order
+            return range(p.count)
+
+        first = 0
+        if (equal is not None):
+            first = bisect.bisect_left(p.positions, equal)
+            last = bisect.bisect_right(p.positions, equal)
+        else:
+            last = bisect.bisect_right(p.positions, upper)
+        rows = p.order[first:last]
+        if ordered:
+            return rows
+        return sorted(rows)
+
+    def distinct(self, rows):
+        seen = set([])
+        for row in rows:
+            if row not in seen:
+                seen.add(row)
+                yield row
+
+    def limit(self, rows, n):
+        for row in rows:
+            if (n <= 0):
+                return
+            n = n - 1
+            yield row
+
+    def fetchone(self):
+        return next(self.rows, None)
+
+    def fetchmany(self, size=1):
+        rows = []
+        for row in self.rows:
+            rows.append(row)
+            if (len(rows) >= size):
+                break
+        return tuple(rows)
+
+    def fetchall(self):
+        return tuple(self.rows)
+
+    def close(self):
+        self.rows = iter([])
+
+
+"""DB-API style connection to a snapshot, returned by utils.db_connect()
+"""
+class SnapshotConnection(object):
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def cursor(self, cursorclass=None):
+        return SnapshotCursor(self.snapshot)
+
+    def ping(self, reconnect=True):
+        return True
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+_snapshots = {}
+
+def connect(directory):
+    if directory not in _snapshots:
+        _snapshots[directory] = Snapshot(directory)
+    return SnapshotConnection(_snapshots[directory])
+
+
+"""Snapshot directory set in the environment, or None
+"""
+def snapshotDir():
+    return os.environ.get(SNAPSHOT_ENV) or None
+
+
+"""Version of the snapshot in use, or None
+"""
+def snapshotVersion():
+    if snapshotDir() is None:
+        return None
+    return connect(snapshotDir()).snapshot.version
+
+
+"""Version of a table in the snapshot in use: its content digest, or
+   the snapshot version for snapshots built without digests; None
+   without a snapshot
+"""
+def tableVersion(table):
+    if snapshotDir() is None:
+        return None
+    snap = connect(snapshotDir()).snapshot
+    meta = snap.manifest['tables'].get(table, {})
+    return meta.get('digest') or snap.version
+
+
+"""dbSNP index of the snapshot in use, or None
+"""
+def dbsnpIndexDir():
+    if snapshotDir() is None:
+        return None
+    directory = os.path.join(connect(snapshotDir()).snapshot.directory,
+        'dbsnp_index')
+    if os.path.exists(os.path.join(directory, 'meta.json')):
+        return directory
+    return None
+
+
+"""tfbsConsSites index of the snapshot in use, or None
+"""
+def tfbsIndexDir():
+    if snapshotDir() is None:
+        return None
+    directory = os.path.join(connect(snapshotDir()).snapshot.directory,
+        'tfbs_index')
+    if os.path.exists(os.path.join(directory, 'meta.json')):
+        return directory
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export the annotator reference tables to a snapshot')
+    parser.add_argument('root', help='snapshot root directory')
+    parser.add_argument('--version', help='snapshot version (default: now)')
+    parser.add_argument('--dump', help='directory of UCSC-style dump files')
+    parser.add_argument('--tables', help='comma-separated tables to export')
+    args = parser.parse_args()
+
+    tables = None
+    if args.tables:
+        tables = args.tables.split(',')
+    print(buildSnapshot(args.root, version=args.version, dumpdir=args.dump,
+        tables=tables))
+
+### EOF
@@ -0,0 +1,210 @@
+# sweep_join.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Sweep-line merge join of sorted VCF records against a reference table
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import heapq
+
+import pymysql
+
+import snapshot
+import utils as u
+
+"""Intervals of one chromosome streamed from the database in start order
+   Yields (start, end, seq, row); seq numbers the rows in the order they
+   are streamed. Rows with the same start come in the order the server
+   returns them, which SQL leaves undefined, as it does for the rows of a
+   per-variant query, so hits sharing a start may be listed in another
+   order than the per-variant lookups list them in. Rows without
+   coordinates never match and are skipped
+"""
+def sqlIntervals(conn, table, chromName, chrom, startName, endName,
+    columns=None, chunk=10000):
+
+    selected = 't.*'
+    if columns is not None:
+        selected = ', '.join(['t.' + name for name in columns])
+    where = ''
+    if chromName is not None:
+        where = ' where t.' + chromName + '="' + str(chrom) + '"'
+
+    cursor = conn.cursor(pymysql.cursors.SSCursor)
+    try:
+        cursor.execute('select ' + selected + ' from ' + table + ' t' + \
+            where + ' order by t.' + startName + ';')
+        names = [str(d[0]) for d in cursor.description]
+        start_ind = names.index(startName)
+        end_ind = names.index(endName)
+        seq = 0
+        rows = cursor.fetchmany(chunk)
+        while (len(rows) > 0):
+            for row in rows:
+                if (row[start_ind] is not None) and \
+                    (row[end_ind] is not None):
+                    yield (int(row[start_ind]), int(row[end_ind]), seq,
+                        tuple(row))
+                seq = seq + 1
+            rows = cursor.fetchmany(chunk)
+    finally:
+        cursor.close()
+
+
+"""Intervals of one partition of a snapshot table, in start order
+   The partition's order.bin already lists its rows by position, and
+   the row numbers give the table order
+"""
+def partitionIntervals(p, k, selected, start_ind, end_ind):
+    for j in p.order:
+        start = p.value(start_ind, j)
+        end = p.value(end_ind, j)
+        if (start is not None) and (end is not None):
+            yield (int(start), int(end), (k, j),
+                tuple([p.value(i, j) for i in selected]))
+
+
+"""Intervals of one chromosome read straight from a snapshot
+"""
+def snapshotIntervals(snap, table, chromName, chrom, startName, endName,
+    columns=None):
+
+    t = snap.table(table)
+    if (t.posName != startName):
+        raise snapshot.SnapshotError(f"{table} is not ordered by {startName}")
+    if columns is None:
+        columns = t.names
+    selected = [t.column(name) for name in columns]
+
+    if chromName is None:
+        partitions = [t.partition(c) for c in t.chroms]
+    else:
+        partitions = [t.partition(str(chrom))]
+    streams = [partitionIntervals(p, k, selected, t.column(startName),
+        t.column(endName)) for (k, p) in enumerate(partitions)
+        if p is not None]
+    return heapq.merge(*streams, key=lambda x: x[0])
+
+
+"""Walks the intervals of a reference table in start order alongside
+   coordinate-sorted records
+   Each chromosome is read once, from the database through an unbuffered
+   cursor on a connection of its own or from the snapshot files, and only
+   the intervals that can still overlap a later record are held, in a
+   heap keyed by end. A join costs O(records + intervals).
+   table(chrom) names the table holding a chromosome (None if there is
+   none); chromName=None reads the whole table for every chromosome.
+   join() returns None, now and for every later chunk, as soon as the
+   records turn out not to be sorted, and the stage falls back to its
+   usual lookups
+"""
+class SweepJoin(object):
+    def __init__(self, table, chromName, startName, endName, columns=None):
+        self.table = table
+        self.chromName = chromName
+        self.startName = startName
+        self.endName = endName
+        self.columns = columns
+        self.sorted = True
+        self.conn = None
+        self.intervals = None
+        self.pending = None
+        self.chrom = None
+        self.last = None
+        self.done = set([])
+        self.active = []
+
+    """True if keys continue the sorted order of the keys joined so far:
+       positions ascending within a chromosome, and no chromosome coming
+       back once another has started
+    """
+    def inOrder(self, keys):
+        chrom = self.chrom
+        last = self.last
+        done = set([])
+        for (c, pos) in keys:
+            if (c != chrom):
+                if (c in self.done) or (c in done):
+                    return False
+                if chrom is not None:
+                    done.add(chrom)
+                chrom = c
+                last = None
+            elif (last is not None) and (pos < last):
+                return False
+            last = pos
+        return True
+
+    """Rows overlapping each of a chunk of sorted (chrom, pos) keys
+       Returns {(chrom, pos): [row, ...]} for the keys with hits, rows in
+       the order the table is streamed in (see sqlIntervals), or None for
+       unsorted input
+    """
+    def join(self, keys):
+        if not self.sorted:
+            return None
+        if not self.inOrder(keys):
+            self.sorted = False
+            self.close()
+            return None
+
+        found = {}
+        for (chrom, pos) in keys:
+            if (chrom != self.chrom):
+                self.open(chrom)
+            rows = self.advance(pos)
+            if (len(rows) > 0):
+                found[(chrom, pos)] = rows
+        return found
+
+    def open(self, chrom):
+        self.release()
+        if self.chrom is not None:
+            self.done.add(self.chrom)
+        self.chrom = chrom
+        self.last = None
+        self.active = []
+
+        table = self.table(chrom)
+        if table is None:
+            return
+        if self.conn is None:
+            self.conn = u.db_connect(pooled=False)
+        if isinstance(self.conn, snapshot.SnapshotConnection):
+            self.intervals = snapshotIntervals(self.conn.snapshot, table,
+                self.chromName, chrom, self.startName, self.endName,
+                columns=self.columns)
+        else:
+            self.intervals = sqlIntervals(self.conn, table, self.chromName,
+                chrom, self.startName, self.endName, columns=self.columns)
+        self.pending = next(self.intervals, None)
+
+    def advance(self, pos):
+        while (self.pending is not None) and (self.pending[0] <= pos):
+            start, end, seq, row = self.pending
+            heapq.heappush(self.active, (end, seq, row))
+            self.pending = next(self.intervals, None)
+
+        while (len(self.active) > 0) and (self.active[0][0] < pos):
+            heapq.heappop(self.active)
+        self.last = pos
+        return [row for (end, seq, row) in
+            sorted(self.active, key=lambda x: x[1])]
+
+    def release(self):
+        if self.intervals is not None:
+            self.intervals.close()
+        self.intervals = None
+        self.pending = None
+
+    def close(self):
+        self.release()
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = None
+        self.active = []
+
+### EOF
@@ -0,0 +1,121 @@
+# test_annotate.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the in-process lookups of the annotation stages in annotate.py
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import annotate as ann
+import interval_index as ii
+import position_index as pi
+
+NAMES = ['chr', 'start', 'end', 'haplotypeReference', 'haplotypeAlternate',
+    'name', 'name2']
+
+"""A BigRefGeneStage on in-memory tables, without a database connection
+"""
+def bigRefGeneStage(base_rows, nobase_rows=[]):
+    base = pi.PositionIndex(NAMES)
+    for row in base_rows:
+        base.add(row[0], row[1], row)
+    nobase = pi.PositionIndex(NAMES)
+    for row in nobase_rows:
+        nobase.add(row[0], row[1], row)
+
+    stage = ann.BigRefGeneStage.__new__(ann.BigRefGeneStage)
+    stage.inds = ann.getFormatSpecificIndices(format='vcf')
+    stage.prefetched = None
+    stage.indexes = (base, nobase, ii.IntervalIndex().build())
+    return stage
+
+
+def record(ref, alt, chrom='1', pos=100):
+    return [chrom, str(pos), '.', ref, alt, '50', 'PASS', '.']
+
+
+class BigRefGeneCascadeTest(unittest.TestCase):
+    def firstMatch(self, stage, fields):
+        for rows in stage.cascade('1', fields[1], fields):
+            if (len(rows) > 0):
+                return rows
+        return []
+
+    def testAllelesMatchCaseInsensitively(self):
+        upper = ('1', 100, 100, 'A', 'G', 'NM_1', 'GENE1')
+        lower = ('1', 100, 100, 'c', 't', 'NM_2', 'GENE2')
+        stage = bigRefGeneStage([upper, lower])
+        self.assertEqual(self.firstMatch(stage, record('a', 'g')), [upper])
+        self.assertEqual(self.firstMatch(stage, record('A', 'G')), [upper])
+        self.assertEqual(self.firstMatch(stage, record('C', 'T')), [lower])
+
+    def testComplementAsTheQueriesTakeIt(self):
+        comp = ('1', 100, 100, 'T', 'C', 'NM_1', 'GENE1')
+        nobase = ('1', 100, 100, '', '', 'NM_3', 'GENE3')
+        stage = bigRefGeneStage([comp], [nobase])
+        self.assertEqual(self.firstMatch(stage, record('A', 'G')), [comp])
+        # getComplementary() only knows upper-case bases, so the query for
+        # a lower-case variant has no complement and falls through
+        self.assertEqual(self.firstMatch(stage, record('a', 'g')), [nobase])
+
+    def testBatchRowsMatchAsTheQueries(self):
+        upper = ('1', 100, 100, 'A', 'G', 'NM_1', 'GENE1')
+        stage = bigRefGeneStage([])
+        stage.indexes = None
+        stage.prefetched = (({('1', 100): [upper]}, NAMES), {}, {})
+        self.assertEqual(self.firstMatch(stage, record('a', '"g')), [upper])
+
+    def testAlleleKeys(self):
+        self.assertEqual(ann.alleleKeys('a', 'Tg'), ('A', 'TG'))
+        self.assertEqual(ann.alleleKeys(), ())
+
+
+# dbSNP columns: CHR, POS, bin, RSID, REF, ALT, INFO, GMAF
+class DbSnpLookupTest(unittest.TestCase):
+    def testBatchRefMatchesCaseInsensitively(self):
+        rows = [('1', 100, 0, 'rs1', 'A', 'G', 'SNV', '0.1'),
+            ('1', 100, 0, 'rs2', 'T', 'C', 'SNV', '.'),
+            ('1', 100, 0, 'rs3', 'c', 'T', 'SNV', '.')]
+        stage = ann.DbSnpStage.__new__(ann.DbSnpStage)
+        stage.inds = ann.getFormatSpecificIndices(format='vcf')
+        stage.index = None
+        stage.prefetched = ({('1', 100): rows}, 4)
+        self.assertEqual(stage.lookupSnps('1', '100', record('A', 'G')),
+            [('rs1', '0.1'), ('rs2', '.')])
+        self.assertEqual(stage.lookupSnps('1', '100', record('a', 'g')),
+            [('rs1', '0.1')])
+        self.assertEqual(stage.lookupSnps('1', '100', record('C', 'T')),
+            [('rs3', '.')])
+
+    def testIndexRefMatchesCaseInsensitively(self):
+        class Index(object):
+            def positions(self, chrom):
+                return [50, 100]
+            def records(self, chrom, i):
+                return [('A', 'SNV', 'rs1', '0.1'), ('t', 'SNV', 'rs2', '.'),
+                    ('A', 'MNV', 'rs4', '.')]
+
+        stage = ann.DbSnpStage.__new__(ann.DbSnpStage)
+        stage.inds = ann.getFormatSpecificIndices(format='vcf')
+        stage.index = Index()
+        stage.varclass = 'SNV'
+        self.assertEqual(stage.lookupSnps('1', '100', record('a', 'g')),
+            [('rs1', '0.1')])
+        self.assertEqual(stage.lookupSnps('1', '100', record('A', 'G')),
+            [('rs1', '0.1'), ('rs2', '.')])
+        self.assertEqual(stage.lookupSnps('1', '99', record('A', 'G')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+### EOF
@@ -0,0 +1,115 @@
+# test_async_lookup.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the concurrent per-variant lookups of async_lookup.py, on
+# connections that answer from a dict
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import time
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import async_lookup as al
+
+"""Connections answering statements from a dict, slowly, and counting
+   the statements sent and the most running at once
+"""
+class FakeDatabase(object):
+    def __init__(self, answers):
+        self.answers = answers
+        self.lock = threading.Lock()
+        self.sent = []
+        self.running = 0
+        self.most = 0
+
+    def connect(self):
+        return FakeConnection(self)
+
+
+class FakeConnection(object):
+    def __init__(self, db):
+        self.db = db
+        self.busy = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        pass
+
+
+class FakeCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = None
+
+    def execute(self, sql):
+        db = self.conn.db
+        assert not self.conn.busy
+        self.conn.busy = True
+        with db.lock:
+            db.sent.append(sql)
+            db.running = db.running + 1
+            db.most = max(db.most, db.running)
+        time.sleep(0.01)
+        with db.lock:
+            db.running = db.running - 1
+        self.conn.busy = False
+        self.rows = db.answers.get(sql, ())
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class AsyncLookupTest(unittest.TestCase):
+    def setUp(self):
+        self.connect = al.u.db_connect
+
+    def tearDown(self):
+        al.u.db_connect = self.connect
+
+    def lookup(self, answers, inflight):
+        self.db = FakeDatabase(answers)
+        al.u.db_connect = self.db.connect
+        return al.AsyncLookup(inflight=inflight)
+
+    def testInflightStatementsAtOnce(self):
+        lookup = self.lookup({}, 8)
+        results = lookup.run([['q' + str(i)] for i in range(40)])
+        lookup.close()
+        self.assertEqual(len(results), 40)
+        self.assertEqual(len(self.db.sent), 40)
+        self.assertGreater(self.db.most, 4)
+        self.assertLessEqual(self.db.most, 8)
+
+    def testChainStopsAtFirstRows(self):
+        lookup = self.lookup({'b': (('row',),)}, 2)
+        results = lookup.run([['a', 'b', 'c']])
+        lookup.close()
+        self.assertEqual(results, {'a': (), 'b': (('row',),)})
+        self.assertEqual(self.db.sent, ['a', 'b'])
+
+    def testSharedStatementRunsOnce(self):
+        lookup = self.lookup({'b': (('row',),)}, 8)
+        results = lookup.run([['a', 'b'], ['a', 'b'], ['b'], ['a', 'c']])
+        lookup.close()
+        self.assertEqual(sorted(self.db.sent), ['a', 'b', 'c'])
+        self.assertEqual(results['b'], (('row',),))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+### EOF
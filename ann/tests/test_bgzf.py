@@ -0,0 +1,195 @@
+# test_bgzf.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the BGZF writer and tabix index of bgzf.py
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import gzip
+import struct
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import bgzf
+
+HEADER = '##fileformat=VCFv4.1\n' + \
+    '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+
+"""Records enough to span several BGZF blocks and linear windows
+"""
+def sortedRecords():
+    lines = []
+    for chrom in ['1', '2', 'X']:
+        for i in range(4000):
+            pos = 1000 + i * 37
+            lines.append(f"{chrom}\t{pos}\t.\tAC\tA\t50\tPASS\t" + \
+                f"DP={i};AF=0.5\n")
+    return lines
+
+
+"""Uncompressed offsets of the blocks of a BGZF file, {coffset: offset}
+"""
+def blockOffsets(filename):
+    offsets = {}
+    with open(filename, 'rb') as fh:
+        data = fh.read()
+    coffset = 0
+    offset = 0
+    while (coffset < len(data)):
+        bsize = struct.unpack('<H', data[coffset + 16:coffset + 18])[0] + 1
+        isize = struct.unpack('<I', data[coffset + bsize - 4:
+            coffset + bsize])[0]
+        offsets[coffset] = offset
+        coffset = coffset + bsize
+        offset = offset + isize
+    return offsets
+
+
+"""Line of text starting at a virtual offset, None if the offset is not
+   at the start of a line
+"""
+def lineAt(text, offsets, voffset):
+    offset = offsets[voffset >> 16] + (voffset & 0xffff)
+    if (offset > 0) and (text[offset - 1] != '\n'):
+        return None
+    return text[offset:text.index('\n', offset) + 1]
+
+
+"""Names, chunks ({name: [(vbeg, vend), ...]}) and linear indexes of a
+   .tbi file
+"""
+def readTabix(filename):
+    data = gzip.open(filename, 'rb').read()
+    assert data[:4] == b'TBI\1'
+    n_ref, fmt, col_seq, col_beg, col_end, meta, skip, l_nm = \
+        struct.unpack('<8i', data[4:36])
+    names = data[36:36 + l_nm].split(b'\0')[:n_ref]
+    at = 36 + l_nm
+    chunks = {}
+    linears = {}
+    for name in names:
+        name = name.decode('utf-8')
+        n_bin = struct.unpack('<i', data[at:at + 4])[0]
+        at = at + 4
+        chunks[name] = []
+        for b in range(n_bin):
+            bin_no, n_chunk = struct.unpack('<Ii', data[at:at + 8])
+            at = at + 8
+            for c in range(n_chunk):
+                chunks[name].append(struct.unpack('<QQ', data[at:at + 16]))
+                at = at + 16
+        n_intv = struct.unpack('<i', data[at:at + 4])[0]
+        at = at + 4
+        linears[name] = struct.unpack('<' + str(n_intv) + 'Q',
+            data[at:at + 8 * n_intv])
+        at = at + 8 * n_intv
+    return ([n.decode('utf-8') for n in names], chunks, linears)
+
+
+class BgzfTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'test.vcf.gz')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, lines, index=True):
+        with bgzf.IndexedWriter(self.filename, index=index) as fh:
+            fh.write(HEADER)
+            for line in lines:
+                fh.write(line)
+
+    def testRoundTripThroughGzip(self):
+        lines = sortedRecords()
+        self.write(lines)
+        with gzip.open(self.filename, 'rt') as fh:
+            self.assertEqual(fh.read(), HEADER + ''.join(lines))
+        with open(self.filename, 'rb') as fh:
+            self.assertTrue(fh.read().endswith(bgzf.EOF_BLOCK))
+        self.assertGreater(len(blockOffsets(self.filename)), 3)
+
+    def testWritesInPiecesAsWhole(self):
+        text = HEADER + ''.join(sortedRecords())
+        with bgzf.IndexedWriter(self.filename) as fh:
+            for i in range(0, len(text), 1000):
+                fh.write(text[i:i + 1000])
+        with gzip.open(self.filename, 'rt') as fh:
+            self.assertEqual(fh.read(), text)
+        names, chunks, linears = readTabix(self.filename + '.tbi')
+        self.assertEqual(names, ['1', '2', 'X'])
+
+    def testVirtualOffsetsPointAtRecords(self):
+        lines = sortedRecords()
+        self.write(lines)
+        text = HEADER + ''.join(lines)
+        offsets = blockOffsets(self.filename)
+        names, chunks, linears = readTabix(self.filename + '.tbi')
+
+        self.assertEqual(names, ['1', '2', 'X'])
+        for name in names:
+            self.assertGreater(len(chunks[name]), 0)
+            for (vbeg, vend) in chunks[name]:
+                line = lineAt(text, offsets, vbeg)
+                self.assertIsNotNone(line)
+                self.assertTrue(line.startswith(name + '\t'))
+                self.assertLess(vbeg, vend)
+            for voffset in linears[name]:
+                line = lineAt(text, offsets, voffset)
+                self.assertIsNotNone(line)
+                self.assertTrue(line.startswith(name + '\t'))
+
+    def testFirstRecordOfEachWindow(self):
+        lines = sortedRecords()
+        self.write(lines)
+        text = HEADER + ''.join(lines)
+        offsets = blockOffsets(self.filename)
+        names, chunks, linears = readTabix(self.filename + '.tbi')
+
+        firsts = {}
+        for line in lines:
+            chrom, pos = line.split('\t')[:2]
+            window = (int(pos) - 1) >> bgzf.LINEAR_SHIFT
+            firsts.setdefault((chrom, window), line)
+        for ((chrom, window), line) in firsts.items():
+            self.assertEqual(lineAt(text, offsets, linears[chrom][window]),
+                line)
+
+    def testUnsortedDropsIndex(self):
+        lines = sortedRecords()
+        self.write(lines)
+        self.assertTrue(os.path.exists(self.filename + '.tbi'))
+
+        unsorted = lines[:10] + [lines[5]] + lines[10:]
+        self.write(unsorted)
+        self.assertFalse(os.path.exists(self.filename + '.tbi'))
+        with gzip.open(self.filename, 'rt') as fh:
+            self.assertEqual(fh.read(), HEADER + ''.join(unsorted))
+
+    def testChromosomeComingBackDropsIndex(self):
+        lines = sortedRecords()
+        self.write(lines[:100] + lines[4000:4100] + lines[100:200])
+        self.assertFalse(os.path.exists(self.filename + '.tbi'))
+
+    def testNoIndexRequested(self):
+        self.write(sortedRecords(), index=False)
+        self.assertFalse(os.path.exists(self.filename + '.tbi'))
+
+    def testReg2bin(self):
+        self.assertEqual(bgzf.reg2bin(0, 1), 4681)
+        self.assertEqual(bgzf.reg2bin(16383, 16385), 585)
+        self.assertEqual(bgzf.reg2bin(0, 1 << 29), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+### EOF
@@ -0,0 +1,166 @@
+# test_external_sort.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the bounded-memory merge sort and order restore of
+# external_sort.py
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import gzip
+import random
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import external_sort as es
+
+HEADER = ['##fileformat=VCFv4.1',
+    '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO']
+
+CHROMS = ['1', 'chr1', '2', '10', 'chr22', 'X', 'chrY', 'M', 'GL000192.1']
+
+"""Unsorted records, with repeated positions whose input order must be
+   kept. The ID column holds the input record number
+"""
+def shuffledRecords(n=3000, seed=7):
+    rng = random.Random(seed)
+    lines = []
+    for i in range(n):
+        chrom = rng.choice(CHROMS)
+        pos = rng.randint(1, 200)
+        lines.append(f"{chrom}\t{pos}\trec{i}\tA\tG\t50\tPASS\tDP={i}")
+    return lines
+
+
+"""The order sortVcf() should produce, with an in-memory stable sort
+"""
+def expectedOrder(lines):
+    def key(line):
+        fields = line.split('\t')
+        return (es.chromKey(fields[0]), int(fields[1]))
+    return sorted(lines, key=key)
+
+
+class ExternalSortTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.infile = self.path('input.vcf')
+        self.sortedfile = self.path('sorted.vcf')
+        self.orderfile = self.path('sorted.order')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def writeInput(self, lines):
+        with open(self.infile, 'w') as fh:
+            for line in HEADER + lines:
+                fh.write(line + '\n')
+
+    def readLines(self, filename):
+        with gzip.open(filename, 'rt') if filename.endswith('.gz') \
+            else open(filename) as fh:
+            return fh.read().split('\n')[:-1]
+
+    def sortInput(self, lines, memory=es.SORT_MEMORY):
+        self.writeInput(lines)
+        es.sortVcf(self.infile, self.sortedfile, self.orderfile,
+            memory=memory)
+        return self.readLines(self.sortedfile)
+
+    def testChromKey(self):
+        names = ['chrM', 'X', '10', 'chr2', 'GL000192.1', '1', 'Y', 'chr22']
+        self.assertEqual(sorted(names, key=es.chromKey),
+            ['1', 'chr2', '10', 'chr22', 'GL000192.1', 'chrM', 'X', 'Y'])
+        self.assertEqual(es.chromKey('chr1'), es.chromKey('1'))
+
+    def testSortInMemory(self):
+        lines = shuffledRecords()
+        out = self.sortInput(lines)
+        self.assertEqual(out[:len(HEADER)], HEADER)
+        self.assertEqual(out[len(HEADER):], expectedOrder(lines))
+
+    def testSortWithSpilledRuns(self):
+        lines = shuffledRecords()
+        # about 15 records per run
+        out = self.sortInput(lines, memory=15 * (es.RECORD_OVERHEAD + 40))
+        self.assertEqual(out, HEADER + expectedOrder(lines))
+
+    def testMergeInSeveralPasses(self):
+        lines = shuffledRecords(n=1000)
+        records = list(enumerate(lines))
+        key = es.recordKey()
+        runs = tempfile.mkdtemp(dir=self.tmpdir.name)
+        # a run per record and four runs merged at once: four passes
+        out = list(es.sortRecords(iter(records), key, runs, memory=1,
+            fanin=4))
+        self.assertEqual([line for (recno, line) in out],
+            expectedOrder(lines))
+        self.assertEqual(os.listdir(runs), [])
+
+    def testOrderFileHoldsInputRecordNumbers(self):
+        lines = shuffledRecords(n=500)
+        out = self.sortInput(lines, memory=4096)
+        order = list(es.readOrder(self.orderfile, block=64))
+        self.assertEqual([lines[recno] for recno in order],
+            out[len(HEADER):])
+
+    def testRestoreOrder(self):
+        lines = shuffledRecords()
+        self.sortInput(lines, memory=8192)
+        outfile = self.path('restored.vcf')
+        self.assertTrue(es.restoreOrder(self.sortedfile, self.orderfile,
+            outfile, memory=8192))
+        self.assertEqual(self.readLines(outfile), HEADER + lines)
+
+    def testRestoreOrderCompressed(self):
+        lines = shuffledRecords(n=500)
+        self.sortInput(lines, memory=4096)
+        outfile = self.path('restored.vcf.gz')
+        self.assertTrue(es.restoreOrder(self.sortedfile, self.orderfile,
+            outfile, memory=4096))
+        self.assertEqual(self.readLines(outfile), HEADER + lines)
+        # the input order is not sorted, so no index is left
+        self.assertFalse(os.path.exists(outfile + '.tbi'))
+
+    def testRestoreOrderCountMismatch(self):
+        lines = shuffledRecords(n=200)
+        self.sortInput(lines)
+        with open(self.sortedfile, 'a') as fh:
+            fh.write('1\t5\textra\tA\tG\t50\tPASS\tDP=0\n')
+        outfile = self.path('restored.vcf')
+        self.assertFalse(es.restoreOrder(self.sortedfile, self.orderfile,
+            outfile))
+        self.assertFalse(os.path.exists(outfile))
+
+    def testEmptyInput(self):
+        out = self.sortInput([])
+        self.assertEqual(out, HEADER)
+        self.assertEqual(os.path.getsize(self.orderfile), 0)
+        outfile = self.path('restored.vcf')
+        self.assertTrue(es.restoreOrder(self.sortedfile, self.orderfile,
+            outfile))
+        self.assertEqual(self.readLines(outfile), HEADER)
+
+    def testTemporaryRunsRemoved(self):
+        lines = shuffledRecords(n=500)
+        self.sortInput(lines, memory=1024)
+        es.restoreOrder(self.sortedfile, self.orderfile,
+            self.path('restored.vcf'), memory=1024)
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)),
+            ['input.vcf', 'restored.vcf', 'sorted.order', 'sorted.vcf'])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+### EOF
@@ -0,0 +1,119 @@
+# test_fragment_sidecar.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the versioned fragment sidecar of fragment_sidecar.py, with
+# reference versions and no snapshot
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import fragment_sidecar as fs
+import snapshot
+
+STAGES = [('CytoBandStage', ['cytoBand']),
+    ('GwasCatalogStage', ['gwasCatalog']),
+    ('BigRefGeneStage', ['chrom_pos_equal_base', 'chrom_pos_unequal'])]
+
+KEYS = ['1\t100\tA\tG', '1\t200\tC\tT', 'X\t300\tG\tA']
+
+
+class FragmentSidecarTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'in.fragments')
+        self.environ = os.environ.pop(snapshot.SNAPSHOT_ENV, None)
+
+    def tearDown(self):
+        if self.environ is not None:
+            os.environ[snapshot.SNAPSHOT_ENV] = self.environ
+        self.tmpdir.cleanup()
+
+    """Annotate KEYS with a sidecar: every stage takes what the sidecar
+       has and computes the rest as '<stage> <tag> <key>'
+       Returns ({stage: {key: fragment}}, report lines)
+    """
+    def annotate(self, version, tag, stages=STAGES):
+        sidecar = fs.FragmentSidecar(self.path, version)
+        fragments = {}
+        for (name, tables) in stages:
+            sidecar.track(name, tables)
+            fragments[name] = sidecar.get(name, KEYS)
+            for key in KEYS:
+                if key not in fragments[name]:
+                    fragments[name][key] = [name, tag, key]
+                    sidecar.add(name, key, fragments[name][key])
+        report = sidecar.report()
+        sidecar.close()
+        return (fragments, report)
+
+    def testSplitVersion(self):
+        self.assertEqual(fs.splitVersion('r1'), ('r1', {}))
+        self.assertEqual(fs.splitVersion('r1; gwasCatalog=2 ;dbSNP = 150'),
+            ('r1', {'gwasCatalog': '2', 'dbSNP': '150'}))
+        self.assertEqual(fs.splitVersion(None), ('None', {}))
+
+    def testStageVersion(self):
+        cyto = fs.stageVersion(['cytoBand'], 'r1')
+        self.assertEqual(fs.stageVersion(['cytoBand'], 'r1; gwasCatalog=2'),
+            cyto)
+        self.assertNotEqual(fs.stageVersion(['cytoBand'], 'r1; cytoBand=2'),
+            cyto)
+        self.assertNotEqual(fs.stageVersion(['cytoBand'], 'r2'), cyto)
+        self.assertEqual(fs.stageVersion(['cytoBand'], 'r2; cytoBand=r1'),
+            cyto)
+
+    def testSameVersionReusesEverything(self):
+        first, report = self.annotate('r1', 'first')
+        again, report = self.annotate('r1', 'again')
+        self.assertEqual(again, first)
+        self.assertEqual(report, [f"{name}: 3 fragments kept, 0 recomputed"
+            for (name, tables) in STAGES])
+
+    def testTableVersionRecomputesItsStages(self):
+        first, report = self.annotate('r1', 'first')
+        second, report = self.annotate('r1; gwasCatalog=2', 'second')
+        self.assertEqual(second['CytoBandStage'], first['CytoBandStage'])
+        self.assertEqual(second['BigRefGeneStage'], first['BigRefGeneStage'])
+        self.assertEqual(second['GwasCatalogStage'],
+            dict([(key, ['GwasCatalogStage', 'second', key])
+                for key in KEYS]))
+        self.assertEqual(report, ['CytoBandStage: 3 fragments kept, ' + \
+            '0 recomputed', 'GwasCatalogStage: 0 fragments kept, ' + \
+            '3 recomputed', 'BigRefGeneStage: 3 fragments kept, ' + \
+            '0 recomputed'])
+
+        # the sidecar now holds the new fragments, under the new version
+        third, report = self.annotate('r1; gwasCatalog=2', 'third')
+        self.assertEqual(third, second)
+        self.assertEqual(self.annotate('r1', 'fourth')[0]['GwasCatalogStage'],
+            dict([(key, ['GwasCatalogStage', 'fourth', key])
+                for key in KEYS]))
+
+    def testNewReferenceVersionRecomputesAll(self):
+        self.annotate('r1', 'first')
+        second, report = self.annotate('r2', 'second')
+        for (name, tables) in STAGES:
+            self.assertEqual(second[name][KEYS[0]], [name, 'second', KEYS[0]])
+
+    def testUntrackedStagesKept(self):
+        first, report = self.annotate('r1', 'first')
+        self.annotate('r2', 'second', stages=STAGES[:1])
+        again, report = self.annotate('r1', 'again', stages=STAGES[1:])
+        self.assertEqual(again['GwasCatalogStage'],
+            first['GwasCatalogStage'])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+### EOF
@@ -0,0 +1,161 @@
+# test_sharding.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the shard planning, merging and count log merging of
+# sharding.py
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import sharding
+
+HEADER = ['##fileformat=VCFv4.1',
+    '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO']
+
+"""A count log as the stages write it, for a shard of `total - 1`
+   records
+"""
+def countLog(total, dbsnp, cds, hugo, hugo_variants, hits=None,
+    lookups=None, size=None):
+    lines = ['## Please notice that all Isoforms were counted',
+        '## Numbers may exceed number of variants in the annotated file',
+        f"Total: {total}",
+        f"In dbSNP: {dbsnp} ({(dbsnp / float(total)) * 100}%)",
+        'Variants located:',
+        f"In CDS {cds}",
+        f"In '3 UTR {cds * 2}",
+        f"In hugo: {hugo} in {hugo_variants} variants"]
+    if hits is not None:
+        lines.append(f"Cache hits: {hits} of {lookups} " + \
+            f"({(hits / float(lookups)) * 100}%)")
+        lines.append(f"Cache size: {size} bytes")
+    return lines
+
+
+class MergeCountLogsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def merge(self, logs):
+        names = []
+        for (n, log) in enumerate(logs):
+            names.append(os.path.join(self.tmpdir.name, f"{n}.count.log"))
+            with open(names[-1], 'w') as fh:
+                fh.write(''.join([l + '\n' for l in log]))
+        logfile = os.path.join(self.tmpdir.name, 'merged.count.log')
+        sharding.mergeCountLogs(names, logfile)
+        with open(logfile) as fh:
+            return fh.read().splitlines()
+
+    def testCountsSummed(self):
+        merged = self.merge([countLog(11, 4, 3, 20, 9),
+            countLog(21, 6, 5, 7, 2), countLog(31, 0, 0, 0, 0)])
+        # one extra per shard in the totals, one left for the whole file
+        self.assertEqual(merged, countLog(61, 10, 8, 27, 11))
+
+    def testSingleShardUnchanged(self):
+        log = countLog(2631, 287, 417, 29918, 2602, hits=10, lookups=40,
+            size=512)
+        self.assertEqual(self.merge([log]), log)
+
+    def testDbsnpRatioFromMergedCounts(self):
+        merged = self.merge([countLog(3, 2, 0, 0, 0),
+            countLog(9, 0, 0, 0, 0)])
+        self.assertIn('Total: 11', merged)
+        self.assertIn(f"In dbSNP: 2 ({(2 / 11.0) * 100}%)", merged)
+
+    def testCacheLines(self):
+        merged = self.merge([
+            countLog(11, 0, 0, 0, 0, hits=30, lookups=40, size=4096),
+            countLog(11, 0, 0, 0, 0, hits=0, lookups=10, size=1024)])
+        self.assertIn(f"Cache hits: 30 of 50 ({(30 / 50.0) * 100}%)", merged)
+        self.assertIn('Cache size: 4096 bytes', merged)
+
+    def testNoCacheLookups(self):
+        log = ['Total: 1', 'Cache hits: 0 of 0 (0.0%)',
+            'Cache size: 0 bytes']
+        self.assertEqual(self.merge([log, log]), log)
+
+    def testDifferentLinesRejected(self):
+        with self.assertRaises(ValueError):
+            self.merge([countLog(11, 4, 3, 20, 9),
+                countLog(11, 4, 3, 20, 9)[:-1]])
+
+
+class ShardsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def testPlanBalancesAndKeepsSmallChromosomesWhole(self):
+        keys = [('1', p) for p in range(100, 0, -1)] + \
+            [('2', p) for p in range(10)] + [('3', p) for p in range(10)]
+        assignment, nshards = sharding.planShards(keys, 4)
+        self.assertEqual(len(assignment), len(keys))
+        self.assertEqual(set(assignment), set(range(nshards)))
+        # chromosome 1 is cut into position ranges of at most the target
+        target = -(-len(keys) // 4)
+        for s in range(nshards):
+            self.assertLessEqual(list(assignment).count(s), target)
+        by_pos = sorted(range(100), key=lambda i: keys[i][1])
+        shards = [assignment[i] for i in by_pos]
+        self.assertEqual(shards, sorted(shards))
+        # the small chromosomes share one shard
+        self.assertEqual(len(set(assignment[100:])), 1)
+
+    def testWriteAndMergeRoundTrip(self):
+        lines = [f"{c}\t{p}\t.\tA\tG\t50\tPASS\tDP={p}"
+            for c in ['1', '2', 'X'] for p in range(1, 40)]
+        infile = os.path.join(self.tmpdir.name, 'in.vcf')
+        with open(infile, 'w') as fh:
+            fh.write(''.join([l + '\n' for l in HEADER + lines]))
+
+        header, keys = sharding.scanInput(infile)
+        self.assertEqual(header, HEADER)
+        assignment, nshards = sharding.planShards(keys, 3)
+        self.assertEqual(nshards, 3)
+        names = sharding.writeShards(infile,
+            os.path.join(self.tmpdir.name, 'shards'), header, assignment,
+            nshards)
+
+        outfile = os.path.join(self.tmpdir.name, 'out.vcf')
+        self.assertTrue(sharding.mergeShards(names, outfile, len(header),
+            assignment))
+        with open(outfile) as fh:
+            self.assertEqual(fh.read().splitlines(), HEADER + lines)
+
+    def testMergeRejectsSplitLines(self):
+        keys = [('1', p) for p in range(10)]
+        assignment, nshards = sharding.planShards(keys, 2)
+        names = []
+        for s in range(nshards):
+            names.append(os.path.join(self.tmpdir.name, f"{s}.vcf"))
+            count = list(assignment).count(s) + (1 if s == 0 else 0)
+            with open(names[-1], 'w') as fh:
+                fh.write(''.join([l + '\n' for l in HEADER]))
+                fh.write('1\t1\t.\tA\tG\t50\tPASS\t.\n' * count)
+        outfile = os.path.join(self.tmpdir.name, 'out.vcf')
+        self.assertFalse(sharding.mergeShards(names, outfile, len(HEADER),
+            assignment))
+        self.assertFalse(os.path.exists(outfile))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+### EOF
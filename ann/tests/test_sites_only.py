@@ -0,0 +1,108 @@
+# test_sites_only.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of setting the sample columns aside and merging them back in
+# sites_only.py
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import sites_only as so
+import vcf_record as vr
+
+HEADER = ['##fileformat=VCFv4.1',
+    '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\tS2']
+
+LINES = ['1\t100\t.\tA\tG\t50\tPASS\tDP=5\tGT:DP\t0/1:3\t1/1:2',
+    '1\t200\t.\tC\tT\t50\tPASS\t\tGT\t0/1\t0/0',
+    '2\t300\t.\tG\tA\t50\tPASS\tDP=1 \tGT\t1/1\t0/1',
+    'X\t400\t.\tT\tC\t50\tPASS\tDP=7']
+
+"""Annotate a line as a stage would: append to INFO, and with gadAll's
+   separator on some records
+"""
+def annotateLine(line, n):
+    record = vr.VariantRecord(line.strip())
+    record.appendInfo(';N=' + str(n))
+    if (n % 2 == 0):
+        record.setSeparator('\t ')
+    return record.text()
+
+
+class SitesOnlyTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.infile = self.path('in.vcf')
+        self.sites = self.path('in.sites')
+        self.samples = self.path('in.samples')
+        with open(self.infile, 'w') as fh:
+            fh.write(''.join([l + '\n' for l in HEADER + LINES]))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    """Lines of text annotated by annotateLine, header lines as they are
+    """
+    def annotate(self, lines):
+        return [l if l.startswith('#') else annotateLine(l, n)
+            for (n, l) in enumerate(lines)]
+
+    def readLines(self, filename):
+        with open(filename) as fh:
+            return fh.read().splitlines()
+
+    def testSitesKeepInfoColumn(self):
+        self.assertEqual(so.splitSamples(self.infile, self.sites,
+            self.samples), len(LINES))
+        sites = self.readLines(self.sites)
+        self.assertEqual(sites[1], '#CHROM\tPOS\tID\tREF\tALT\tQUAL\t' + \
+            'FILTER\tINFO')
+        # the empty INFO is not the end of the line, so it is not stripped
+        record = vr.VariantRecord(sites[3].strip())
+        self.assertEqual(record.info(), '')
+        self.assertEqual(record.fields[vr.REST_IND], so.PLACEHOLDER)
+        self.assertEqual(sites[5], LINES[3])
+        self.assertEqual(self.readLines(self.samples),
+            ['#\tFORMAT\tS1\tS2', '0\tGT:DP\t0/1:3\t1/1:2',
+                '1\tGT\t0/1\t0/0', '2\tGT\t1/1\t0/1'])
+
+    def testMergeAsIfAnnotatedWhole(self):
+        count = so.splitSamples(self.infile, self.sites, self.samples)
+        annotated = self.path('in.sites.annot')
+        with open(annotated, 'w') as fh:
+            fh.write(''.join([l + '\n' for l in
+                self.annotate(self.readLines(self.sites))]))
+        outfile = self.path('in.annot.vcf')
+        so.mergeSamples(annotated, self.samples, outfile, count)
+        self.assertEqual(self.readLines(outfile),
+            self.annotate(HEADER + LINES))
+
+    def testSplitRecordFails(self):
+        count = so.splitSamples(self.infile, self.sites, self.samples)
+        annotated = self.path('in.sites.annot')
+        sites = self.readLines(self.sites)
+        with open(annotated, 'w') as fh:
+            fh.write(''.join([l + '\n' for l in sites + sites[-1:]]))
+        outfile = self.path('in.annot.vcf')
+        with self.assertRaises(ValueError):
+            so.mergeSamples(annotated, self.samples, outfile, count)
+        self.assertFalse(os.path.exists(outfile))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+### EOF
@@ -0,0 +1,199 @@
+# test_snapshot.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of snapshot.py: building a snapshot from dump files and answering
+# the stages' SQL from it, checked against SQLite on the same rows
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import sqlite3
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import snapshot
+
+CYTOBAND_SQL = '''CREATE TABLE `cytoBand` (
+  `chrom` varchar(255) NOT NULL,
+  `chromStart` int(10) unsigned NOT NULL,
+  `chromEnd` int(10) unsigned NOT NULL,
+  `name` varchar(255) NOT NULL,
+  `gieStain` varchar(255) NOT NULL
+);
+'''
+
+# Rows in table order: chromosomes interleaved, starts out of order and
+# repeated, a NULL end and escaped text
+CYTOBAND_ROWS = [
+    ('chr1', 1000, 2000, 'p36.33', 'gneg'),
+    ('chr2', 300, 900, 'p25.3', 'gpos50'),
+    ('chr1', 0, 1200, 'p36.32', 'gpos25'),
+    ('chr1', 1000, 1600, 'p36.31', 'gneg'),
+    ('chr2', 300, 400, 'p25.2', 'gneg'),
+    ('chr1', 1800, None, 'p36.23', 'gvar'),
+    ('chr1', 2500, 4000, 'p36.22\ttab', 'acen'),
+    ('chrX', 50, 150, 'p22.33', 'gneg'),
+]
+
+SQLITE_TABLE = 'create table cytoBand (chrom text, chromStart integer, ' + \
+    'chromEnd integer, name text, gieStain text)'
+
+"""A mysqldump --tab line of a row
+"""
+def dumpLine(row):
+    fields = []
+    for value in row:
+        if value is None:
+            fields.append('\\N')
+        else:
+            fields.append(str(value).replace('\\', '\\\\').replace('\t',
+                '\\t'))
+    return '\t'.join(fields) + '\n'
+
+
+def writeDump(dumpdir, rows):
+    with open(os.path.join(dumpdir, 'cytoBand.sql'), 'w') as fh:
+        fh.write(CYTOBAND_SQL)
+    with open(os.path.join(dumpdir, 'cytoBand.txt'), 'w') as fh:
+        for row in rows:
+            fh.write(dumpLine(row))
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dumpdir = os.path.join(self.tmpdir.name, 'dump')
+        self.root = os.path.join(self.tmpdir.name, 'root')
+        os.makedirs(self.dumpdir)
+        writeDump(self.dumpdir, CYTOBAND_ROWS)
+        self.directory = snapshot.buildSnapshot(self.root, version='v1',
+            dumpdir=self.dumpdir, tables=['cytoBand'])
+        self.conn = snapshot.SnapshotConnection(
+            snapshot.Snapshot(self.directory))
+        self.sqlite = sqlite3.connect(':memory:')
+        self.sqlite.execute(SQLITE_TABLE)
+        self.sqlite.executemany('insert into cytoBand values (?, ?, ?, ?, ?)',
+            CYTOBAND_ROWS)
+
+    def tearDown(self):
+        self.sqlite.close()
+        self.tmpdir.cleanup()
+        os.environ.pop(snapshot.SNAPSHOT_ENV, None)
+
+    def query(self, sql, args=None):
+        cursor = self.conn.cursor()
+        cursor.execute(sql, args)
+        return [tuple(row) for row in cursor.fetchall()]
+
+    def expected(self, sql, args=()):
+        return [tuple(row) for row in self.sqlite.execute(sql, args)]
+
+    def assertSameRows(self, sql, oracle=None, ordered=True):
+        rows = self.query(sql)
+        expected = self.expected(oracle or sql)
+        if not ordered:
+            rows = sorted(rows, key=repr)
+            expected = sorted(expected, key=repr)
+        self.assertEqual(rows, expected)
+
+    def testCurrentAndManifest(self):
+        self.assertEqual(os.readlink(os.path.join(self.root, 'current')),
+            'v1')
+        with open(os.path.join(self.directory, 'manifest.json')) as fh:
+            manifest = json.load(fh)
+        meta = manifest['tables']['cytoBand']
+        self.assertEqual(meta['position'], 'chromStart')
+        self.assertEqual(sum([p[2] for p in meta['partitions']]),
+            len(CYTOBAND_ROWS))
+        self.assertIn('chromEnd', meta['nullable'])
+
+    def testOverlapQueries(self):
+        for pos in [0, 999, 1000, 1500, 1800, 2000, 2001, 5000]:
+            self.assertSameRows('select * from cytoBand where ' + \
+                f"chrom='chr1' AND chromStart <= {pos} AND " + \
+                f"{pos} <= chromEnd;")
+
+    def testArithmeticBounds(self):
+        self.assertSameRows('select chrom, chromStart, name from cytoBand ' + \
+            "where chrom = 'chr2' and (chromStart - 100) <= 950 and " + \
+            '950 <= (chromEnd + 100)')
+
+    def testEqualPosition(self):
+        self.assertSameRows('select name from cytoBand where ' + \
+            "chrom = 'chr2' and chromStart = 300")
+        self.assertEqual(self.query('select name from cytoBand where ' + \
+            'chrom = %s and chromStart = %s', ('chr1', 1000)),
+            [('p36.33',), ('p36.31',)])
+
+    def testDoubleQuotedStrings(self):
+        self.assertEqual(self.query('select name from cytoBand where ' + \
+            'chrom="chrX"'), [('p22.33',)])
+
+    def testOrAndNotEqual(self):
+        self.assertSameRows('select * from cytoBand where ' + \
+            "(chrom = 'chrX' or chromStart = 2500) and gieStain != 'gneg'",
+            ordered=False)
+        self.assertSameRows("select * from cytoBand where gieStain <> 'gneg'",
+            ordered=False)
+
+    def testNullNeverMatches(self):
+        self.assertSameRows('select name from cytoBand where ' + \
+            "chrom = 'chr1' and chromEnd >= 0")
+
+    def testOrderByPosition(self):
+        self.assertSameRows("select * from cytoBand where chrom = 'chr1' " + \
+            'order by chromStart', "select * from cytoBand where " + \
+            "chrom = 'chr1' order by chromStart, rowid")
+
+    def testDistinctAndLimit(self):
+        self.assertSameRows('select distinct chrom from cytoBand',
+            ordered=False)
+        self.assertSameRows('select distinct gieStain from cytoBand',
+            ordered=False)
+        self.assertEqual(len(self.query('select * from cytoBand limit 3')), 3)
+
+    def testEscapedText(self):
+        self.assertEqual(self.query('select name from cytoBand where ' + \
+            "chrom = 'chr1' and chromStart = 2500"), [('p36.22\ttab',)])
+
+    def testReadOnlyAndUnsupported(self):
+        cursor = self.conn.cursor()
+        with self.assertRaises(snapshot.SnapshotError):
+            cursor.execute('delete from cytoBand')
+        with self.assertRaises(snapshot.SnapshotError):
+            cursor.execute('select * from cytoBand order by name')
+        with self.assertRaises(snapshot.SnapshotError):
+            cursor.execute('select * from cytoBand where chrom = %s',
+                ('chr1', 'chr2'))
+
+    def testTableDigests(self):
+        again = snapshot.buildSnapshot(self.root, version='v2',
+            dumpdir=self.dumpdir, tables=['cytoBand'])
+        rows = list(CYTOBAND_ROWS)
+        rows[0] = ('chr1', 1000, 2001, 'p36.33', 'gneg')
+        writeDump(self.dumpdir, rows)
+        changed = snapshot.buildSnapshot(self.root, version='v3',
+            dumpdir=self.dumpdir, tables=['cytoBand'])
+
+        digests = []
+        for directory in [self.directory, again, changed]:
+            os.environ[snapshot.SNAPSHOT_ENV] = directory
+            digests.append(snapshot.tableVersion('cytoBand'))
+        self.assertEqual(digests[0], digests[1])
+        self.assertNotEqual(digests[0], digests[2])
+        os.environ.pop(snapshot.SNAPSHOT_ENV)
+        self.assertIsNone(snapshot.tableVersion('cytoBand'))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+### EOF
@@ -0,0 +1,181 @@
+# test_sweep_join.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the sorted-input sweep join of sweep_join.py, reading a
+# snapshot and a SQL cursor, checked against a scan of every row
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import random
+import sqlite3
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import snapshot
+import sweep_join as sj
+
+CYTOBAND_SQL = '''CREATE TABLE `cytoBand` (
+  `chrom` varchar(255) NOT NULL,
+  `chromStart` int(10) unsigned NOT NULL,
+  `chromEnd` int(10) unsigned NOT NULL,
+  `name` varchar(255) NOT NULL,
+  `gieStain` varchar(255) NOT NULL
+);
+'''
+
+"""Random, overlapping intervals in no particular order, with repeated
+   starts and one row without an end
+"""
+def cytoBandRows(n=400, seed=3):
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n):
+        chrom = rng.choice(['chr1', 'chr2', 'chrX'])
+        start = rng.randrange(0, 5000, 10)
+        rows.append((chrom, start, start + rng.randrange(0, 400),
+            'band' + str(i), 'gneg'))
+    rows.append(('chr1', 1000, None, 'noend', 'gvar'))
+    return rows
+
+
+"""Rows overlapping a position, in table order, as a scan finds them
+"""
+def scan(rows, chrom, pos):
+    return [row for row in rows if (row[0] == chrom) and
+        (row[2] is not None) and (row[1] <= pos <= row[2])]
+
+
+class SnapshotSweepTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        dumpdir = os.path.join(self.tmpdir.name, 'dump')
+        os.makedirs(dumpdir)
+        self.rows = cytoBandRows()
+        with open(os.path.join(dumpdir, 'cytoBand.sql'), 'w') as fh:
+            fh.write(CYTOBAND_SQL)
+        with open(os.path.join(dumpdir, 'cytoBand.txt'), 'w') as fh:
+            for row in self.rows:
+                fh.write('\t'.join(['\\N' if v is None else str(v)
+                    for v in row]) + '\n')
+        directory = snapshot.buildSnapshot(os.path.join(self.tmpdir.name,
+            'root'), version='v1', dumpdir=dumpdir, tables=['cytoBand'])
+        os.environ[snapshot.SNAPSHOT_ENV] = directory
+
+    def tearDown(self):
+        os.environ.pop(snapshot.SNAPSHOT_ENV, None)
+        self.tmpdir.cleanup()
+
+    def sweep(self):
+        return sj.SweepJoin(lambda chrom: 'cytoBand', 'chrom', 'chromStart',
+            'chromEnd')
+
+    def testJoinMatchesScan(self):
+        join = self.sweep()
+        keys = [(chrom, pos) for chrom in ['chr1', 'chr2', 'chrX']
+            for pos in range(0, 5600, 37)]
+        found = {}
+        for i in range(0, len(keys), 25):
+            found.update(join.join(keys[i:i + 25]))
+        join.close()
+        for (chrom, pos) in keys:
+            rows = [tuple(row) for row in found.get((chrom, pos), [])]
+            self.assertEqual(rows, scan(self.rows, chrom, pos))
+
+    def testRepeatedPositions(self):
+        join = self.sweep()
+        found = join.join([('chr1', 1000), ('chr1', 1000), ('chr1', 1005)])
+        join.close()
+        self.assertEqual([tuple(row) for row in found[('chr1', 1000)]],
+            scan(self.rows, 'chr1', 1000))
+
+    def testUnsortedFallsBack(self):
+        join = self.sweep()
+        self.assertIsNotNone(join.join([('chr1', 100), ('chr1', 200)]))
+        self.assertIsNone(join.join([('chr1', 300), ('chr1', 150)]))
+        # and stays off for the rest of the file
+        self.assertIsNone(join.join([('chr2', 100)]))
+
+    def testChromosomeComingBackFallsBack(self):
+        join = self.sweep()
+        self.assertIsNotNone(join.join([('chr1', 100), ('chr2', 100)]))
+        self.assertIsNone(join.join([('chr1', 200)]))
+
+    def testInOrder(self):
+        join = self.sweep()
+        self.assertTrue(join.inOrder([('1', 5), ('1', 5), ('2', 1)]))
+        self.assertFalse(join.inOrder([('1', 5), ('2', 1), ('1', 6)]))
+        self.assertFalse(join.inOrder([('1', 5), ('1', 4)]))
+
+
+"""A pymysql-like connection on SQLite, for sqlIntervals()
+"""
+class SqliteConnection(object):
+    def __init__(self, rows):
+        self.db = sqlite3.connect(':memory:')
+        self.db.execute('create table cytoBand (chrom text, ' + \
+            'chromStart integer, chromEnd integer, name text, ' + \
+            'gieStain text)')
+        self.db.executemany('insert into cytoBand values (?, ?, ?, ?, ?)',
+            rows)
+        self.executed = []
+
+    def cursor(self, cls=None):
+        return SqliteCursor(self)
+
+
+class SqliteCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.db.cursor()
+
+    def execute(self, sql):
+        self.conn.executed.append(sql)
+        self.cursor.execute(sql.replace('"', "'"))
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def fetchmany(self, n):
+        return self.cursor.fetchmany(n)
+
+    def close(self):
+        self.cursor.close()
+
+
+class SqlIntervalsTest(unittest.TestCase):
+    def testStartOrderWithoutNulls(self):
+        rows = cytoBandRows()
+        conn = SqliteConnection(rows)
+        intervals = list(sj.sqlIntervals(conn, 'cytoBand', 'chrom', 'chr1',
+            'chromStart', 'chromEnd', chunk=7))
+        self.assertIn('order by t.chromStart', conn.executed[0])
+        starts = [start for (start, end, seq, row) in intervals]
+        self.assertEqual(starts, sorted(starts))
+        self.assertEqual(sorted([row for (start, end, seq, row)
+            in intervals]), sorted([row for row in rows
+            if (row[0] == 'chr1') and (row[2] is not None)]))
+        seqs = [seq for (start, end, seq, row) in intervals]
+        self.assertEqual(seqs, sorted(set(seqs)))
+
+    def testColumns(self):
+        conn = SqliteConnection(cytoBandRows())
+        intervals = list(sj.sqlIntervals(conn, 'cytoBand', 'chrom', 'chr2',
+            'chromStart', 'chromEnd', columns=['chromStart', 'chromEnd',
+            'name']))
+        self.assertTrue(all([len(row) == 3 for (start, end, seq, row)
+            in intervals]))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+### EOF
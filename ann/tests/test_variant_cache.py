@@ -0,0 +1,130 @@
+# test_variant_cache.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the size-bounded, least recently used variant cache of
+# variant_cache.py
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import variant_cache as vc
+
+INDS = [0, 1, 3, 4]
+
+"""Key of variant n, and a fragment of about 100 bytes for it
+"""
+def entry(n):
+    key = vc.variantKey(['1', str(1000 + n), '.', 'A', 'G'], INDS)
+    return (key, [n, 'x' * 90])
+
+
+def entrySize(n):
+    key, fragment = entry(n)
+    return len(key) + len(json.dumps(fragment))
+
+
+class VariantCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'cache.db')
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        self.tmpdir.cleanup()
+
+    def cache(self, version='r1', max_bytes=vc.CACHE_BYTES):
+        cache = vc.VariantCache(self.path, version, max_bytes=max_bytes)
+        self.caches.append(cache)
+        return cache
+
+    def keys(self, ns):
+        return [entry(n)[0] for n in ns]
+
+    def testVariantKey(self):
+        self.assertEqual(vc.variantKey(['chr1', ' 5 ', '.', 'A', 'G'], INDS),
+            '1\t5\tA\tG')
+        self.assertEqual(vc.variantKey(['X', '5', '.', 'A'], INDS),
+            'X\t5\tA\t')
+
+    def testFragmentsRoundTrip(self):
+        cache = self.cache()
+        fragments = {'a': None, 'b': [3, 'x;y', None], 'c': 'text\tz'}
+        cache.put('Stage', fragments)
+        self.assertEqual(cache.get('Stage', ['a', 'b', 'c', 'd', 'b']),
+            fragments)
+        self.assertEqual(cache.get('Other', ['a']), {})
+        self.assertEqual(cache.report()[0], 'Cache hits: 4 of 6 ' + \
+            f"({str((4 / 6.0) * 100)}%)")
+
+    def testVersionsKeptApart(self):
+        self.cache('r1').put('Stage', {'a': 1})
+        self.assertEqual(self.cache('r2').get('Stage', ['a']), {})
+        self.assertEqual(self.cache('r1').get('Stage', ['a']), {'a': 1})
+
+    def testSizeCountsEachEntryOnce(self):
+        cache = self.cache()
+        cache.put('Stage', dict([entry(0), entry(1)]))
+        cache.put('Stage', dict([entry(1)]))
+        self.assertEqual(cache.size(), entrySize(0) + entrySize(1))
+        self.assertEqual(cache.report()[1],
+            f"Cache size: {str(entrySize(0) + entrySize(1))} bytes")
+
+    def testSizeBounded(self):
+        max_bytes = 20 * entrySize(0)
+        cache = self.cache(max_bytes=max_bytes)
+        for n in range(100):
+            cache.put('Stage', dict([entry(n)]))
+            self.assertLessEqual(cache.size(), max_bytes)
+        found = cache.get('Stage', self.keys(range(100)))
+        self.assertEqual(cache.size(), sum([len(key) +
+            len(json.dumps(value)) for (key, value) in found.items()]))
+        self.assertGreaterEqual(len(found), 15)
+        # the newest entries are the ones kept
+        self.assertIn(entry(99)[0], found)
+        self.assertNotIn(entry(0)[0], found)
+
+    def testLeastRecentlyUsedEvicted(self):
+        cache = self.cache(max_bytes=int(10.5 * entrySize(0)))
+        cache.put('Stage', dict([entry(n) for n in range(5)]))
+        cache.put('Stage', dict([entry(n) for n in range(5, 10)]))
+        # reading 0..4 makes 5..9 the least recently used
+        self.assertEqual(len(cache.get('Stage', self.keys(range(5)))), 5)
+        cache.put('Stage', dict([entry(10), entry(11)]))
+        kept = cache.get('Stage', self.keys(range(12)))
+        for n in range(5):
+            self.assertIn(entry(n)[0], kept)
+        self.assertIn(entry(11)[0], kept)
+        self.assertNotIn(entry(5)[0], kept)
+
+    def testRecencyKeptAcrossProcesses(self):
+        cache = self.cache(max_bytes=int(4.5 * entrySize(0)))
+        cache.put('Stage', dict([entry(0), entry(1)]))
+        cache.put('Stage', dict([entry(2), entry(3)]))
+        cache.close()
+        self.caches.remove(cache)
+
+        cache = self.cache(max_bytes=int(4.5 * entrySize(0)))
+        self.assertEqual(cache.size(), 4 * entrySize(0))
+        cache.get('Stage', self.keys([0]))
+        cache.put('Stage', dict([entry(4)]))
+        kept = cache.get('Stage', self.keys(range(5)))
+        self.assertEqual(sorted(kept), sorted(self.keys([0, 2, 3, 4])))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+### EOF
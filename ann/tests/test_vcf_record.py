@@ -0,0 +1,174 @@
+# test_vcf_record.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the record splitting and joining of vcf_record.py
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import os
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import vcf_record as vr
+
+SITE = '1\t100\trs1\tA\tG\t50\tPASS\tDP=5;AF=0.5'
+SAMPLES = SITE + '\tGT:DP\t0/1:3\t1/1:2\t./.:0'
+
+"""Records the next stage reads from the text of a record written to a
+   file: one per line, each line stripped as Stage.record() strips it
+"""
+def reread(record, sep='\t'):
+    return [vr.VariantRecord(line.strip(), sep)
+        for line in re.split('\r\n|\r|\n', record.text())]
+
+
+class SplitJoinTest(unittest.TestCase):
+    def testSitesLine(self):
+        fields = vr.splitRecord(SITE)
+        self.assertEqual(len(fields), vr.COLUMNS)
+        self.assertEqual(fields[vr.INFO_IND], 'DP=5;AF=0.5')
+        self.assertEqual(vr.joinRecord(fields), SITE)
+
+    def testSampleColumnsKeptWhole(self):
+        fields = vr.splitRecord(SAMPLES)
+        self.assertEqual(len(fields), vr.REST_IND + 1)
+        self.assertEqual(fields[vr.INFO_IND], 'DP=5;AF=0.5')
+        self.assertEqual(fields[vr.REST_IND], 'GT:DP\t0/1:3\t1/1:2\t./.:0')
+        self.assertEqual(vr.joinRecord(fields), SAMPLES)
+
+    def testOtherSeparator(self):
+        line = SAMPLES.replace('\t', ',')
+        fields = vr.splitRecord(line, sep=',')
+        self.assertEqual(fields, SAMPLES.replace('\t', ',').split(',', 8))
+        self.assertEqual(vr.joinRecord(fields, sep=',', split=','), line)
+
+    def testJoinWithNewSeparator(self):
+        fields = vr.splitRecord(SAMPLES)
+        # every column gets the new separator, those in the rest included
+        self.assertEqual(vr.joinRecord(fields, sep='\t '),
+            SAMPLES.replace('\t', '\t '))
+        fields = vr.splitRecord(SAMPLES.replace('\t', ','), sep=',')
+        self.assertEqual(vr.joinRecord(fields, sep='\t', split=','),
+            SAMPLES)
+
+    def testEmptyInfo(self):
+        record = vr.VariantRecord(SAMPLES.replace('DP=5;AF=0.5', ''))
+        self.assertEqual(record.info(), '')
+        record.appendInfo(';DB')
+        self.assertEqual(record.text(),
+            SAMPLES.replace('DP=5;AF=0.5', ';DB'))
+        # without sample columns the stripped line has no INFO column
+        record = vr.VariantRecord((SITE.replace('DP=5;AF=0.5', '')).strip())
+        with self.assertRaises(IndexError):
+            record.info()
+
+
+class VariantRecordTest(unittest.TestCase):
+    def testInfoEntriesJoinedOnce(self):
+        record = vr.VariantRecord(SAMPLES)
+        record.appendInfo(';DB')
+        record.addInfo('VC=SNV')
+        record.appendInfo(';')
+        record.addInfo('cytoBand=p1')
+        self.assertFalse(record.reparse)
+        self.assertEqual(record.info(), 'DP=5;AF=0.5;DB;VC=SNV;cytoBand=p1')
+        self.assertEqual(record.text(), SAMPLES.replace('DP=5;AF=0.5',
+            'DP=5;AF=0.5;DB;VC=SNV;cytoBand=p1'))
+
+    def testInfoEndsWith(self):
+        record = vr.VariantRecord(SITE)
+        self.assertTrue(record.infoEndsWith('0.5'))
+        record.appendInfo(';x;')
+        record.appendInfo('')
+        self.assertTrue(record.infoEndsWith(';'))
+        record.appendInfo('y')
+        self.assertFalse(record.infoEndsWith(';'))
+        self.assertTrue(record.infoEndsWith('x;y'))
+
+    def testInfoValue(self):
+        record = vr.VariantRecord(SITE)
+        self.assertEqual(record.infoValue('AF'), '0.5')
+        self.assertEqual(record.infoValue('positionType'), '.')
+        record.addInfo('positionType=CDS')
+        self.assertEqual(record.infoValue('positionType'), 'CDS')
+        record.setInfo('DB')
+        self.assertEqual(record.infoValue('DB'), '.')
+        self.assertEqual(record.infoValue('AF'), '.')
+
+    def testHandedOnAsRead(self):
+        record = vr.VariantRecord(SAMPLES)
+        record.addInfo('DB')
+        record.setField(2, 'rs1;rs2')
+        self.assertFalse(record.reparse)
+        again = reread(record)
+        self.assertEqual(len(again), 1)
+        self.assertEqual(again[0].fields, record.fields)
+
+    def testLineBreakReparsed(self):
+        record = vr.VariantRecord(SAMPLES)
+        record.appendInfo(';desc=a\nb')
+        self.assertTrue(record.reparse)
+        self.assertEqual(len(reread(record)), 2)
+
+        record = vr.VariantRecord(SAMPLES)
+        record.setInfo('DP=5\r')
+        self.assertTrue(record.reparse)
+
+    def testTrailingWhitespaceReparsed(self):
+        record = vr.VariantRecord(SITE)
+        record.appendInfo(';name=x ')
+        self.assertTrue(record.reparse)
+        # the next stage strips the line, so it reads INFO without it
+        self.assertEqual(reread(record)[0].info(), 'DP=5;AF=0.5;name=x')
+
+        record = vr.VariantRecord(SAMPLES)
+        record.appendInfo(';name=x ')
+        self.assertTrue(record.reparse)
+        self.assertEqual(reread(record)[0].info(), 'DP=5;AF=0.5;name=x ')
+
+    def testSeparatorInValueReparsed(self):
+        record = vr.VariantRecord(SAMPLES)
+        record.setField(2, 'rs1\trs2')
+        self.assertTrue(record.reparse)
+        self.assertEqual(reread(record)[0].fields[2], 'rs1')
+
+    def testSetSeparator(self):
+        record = vr.VariantRecord(SAMPLES)
+        record.setSeparator('\t ')
+        self.assertTrue(record.reparse)
+        self.assertEqual(record.text(), SAMPLES.replace('\t', '\t '))
+        self.assertEqual(reread(record)[0].fields[1], ' 100')
+
+
+class WriteTest(unittest.TestCase):
+    def testWriteRecordsAndLines(self):
+        lines = vr.asRecords(['#CHROM\tPOS\n', SITE + '\n', SAMPLES])
+        lines[1].addInfo('DB')
+        fh = io.StringIO()
+        vr.writeRecords(fh, [vr.stripLine('##fileformat=VCFv4.1 ')] + lines)
+        self.assertEqual(fh.getvalue(), '##fileformat=VCFv4.1\n' + \
+            '#CHROM\tPOS\n' + SITE + ';DB\n' + SAMPLES + '\n')
+
+    def testWriteNothing(self):
+        fh = io.StringIO()
+        vr.writeRecords(fh, [])
+        self.assertEqual(fh.getvalue(), '')
+
+    def testRecordsKept(self):
+        record = vr.VariantRecord(SITE)
+        self.assertIs(vr.asRecords([record])[0], record)
+        self.assertIs(vr.stripLine(record), record)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+### EOF
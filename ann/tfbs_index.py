@@ -0,0 +1,230 @@
+# tfbs_index.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Memory-mapped, per-chromosome tfbsConsSites overlap index
+#
+# Build once per tfbsConsSites release with:
+#   python tfbs_index.py <index_directory>
+#
+# Layout of <index_directory>:
+#   meta.json        chromosomes and record counts
+#   <chrom>.bin      one file per tfbsConsSites<chrom> table, holding
+#       n, size      record count and bytes of region text (uint64)
+#       starts       chromStart of each record, ascending (int64, n)
+#       ends         chromEnd of each record (int64, n)
+#       maxends      running maximum of ends (int64, n)
+#       seqs         row number of each record in the table (uint64, n)
+#       offsets      offsets into the region text (uint64, n + 1)
+#       text         utf-8 tfbsRegion values, name.chrom.start.end
+#
+# The tables are too large to keep in memory, so the annotator maps only
+# the file of the chromosome it is reading and unmaps it when the input
+# moves on to another chromosome.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import mmap
+import shutil
+import time
+from array import array
+from bisect import bisect_right
+
+import utils as u
+
+CHROMS = ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '11', '12',
+    '13', '14', '15', '16', '17', '18', '19', '20', '21', '22', 'X', 'Y']
+
+"""tfbsRegion value of a (chrom, chromStart, chromEnd, name) row, as
+   written by addOverlapWithTfbsConsSites
+"""
+def region(row):
+    t = str(row[3]) + '.' + str(row[0]) + '.' + str(row[1]) + '.' + \
+        str(row[2])
+    return t.strip()
+
+
+"""Write the index file of one chromosome
+   Records are sorted by start for the bisect and keep the number of the
+   row as the table was read, so lookups list them in that order. SQL
+   does not define it, for the per-variant query either, so hits may be
+   listed in another order than from MySQL
+"""
+def writeChromosome(cursor, table, path, chunk=100000):
+    cursor.execute('select chrom, chromStart, chromEnd, name from ' + \
+        table + ';')
+    records = []
+    seq = 0
+    rows = cursor.fetchmany(chunk)
+    while (len(rows) > 0):
+        for row in rows:
+            if (row[1] is not None) and (row[2] is not None):
+                records.append((int(row[1]), seq, int(row[2]), region(row)))
+            seq = seq + 1
+        rows = cursor.fetchmany(chunk)
+    records.sort()
+
+    starts = array('q')
+    ends = array('q')
+    maxends = array('q')
+    seqs = array('Q')
+    offsets = array('Q', [0])
+    text = bytearray()
+    for (start, seq, end, value) in records:
+        starts.append(start)
+        ends.append(end)
+        if (len(maxends) == 0) or (end > maxends[-1]):
+            maxends.append(end)
+        else:
+            maxends.append(maxends[-1])
+        seqs.append(seq)
+        text.extend(value.encode('utf-8'))
+        offsets.append(len(text))
+
+    with open(path, 'wb') as fh:
+        array('Q', [len(records), len(text)]).tofile(fh)
+        for column in (starts, ends, maxends, seqs, offsets):
+            column.tofile(fh)
+        fh.write(text)
+    return len(records)
+
+
+"""Export the tfbsConsSites<chrom> tables into an index directory
+"""
+def buildIndex(conn, directory, table='tfbsConsSites', chroms=CHROMS):
+    tmpdir = directory.rstrip('/') + '.tmp'
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+
+    counts = {}
+    cursor = conn.cursor()
+    for chrom in chroms:
+        counts[chrom] = writeChromosome(cursor, table + chrom,
+            os.path.join(tmpdir, chrom + '.bin'))
+        print(f"{chrom}: {str(counts[chrom])} records")
+    cursor.close()
+
+    meta = {'table': table, 'built': int(time.time()), 'chroms': counts}
+    with open(os.path.join(tmpdir, 'meta.json'), 'w') as fh:
+        json.dump(meta, fh, indent=2)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.rename(tmpdir, directory)
+
+
+"""The mapped index file of one chromosome
+"""
+class ChromosomeIndex(object):
+    def __init__(self, path):
+        fh = open(path, 'rb')
+        try:
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fh.close()
+
+        self.views = [memoryview(self.mm)]
+        count, size = self.section(0, 2, 'Q')
+        offset = 16
+        self.starts = self.section(offset, count, 'q')
+        self.ends = self.section(offset + 8 * count, count, 'q')
+        self.maxends = self.section(offset + 16 * count, count, 'q')
+        self.seqs = self.section(offset + 24 * count, count, 'Q')
+        self.offsets = self.section(offset + 32 * count, count + 1, 'Q')
+        self.text = self.section(offset + 40 * count + 8, size, 'B')
+
+    def section(self, offset, count, typecode):
+        width = array(typecode).itemsize
+        view = self.views[0][offset:offset + count * width]
+        self.views.append(view)
+        if (typecode == 'B'):
+            return view
+        view = view.cast(typecode)
+        self.views.append(view)
+        return view
+
+    """tfbsRegion values of the records with start <= pos <= end, in
+       table order
+    """
+    def regions(self, pos):
+        starts = self.starts
+        ends = self.ends
+        maxends = self.maxends
+        hits = []
+        i = bisect_right(starts, pos) - 1
+        while (i >= 0) and (maxends[i] >= pos):
+            if (ends[i] >= pos):
+                hits.append((self.seqs[i], i))
+            i = i - 1
+        hits.sort()
+
+        offsets = self.offsets
+        return [bytes(self.text[offsets[i]:offsets[i + 1]]).decode('utf-8')
+            for (seq, i) in hits]
+
+    def close(self):
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        self.mm.close()
+
+
+"""Read-only view of an index directory
+   Only one chromosome is mapped at a time: regions() maps the file of
+   the chromosome asked for and unmaps the previous one
+"""
+class TfbsIndex(object):
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as fh:
+            meta = json.load(fh)
+        self.counts = meta['chroms']
+        self.chrom = None
+        self.current = None
+
+    def chromosome(self, chrom):
+        if (chrom != self.chrom):
+            self.release()
+            if chrom in self.counts:
+                self.current = ChromosomeIndex(
+                    os.path.join(self.directory, chrom + '.bin'))
+            self.chrom = chrom
+        return self.current
+
+    def regions(self, chrom, pos):
+        index = self.chromosome(chrom)
+        if index is None:
+            return []
+        return index.regions(int(pos))
+
+    def release(self):
+        if self.current is not None:
+            self.current.close()
+        self.chrom = None
+        self.current = None
+
+
+_indexes = {}
+
+"""Get the index in a directory, opening it on first use
+"""
+def getIndex(directory):
+    if directory not in _indexes:
+        _indexes[directory] = TfbsIndex(directory)
+    return _indexes[directory]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        conn = u.db_connect()
+        buildIndex(conn, sys.argv[1])
+        conn.close()
+    else:
+        print("An output directory for the tfbsConsSites index must be " + \
+            "provided.")
+
+### EOF
@@ -0,0 +1,161 @@
+# transcript_model.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Precompiled refGene transcript model for getGenes and
+# addOverlapWithRefGene
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+from array import array
+from bisect import bisect_right
+
+import interval_index as ii
+
+# Positions of the refGene columns
+CHROM_IND = 2
+STRAND_IND = 3
+TX_START_IND = 4
+TX_END_IND = 5
+CDS_START_IND = 6
+CDS_END_IND = 7
+EXON_COUNT_IND = 8
+EXON_STARTS_IND = 9
+EXON_ENDS_IND = 10
+SYMBOL_IND = 12
+
+"""Exon coordinates from an exonStarts/exonEnds value
+"""
+def parseExons(value, count):
+    if isinstance(value, (bytes, bytearray)):
+        value = value.decode('utf-8')
+    return [int(x) for x in str(value).split(',')[:count]]
+
+
+"""refGene transcripts compiled once into parallel arrays
+   Transcript t is the t-th row in table order. Its exons are
+   exonStarts[exonOffsets[t]:exonOffsets[t + 1]] (and exonEnds alike),
+   so an exon lookup is a bisect over the transcript's slice instead of
+   splitting the exon blobs for every variant
+"""
+class TranscriptModel(object):
+    def __init__(self):
+        self.rows = []
+        self.strand = []
+        self.symbol = []
+        self.txStart = array('q')
+        self.txEnd = array('q')
+        self.cdsStart = array('q')
+        self.cdsEnd = array('q')
+        self.exonCount = array('q')
+        self.exonOffsets = array('Q', [0])
+        self.exonStarts = array('q')
+        self.exonEnds = array('q')
+        self.sortedExons = array('B')
+        self.index = ii.IntervalIndex()
+
+    def add(self, row):
+        t = len(self.rows)
+        count = int(row[EXON_COUNT_IND])
+        starts = parseExons(row[EXON_STARTS_IND], count)
+        ends = parseExons(row[EXON_ENDS_IND], count)
+        starts = starts[:len(ends)]
+        ends = ends[:len(starts)]
+
+        self.rows.append(row)
+        self.strand.append(str(row[STRAND_IND]))
+        self.symbol.append(str(row[SYMBOL_IND]))
+        self.txStart.append(int(row[TX_START_IND]))
+        self.txEnd.append(int(row[TX_END_IND]))
+        self.cdsStart.append(int(row[CDS_START_IND]))
+        self.cdsEnd.append(int(row[CDS_END_IND]))
+        self.exonCount.append(count)
+        self.exonStarts.extend(starts)
+        self.exonEnds.extend(ends)
+        self.exonOffsets.append(len(self.exonStarts))
+        # bisect needs starts and ends that both ascend
+        self.sortedExons.append((starts == sorted(starts)) and
+            (ends == sorted(ends)))
+
+        self.index.add(str(row[CHROM_IND]), row[TX_START_IND],
+            row[TX_END_IND], t)
+
+    def build(self):
+        self.index.build()
+        return self
+
+    """Transcripts with txStart - offset <= pos <= txEnd + offset, in
+       table order
+    """
+    def transcripts(self, chrom, pos, offset=0):
+        return self.index.overlapRange(chrom, pos - offset, pos + offset)
+
+    def overlap(self, chrom, pos):
+        return [self.rows[t] for t in self.transcripts(chrom, int(pos))]
+
+    def span(self, chrom, pos):
+        return self.index.span(chrom, pos)
+
+    def first(self, chrom, pos):
+        rows = self.overlap(chrom, pos)
+        if (len(rows) > 0):
+            return rows[0]
+        return None
+
+    """Numbers (from 0, ascending) of the exons of transcript t that
+       contain pos, ends included
+    """
+    def exonsAt(self, t, pos):
+        lo = self.exonOffsets[t]
+        hi = self.exonOffsets[t + 1]
+        starts = self.exonStarts
+        ends = self.exonEnds
+        if not self.sortedExons[t]:
+            return [i - lo for i in range(lo, hi)
+                if (starts[i] <= pos) and (pos <= ends[i])]
+
+        exons = []
+        i = bisect_right(starts, pos, lo, hi) - 1
+        while (i >= lo) and (ends[i] >= pos):
+            exons.append(i - lo)
+            i = i - 1
+        exons.reverse()
+        return exons
+
+
+"""Compile rows fetched by a query (the batch and per-variant paths)
+"""
+def compileRows(rows):
+    model = TranscriptModel()
+    for row in rows:
+        model.add(row)
+    return model
+
+
+"""Load a whole refGene-style table into a TranscriptModel
+"""
+def buildModel(cursor, table, chunk=10000):
+    cursor.execute('select * from ' + table + ';')
+    model = TranscriptModel()
+    rows = cursor.fetchmany(chunk)
+    while (len(rows) > 0):
+        for row in rows:
+            model.add(row)
+        rows = cursor.fetchmany(chunk)
+    return model.build()
+
+
+_models = {}
+
+"""Get the model for a table, building it on first use
+   Models are kept for the life of the process and shared by the
+   getGenes and addOverlapWithRefGene stages
+"""
+def getModel(cursor, table='refGene'):
+    if table not in _models:
+        _models[table] = buildModel(cursor, table)
+    return _models[table]
+
+### EOF
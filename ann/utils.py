@@ -13,24 +13,45 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import time
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
-"""Get connection to reference database
-"""
-def db_connect():
-    AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
-        ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+import db_pool
 
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
-    try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
+# Seconds the RDS secret is cached before Secrets Manager is asked again
+RDS_SECRET_TTL = int(os.environ.get('RDS_SECRET_TTL', 300))
+
+_rds_secret = {'value': None, 'expires': 0}
+
+"""Get the RDS credentials, cached for RDS_SECRET_TTL seconds
+"""
+def getRdsSecret(refresh=False):
+    if refresh or (_rds_secret['value'] is None) or \
+        (time.time() >= _rds_secret['expires']):
+        AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
+            ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+
+        # Get RDS secret from AWS Secrets Manager
+        asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+        try:
+            asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
+            _rds_secret['value'] = json.loads(asm_response['SecretString'])
+            _rds_secret['expires'] = time.time() + RDS_SECRET_TTL
+        except ClientError as e:
+            print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
+            raise e
+
+    return _rds_secret['value']
+
+
+"""Open a new connection to the reference database
+   If the cached credentials are refused (e.g. after a secret rotation),
+   the secret is fetched again and the connection retried once
+"""
+def rdsConnect(refresh=False):
+    rds_secret = getRdsSecret(refresh=refresh)
 
     # Extract database connection parameters
     rds_host = rds_secret['host']
@@ -40,12 +61,36 @@ def db_connect():
     database_name = 'annotator'
 
     # Return a connection to the database
-    return pymysql.connect(
-        host=rds_host,
-        port=mysql_port,
-        user=username,
-        passwd=password,
-        db=database_name)
+    try:
+        return pymysql.connect(
+            host=rds_host,
+            port=mysql_port,
+            user=username,
+            passwd=password,
+            db=database_name)
+    except pymysql.OperationalError as e:
+        if refresh:
+            raise e
+        return rdsConnect(refresh=True)
+
+
+"""Get connection to reference database
+   Connections come from a process-wide pool (db_pool.py) and go back to
+   it on close(); pass pooled=False for a private connection.
+   If snapshot_dir (or ANNOTATOR_SNAPSHOT_DIR in the environment) names a
+   reference snapshot built with snapshot.py, a read-only connection to
+   the snapshot is returned instead; pass snapshot_dir='' to force RDS
+"""
+def db_connect(snapshot_dir=None, pooled=True):
+    if snapshot_dir is None:
+        snapshot_dir = os.environ.get('ANNOTATOR_SNAPSHOT_DIR')
+    if snapshot_dir:
+        import snapshot
+        return snapshot.connect(snapshot_dir)
+
+    if not pooled:
+        return rdsConnect()
+    return db_pool.getPool(rdsConnect).acquire()
 
 
 """Column inices for pileup and VCF
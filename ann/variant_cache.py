@@ -0,0 +1,155 @@
+# variant_cache.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Persistent cross-job cache of the stages' annotation fragments
+#
+# Jobs from the same cohorts see mostly the same variants, so what each
+# stage adds for a variant is kept in a local SQLite file, keyed by the
+# stage, the reference version and the normalized variant key (chrom
+# without 'chr', pos, ref, alt). The file is bounded in size: entries are
+# stamped when they are written or read, and the least recently used are
+# evicted once the values stored pass max_bytes. Several annotator
+# processes, e.g. parallel shards, can share one file.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import sqlite3
+
+# Bytes of keys and values kept before the least recently used go
+CACHE_BYTES = 1024 * 1024 * 1024
+
+# Share of max_bytes left after an eviction
+EVICT_TO = 0.9
+
+# Keys per statement
+KEY_CHUNK = 500
+
+"""Normalized key of a record: chrom without a leading 'chr', pos, ref
+   and alt, as the stages read them
+"""
+def variantKey(fields, inds):
+    values = []
+    for i in inds:
+        if (len(fields) > i):
+            values.append(fields[i].strip())
+        else:
+            values.append('')
+    if values[0].startswith('chr'):
+        values[0] = values[0][3:]
+    return '\t'.join(values)
+
+
+"""A cache file, for the fragments of one reference version
+"""
+class VariantCache(object):
+    def __init__(self, path, version, max_bytes=CACHE_BYTES):
+        self.version = str(version)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.lookups = 0
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('create table if not exists fragments ' + \
+            '(name text, version text, key text, value text, ' + \
+            'size integer, used integer, primary key (name, version, key))')
+        self.conn.execute('create index if not exists fragments_used ' + \
+            'on fragments (used)')
+        self.conn.execute('create table if not exists usage (bytes integer)')
+        if self.conn.execute('select count(*) from usage').fetchone()[0] == 0:
+            self.conn.execute('insert into usage values (0)')
+        self.conn.commit()
+        self.clock = self.conn.execute(
+            'select max(used) from fragments').fetchone()[0] or 0
+
+    def tick(self):
+        self.clock = self.clock + 1
+        return self.clock
+
+    """Fragments of a stage found for keys, {key: fragment}
+    """
+    def get(self, name, keys):
+        found = {}
+        unique = list(set(keys))
+        used = self.tick()
+        for i in range(0, len(unique), KEY_CHUNK):
+            chunk = unique[i:i + KEY_CHUNK]
+            marks = ', '.join(['?'] * len(chunk))
+            args = [name, self.version] + chunk
+            for (key, value) in self.conn.execute('select key, value ' + \
+                'from fragments where name = ? and version = ? ' + \
+                'and key in (' + marks + ')', args):
+                found[key] = json.loads(value)
+            self.conn.execute('update fragments set used = ' + str(used) + \
+                ' where name = ? and version = ? and key in (' + marks + ')',
+                args)
+        self.conn.commit()
+
+        self.lookups = self.lookups + len(keys)
+        self.hits = self.hits + len([key for key in keys if key in found])
+        return found
+
+    """Store the fragments of a stage, {key: fragment}
+    """
+    def put(self, name, fragments):
+        if (len(fragments) == 0):
+            return
+        used = self.tick()
+        added = 0
+        for (key, fragment) in fragments.items():
+            value = json.dumps(fragment)
+            size = len(key) + len(value)
+            cursor = self.conn.execute('insert or ignore into fragments ' + \
+                'values (?, ?, ?, ?, ?, ?)',
+                (name, self.version, key, value, size, used))
+            if (cursor.rowcount == 1):
+                added = added + size
+        self.conn.execute('update usage set bytes = bytes + ?', (added,))
+        self.conn.commit()
+        if (self.size() > self.max_bytes):
+            self.evict()
+
+    """Bytes of keys and values stored
+    """
+    def size(self):
+        return self.conn.execute('select bytes from usage').fetchone()[0]
+
+    """Remove the least recently used entries until the cache is down to
+       EVICT_TO of max_bytes
+    """
+    def evict(self):
+        excess = self.size() - int(self.max_bytes * EVICT_TO)
+        while (excess > 0):
+            rows = self.conn.execute('select rowid, size from fragments ' + \
+                'order by used limit ' + str(KEY_CHUNK)).fetchall()
+            if (len(rows) == 0):
+                break
+            removed = 0
+            victims = []
+            for (rowid, size) in rows:
+                if (removed >= excess):
+                    break
+                victims.append(rowid)
+                removed = removed + size
+            self.conn.execute('delete from fragments where rowid in (' + \
+                ', '.join([str(rowid) for rowid in victims]) + ')')
+            self.conn.execute('update usage set bytes = bytes - ?',
+                (removed,))
+            excess = excess - removed
+        self.conn.commit()
+
+    """Hit rate and size lines for the .count.log
+    """
+    def report(self):
+        rate = 0.0
+        if (self.lookups > 0):
+            rate = (self.hits / float(self.lookups)) * 100
+        return [f"Cache hits: {str(self.hits)} of {str(self.lookups)} " + \
+            f"({str(rate)}%)", f"Cache size: {str(self.size())} bytes"]
+
+    def close(self):
+        self.conn.close()
+
+### EOF
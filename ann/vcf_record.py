@@ -0,0 +1,168 @@
+# vcf_record.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Splitting and joining VCF records for the annotation stages
+#
+# The stages only read or change CHROM, POS, ID, REF, ALT and INFO, so a
+# record is split into its first eight columns (CHROM through INFO) and
+# the rest of the line, FORMAT and the sample columns, is kept as one
+# untouched string that is written back as it was read. In multi-sample
+# files most of every line is genotypes, which are then never split into
+# a string per sample nor joined back together by each stage.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+# Columns split off the front of a record, CHROM through INFO
+COLUMNS = 8
+
+# Index of INFO, and of the rest of the line if there is one
+INFO_IND = 7
+REST_IND = 8
+
+"""Split a record into its first COLUMNS fields and, if the line has
+   more columns, the rest of the line as a last field
+"""
+def splitRecord(line, sep='\t'):
+    return line.split(sep, COLUMNS)
+
+
+"""Join the fields of splitRecord() back into a line with sep between
+   every column, the columns inside the rest of the line included (they
+   are separated by split as read)
+"""
+def joinRecord(fields, sep='\t', split='\t'):
+    if (sep != split) and (len(fields) > REST_IND):
+        fields = fields[:REST_IND] + [fields[REST_IND].replace(split, sep)]
+    return sep.join(fields)
+
+
+"""A record as the stages see it: the fields of splitRecord(), with INFO
+   kept as the text read plus the entries the stages added to it, in
+   order. INFO is only built when it is read back or the record is
+   written, so records that pick up many entries are not copied at every
+   addition. infoValue() parses INFO into (name, value) items once and
+   keeps them until INFO changes.
+   A record written with a separator other than sep, or given INFO text
+   holding a line break, sep or trailing whitespace, has reparse set: a
+   later stage would have read it differently from its text, so it is
+   handed on as text instead
+"""
+class VariantRecord(object):
+    __slots__ = ('fields', 'added', 'items', 'sep', 'joinSep', 'reparse')
+
+    def __init__(self, line, sep='\t'):
+        self.fields = splitRecord(line, sep)
+        self.added = []
+        self.items = None
+        self.sep = sep
+        self.joinSep = '\t'
+        self.reparse = False
+
+    def check(self, text):
+        if ('\n' in text) or ('\r' in text) or (self.sep in text) or \
+            text[-1:].isspace():
+            self.reparse = True
+
+    def info(self):
+        if (len(self.added) > 0):
+            self.fields[INFO_IND] = self.fields[INFO_IND] + \
+                ''.join(self.added)
+            self.added = []
+        return self.fields[INFO_IND]
+
+    def setInfo(self, text):
+        self.fields[INFO_IND] = text
+        self.added = []
+        self.items = None
+        self.check(text)
+
+    """Append text to INFO as it is
+    """
+    def appendInfo(self, text):
+        self.added.append(text)
+        self.items = None
+        self.check(text)
+
+    """Append an entry to INFO, after a ';' unless INFO ends with one
+    """
+    def addInfo(self, text):
+        if self.infoEndsWith(';'):
+            self.appendInfo(text)
+        else:
+            self.appendInfo(';' + text)
+
+    def infoEndsWith(self, suffix):
+        for text in reversed(self.added):
+            if (len(text) >= len(suffix)):
+                return text.endswith(suffix)
+            if (len(text) > 0):
+                break
+        return self.info().endswith(suffix)
+
+    """Value of the first INFO item whose name contains key, '.' if there
+       is none (as utils.parse_field)
+    """
+    def infoValue(self, key):
+        if self.items is None:
+            self.items = [item.split('=') for item in
+                self.info().strip().split(';')]
+        for pairs in self.items:
+            if (pairs[0].find(key) > -1):
+                if (len(pairs) > 1):
+                    return pairs[1]
+                break
+        return '.'
+
+    def setField(self, i, text):
+        self.fields[i] = text
+        self.check(text)
+
+    """Write the record with sep between its columns from now on
+    """
+    def setSeparator(self, sep):
+        self.joinSep = sep
+        self.reparse = True
+
+    def text(self):
+        if (len(self.added) > 0):
+            self.info()
+        return joinRecord(self.fields, self.joinSep, self.sep)
+
+
+"""Records of a chunk of lines read from a file or handed on by a stage;
+   records are kept, lines are stripped and split once here
+"""
+def asRecords(lines, sep='\t'):
+    return [l if isinstance(l, VariantRecord) else
+        VariantRecord(l.strip(), sep) for l in lines]
+
+
+"""A header line as a stage returns it: stripped, unless it is held in a
+   record, which already is
+"""
+def stripLine(item):
+    if isinstance(item, VariantRecord):
+        return item
+    return item.strip()
+
+
+"""Text of a line or record
+"""
+def lineText(item):
+    if isinstance(item, VariantRecord):
+        return item.text()
+    return item
+
+
+"""Write a chunk of lines or records with one join, and without a copy
+   of every line to append its newline
+"""
+def writeRecords(fh, lines):
+    if (len(lines) > 0):
+        fh.write('\n'.join([lineText(l) for l in lines]))
+        fh.write('\n')
+
+### EOF